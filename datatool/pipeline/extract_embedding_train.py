@@ -1,7 +1,9 @@
 import jieba
 import time
 import datetime
+import multiprocessing
 import traceback
+from datatool.pipeline import sharding
 from utils.mention import extract_mention_and_plain_text_from_annotated_doc
 import re
 
@@ -9,82 +11,121 @@ import re
 punctuations = "!！?？/\'\".,:()\-\n·;。＂＃＄％＆＇（）＊＋，－／：；＜＝=＞＠［＼］＾＿｀｛｜｝{|}～｟｠｢｣､、〃《》<>「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏"
 
 
-def extract_bd_corpus(corpus_path, train_text_path):
+def extract_bd_line(line):
     """
+    分词并去掉标点, 标注的 mention 分词边界正确时保留为 [[instance_id|mention]]
+
+    :param line: <instance_id>\t\t<document>
+    :return: train text line
+    """
+    train_text = []
+    instance_id, document = line.strip().split("\t\t")
+
+    # 2020.8.20 strip spaces between chinese words
+    document = re.sub(r'([^a-zA-Z])( )([^a-zA-Z])', r'\1\3', document)
+    document = document.lower()
+
+    mention_anchor_list, plain_doc = extract_mention_and_plain_text_from_annotated_doc(document)
+
+    splitted_words = list(jieba.cut(plain_doc))
+
+    offset, m_index, s_index = 0, 0, 0
+
+    while s_index < len(splitted_words):
+        word = splitted_words[s_index]
+        if m_index >= len(mention_anchor_list):
+            if word not in punctuations:
+                train_text.append(word)
+            s_index += 1
+            continue
+
+        mention_item = mention_anchor_list[m_index]
+        if offset < mention_item[2]:
+            if word not in punctuations:
+                train_text.append(word)
+            offset += len(word)
+            s_index += 1
+        elif offset > mention_item[2]:
+            m_index += 1
+        else: # offset == mention_item[2], the start position of mention in the plain document.
+            tmp_mention = []
+
+            while s_index < len(splitted_words) and offset < mention_item[2] + len(mention_item[0]):
+                word = splitted_words[s_index]
+                tmp_mention.append(word)
+                offset += len(word)
+                s_index += 1
+
+            # 如果 mention 的分词边界没有问题
+            if offset == mention_item[2] + len(mention_item[0]) and \
+                    ''.join(tmp_mention) == mention_item[0]:
+                mention = ''.join(tmp_mention)
+                train_text.append("[[{}|{}]]".format(instance_id, mention))
+            else:
+                train_text.extend(tmp_mention)
+            m_index += 1
+    return " ".join(train_text).strip() + "\n"
+
+
+def extract_bd_lines(batch):
+    """
+    :param batch: (first_line_no, lines) from sharding.iter_line_batches
+    :return: (number of lines, train text lines)
+    """
+    _, lines = batch
+    train_lines = []
+    for line in lines:
+        try:
+            train_lines.append(extract_bd_line(line))
+        except Exception as e:
+            traceback.print_exc()
+    return len(lines), train_lines
+
+
+def extract_bd_corpus(corpus_path, train_text_path, workers=1, batch_size=2000):
+    """
+    workers > 1 时每 batch_size 行在 fork 出的进程中分词, 结果按原顺序写出, 与单进程输出相同
+
     :param corpus_path: <instance_id>\t\t<document>
     :param train_text_path:
-    :return: mention_anchors, out_links
+    :param workers: number of worker processes
+    :param batch_size: number of lines sent to a worker at once
+    :return: number of lines
     """
-    print("Extracting `bd` train text for embedding training from standard corpus file:\n\t{}".format(corpus_path))
+    print("Extracting `bd` train text for embedding training from standard corpus file:\n\t{}, workers: {}".format(
+        corpus_path, workers))
     counter, mode_cnt = 0, 100000
-    start_time = int(time.time())
-    last_update = start_time
-
-    train_text_writer = open(train_text_path, "w", encoding="utf-8")
-    with open(corpus_path, "r", encoding="utf-8") as rf:
-        for line in rf:
-            train_text = ""
-            counter += 1
-            if counter % mode_cnt == 0:
-                curr_update = int(time.time())
-                print("#{}, time: {}, total_time: {}".format(
-                    counter,
-                    str(datetime.timedelta(seconds=curr_update-last_update)),
-                    str(datetime.timedelta(seconds=curr_update-start_time))
-                ))
-                last_update = curr_update
-            try:
-                instance_id, document = line.strip().split("\t\t")
-
-                # 2020.8.20 strip spaces between chinese words
-                document = re.sub(r'([^a-zA-Z])( )([^a-zA-Z])', r'\1\3', document)
-                document = document.lower()
-
-                mention_anchor_list, plain_doc = extract_mention_and_plain_text_from_annotated_doc(document)
-
-                splitted_words = list(jieba.cut(plain_doc))
-
-                offset, m_index, s_index = 0, 0, 0
-
-                while s_index < len(splitted_words):
-                    word = splitted_words[s_index]
-                    if m_index >= len(mention_anchor_list):
-                        if word not in punctuations:
-                            train_text += word + " "
-                        s_index += 1
-                        continue
-
-                    mention_item = mention_anchor_list[m_index]
-                    if offset < mention_item[2]:
-                        if word not in punctuations:
-                            train_text += word + " "
-                        offset += len(word)
-                        s_index += 1
-                    elif offset > mention_item[2]:
-                        m_index += 1
-                    else: # offset == mention_item[2], the start position of mention in the plain document.
-                        tmp_mention = []
-
-                        while s_index < len(splitted_words) and offset < mention_item[2] + len(mention_item[0]):
-                            word = splitted_words[s_index]
-                            tmp_mention.append(word)
-                            offset += len(word)
-                            s_index += 1
-
-                        # 如果 mention 的分词边界没有问题
-                        if offset == mention_item[2] + len(mention_item[0]) and \
-                                ''.join(tmp_mention) == mention_item[0]:
-                            mention = ''.join(tmp_mention)
-                            train_text += "[[{}|{}]] ".format(instance_id, mention)
-                        else:
-                            train_text += " ".join(tmp_mention) + " "
-                        m_index += 1
-                train_text_writer.write(train_text.strip() + "\n")
-            except Exception as e:
-                traceback.print_exc()
-    train_text_writer.close()
-    print("Train text extracted, time: {}, saved to file:\n\t{}".format(
-        str(datetime.timedelta(seconds=int(time.time()) - start_time)), train_text_path))
+    start_time = time.time()
+    last_update, last_counter = start_time, 0
+
+    # 在 fork 之前加载 jieba 词典, 子进程不再各自加载
+    jieba.initialize()
+    pool = multiprocessing.get_context("fork").Pool(workers) if workers > 1 else None
+    try:
+        batches = sharding.iter_line_batches(corpus_path, batch_size)
+        results = sharding.imap_bounded(pool, extract_bd_lines, batches, workers * 2) if pool is not None \
+            else map(extract_bd_lines, batches)
+        with open(train_text_path, "w", encoding="utf-8") as train_text_writer:
+            for batch_counter, train_lines in results:
+                train_text_writer.writelines(train_lines)
+                counter += batch_counter
+                if counter // mode_cnt != (counter - batch_counter) // mode_cnt:
+                    curr_update = time.time()
+                    print("#{}, time: {}, total_time: {}, lines/sec: {:.1f}".format(
+                        counter,
+                        str(datetime.timedelta(seconds=int(curr_update-last_update))),
+                        str(datetime.timedelta(seconds=int(curr_update-start_time))),
+                        (counter - last_counter) / max(curr_update - last_update, 1e-6)
+                    ))
+                    last_update, last_counter = curr_update, counter
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    total_time = time.time() - start_time
+    print("Train text extracted, #{}, time: {}, lines/sec: {:.1f}, saved to file:\n\t{}".format(
+        counter, str(datetime.timedelta(seconds=int(total_time))), counter / max(total_time, 1e-6), train_text_path))
+    return counter
 
 def extract_wiki_corpus(corpus_path, train_text_path):
     """
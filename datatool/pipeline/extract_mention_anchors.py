@@ -1,18 +1,74 @@
 import datetime
+import multiprocessing
+import os
 import time
 
+from datatool.pipeline import sharding
 from utils.dictionary import EntityDictionary
 from utils.mention import extract_mention_and_plain_text_from_annotated_doc
 
 
-def extract_mention_and_out_links_from_corpus(corpus_path):
+def extract_mention_and_out_links_from_corpus(corpus_path, workers=1, num_shards=None):
     """
         只得到 mention_anchors 和 out_links，不需要同步生成 train_text
         由于中文 train_text 的生成需要分词，分词很耗时，可以先用这个函数生成一份 mention_anchors 和 out_links
 
+        workers > 1 时把语料按行边界切成 num_shards 个字节区间 (默认 workers * 4 个), 各进程分别统计,
+        再两两归并, 结果与单进程完全相同
+
     :param corpus_path:
+    :param workers: number of worker processes
+    :param num_shards: number of byte ranges the corpus is split into
     :return:
     """
+    start_time = int(time.time())
+    print("Extracting mention anchors and out links from corpus: \n\t{}".format(corpus_path))
+    if workers <= 1:
+        mention_anchors, out_links, self_links = extract_from_shard(corpus_path, 0, os.path.getsize(corpus_path))
+    else:
+        shards = sharding.split_file(corpus_path, num_shards or workers * 4)
+        print("\tworkers: {}, shards: {}".format(workers, len(shards)))
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            parts = pool.starmap(extract_from_shard, [(corpus_path, start, end, shard_id)
+                                                      for shard_id, (start, end) in enumerate(shards)])
+            mention_anchors, out_links, self_links = sharding.tree_reduce(parts, merge_extracted_shards, pool)
+
+    ol = get_out_link_lists(out_links)
+    print("Extracted, total mentions: #{}, total time: {}".format(
+        len(mention_anchors), str(datetime.timedelta(seconds=int(time.time())-start_time))))
+    return mention_anchors, ol, self_links
+
+
+def get_out_link_lists(out_links):
+    """
+        {instance_id: {anchor: None}} -> {instance_id: [anchor]}, 去掉没有 out link 的实体
+
+    :return: dict
+    """
+    ol = dict()
+    for i in out_links:
+        if len(out_links[i]) > 0:
+            # 按首次出现的顺序逐个加入 set, 得到与逐行 add 相同的 set
+            links = set()
+            for anchor in out_links[i]:
+                links.add(anchor)
+            ol[i] = list(links)
+    return ol
+
+
+def extract_from_shard(corpus_path, start, end, shard_id=0):
+    """
+        统计语料字节区间 [start, end) 中的 mention_anchors, out_links 和 self_links
+
+    :return: (mention_anchors, out_links, self_links), out_links 为 {instance_id: {anchor: None}}, 保持首次出现的顺序
+    """
+    return extract_from_lines(sharding.iter_lines(corpus_path, start, end), shard_id)
+
+
+def extract_from_lines(lines, shard_id=0):
+    """
+        统计若干行语料中的 mention_anchors, out_links 和 self_links, 返回值与 extract_from_shard 相同
+    """
     mention_anchors = dict()
     out_links = dict()
     self_links = dict()
@@ -20,45 +76,64 @@ def extract_mention_and_out_links_from_corpus(corpus_path):
     counter, mode_cnt = 0, 1000000
     start_time = int(time.time())
     last_update = start_time
-    print("Extracting mention anchors and out links from corpus: \n\t{}".format(corpus_path))
-    with open(corpus_path, "r", encoding="utf-8") as rf:
-        for line in rf:
-            counter += 1
-            if counter % mode_cnt == 0:
-                curr_update = int(time.time())
-                print("\t#{}, batch_time: {}, total_time: {}".format(
-                    counter,
-                    str(datetime.timedelta(seconds=curr_update-last_update)),
-                    str(datetime.timedelta(seconds=curr_update-start_time))
-                ))
-                last_update = curr_update
-            try:
-                instance_id, document = line.strip().split("\t\t")
-                mention_anchor_list, _ = extract_mention_and_plain_text_from_annotated_doc(document)
-                if out_links.get(instance_id) is None:
-                    out_links[instance_id] = set()
-                for mention, anchor, offset in mention_anchor_list:
-                    mention = mention.lower()
-                    if mention_anchors.get(mention) is None:
-                        mention_anchors[mention] = dict()
-                    if mention_anchors[mention].get(anchor) is None:
-                        mention_anchors[mention][anchor] = 0
-                    mention_anchors[mention][anchor] += 1
-                    out_links[instance_id].add(anchor)
-
-                    # 2020.10.28
-                    if (instance_id == anchor):
-                        self_links[mention] = self_links.get(mention, 0)+1
-
-            except Exception as e:
-                print(counter, e)
-    ol = dict()
-    for i in out_links:
-        if len(out_links[i]) > 0:
-            ol[i] = list(out_links[i])
-    print("Extracted, total mentions: #{}, total time: {}".format(
-        len(mention_anchors), str(datetime.timedelta(seconds=int(time.time())-start_time))))
-    return mention_anchors, ol, self_links
+    for line in lines:
+        counter += 1
+        if counter % mode_cnt == 0:
+            curr_update = int(time.time())
+            print("\tshard {}, #{}, batch_time: {}, total_time: {}".format(
+                shard_id,
+                counter,
+                str(datetime.timedelta(seconds=curr_update-last_update)),
+                str(datetime.timedelta(seconds=curr_update-start_time))
+            ))
+            last_update = curr_update
+        try:
+            instance_id, document = line.strip().split("\t\t")
+            mention_anchor_list, _ = extract_mention_and_plain_text_from_annotated_doc(document)
+            if out_links.get(instance_id) is None:
+                out_links[instance_id] = dict()
+            for mention, anchor, offset in mention_anchor_list:
+                mention = mention.lower()
+                if mention_anchors.get(mention) is None:
+                    mention_anchors[mention] = dict()
+                if mention_anchors[mention].get(anchor) is None:
+                    mention_anchors[mention][anchor] = 0
+                mention_anchors[mention][anchor] += 1
+                out_links[instance_id][anchor] = None
+
+                # 2020.10.28
+                if (instance_id == anchor):
+                    self_links[mention] = self_links.get(mention, 0)+1
+
+        except Exception as e:
+            print(shard_id, counter, e)
+    return mention_anchors, out_links, self_links
+
+
+def merge_extracted_shards(left, right):
+    """
+        把相邻两个分片的统计结果合并到 left, 计数和链接的合并方式与 merge_mention_anchors, merge_out_links,
+        merge_self_links 相同, 但保留单字 mention, 且保持首次出现的顺序
+
+    :param left: (mention_anchors, out_links, self_links) of the earlier shard
+    :param right: (mention_anchors, out_links, self_links) of the next shard
+    :return: left
+    """
+    mention_anchors, out_links, self_links = left
+    for mention, anchors in right[0].items():
+        if mention_anchors.get(mention) is None:
+            mention_anchors[mention] = anchors
+            continue
+        for anchor, count in anchors.items():
+            mention_anchors[mention][anchor] = mention_anchors[mention].get(anchor, 0) + count
+    for instance_id, anchors in right[1].items():
+        if out_links.get(instance_id) is None:
+            out_links[instance_id] = anchors
+        else:
+            out_links[instance_id].update(anchors)
+    for mention, count in right[2].items():
+        self_links[mention] = self_links.get(mention, 0) + count
+    return left
 
 def merge_mention_anchors(mention_anchors_list):
     """
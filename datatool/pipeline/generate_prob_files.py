@@ -2,10 +2,20 @@ import traceback
 import json
 import time
 import datetime
+import gc
+import multiprocessing
+from collections import Counter
 # from jpype import *
 import ahocorasick
+from datatool.pipeline import sharding
 from datatool.pipeline.extract_mention_anchors import extract_mention_and_plain_text_from_annotated_doc
 
+# mention_anchor_path -> (automaton, labels), automaton 的 payload 为 mention 在 labels 中的下标
+_mention_id_automata = dict()
+# 并行统计 freq(m) 时 fork 前设置, 子进程共享
+freq_m_automaton = None
+freq_m_progress = None
+
 class Parser:
     _instance = None
     index_builder = None
@@ -161,7 +171,9 @@ JDClass = JClass("edu.TextParser")
 shutdownJVM()
 """
 # def cal_freq_m(corpus_path, mention_anchor_path, trie_tree_path, JDClass: JClass):
-def cal_freq_m(corpus_path, mention_anchor_path):
+def cal_freq_m(corpus_path, mention_anchor_path, workers=1, num_shards=None):
+    if workers > 1:
+        return cal_freq_m_sharded(corpus_path, mention_anchor_path, workers, num_shards)
     # parser = Parser.get_instance(mention_anchor_path, trie_tree_path, JDClass)
     parser = Parser.get_instance(mention_anchor_path)
 
@@ -194,6 +206,91 @@ def cal_freq_m(corpus_path, mention_anchor_path):
 
 
 
+def get_mention_id_automaton(mention_anchor_path):
+    """
+    与 Parser 相同的 mention 自动机, 但 payload 只是 mention 的整数 id, 每个文件只构建一次
+
+    :return: (automaton, labels), labels[id] 为 mention
+    """
+    if _mention_id_automata.get(mention_anchor_path) is None:
+        print("Building mention id automaton from: {}".format(mention_anchor_path))
+        start_at = int(time.time())
+        A = ahocorasick.Automaton(ahocorasick.STORE_ANY, ahocorasick.KEY_STRING)
+        mention_ids = dict()
+        with open(mention_anchor_path, 'r', encoding='utf-8') as fin:
+            for line in fin:
+                mention = line.strip().split('::=')[0]
+                A.add_word(mention, mention_ids.setdefault(mention, len(mention_ids)))
+        A.make_automaton()
+        _mention_id_automata[mention_anchor_path] = (A, list(mention_ids))
+        print("Built, #{}, time: {}".format(len(mention_ids), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+    return _mention_id_automata[mention_anchor_path]
+
+
+def cal_freq_m_of_shard(corpus_path, start, end, mode_cnt=100000) -> Counter:
+    """
+    在子进程中统计语料字节区间 [start, end) 的 freq(m), 以 mention id 计数, 每 mode_cnt 行更新一次共享进度
+    """
+    counter, freq = 0, Counter()
+    for line in sharding.iter_lines(corpus_path, start, end):
+        counter += 1
+        if counter % mode_cnt == 0:
+            with freq_m_progress.get_lock():
+                freq_m_progress.value += mode_cnt
+        try:
+            _, plain_doc = extract_mention_and_plain_text_from_annotated_doc(line)
+            freq.update(mention_id for _, mention_id in freq_m_automaton.iter(plain_doc.lower()))
+        except Exception:
+            traceback.print_exc()
+    with freq_m_progress.get_lock():
+        freq_m_progress.value += counter % mode_cnt
+    return freq
+
+
+def merge_freq_counters(left: Counter, right: Counter) -> Counter:
+    left.update(right)
+    return left
+
+
+def cal_freq_m_sharded(corpus_path, mention_anchor_path, workers, num_shards=None, report_interval=30):
+    """
+    与 cal_freq_m 结果相同 (包括 dict 顺序), 自动机在父进程构建一次, fork 出的 workers 共享,
+    各自统计一个字节区间后按区间顺序两两归并
+    """
+    global freq_m_automaton, freq_m_progress
+    freq_m_automaton, labels = get_mention_id_automaton(mention_anchor_path)
+    freq_m_progress = multiprocessing.get_context("fork").Value("q", 0)
+
+    shards = sharding.split_file(corpus_path, num_shards or workers * 4)
+    print("Counting freq(m) in {}, workers: {}, shards: {}".format(corpus_path, workers, len(shards)))
+    start_time = int(time.time())
+    last_update, last_count = start_time, 0
+
+    # 冻结已构建的自动机等对象, 避免 fork 后子进程的 gc 遍历触发写时复制
+    gc.freeze()
+    try:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            result = pool.starmap_async(cal_freq_m_of_shard, [(corpus_path, start, end) for start, end in shards])
+            while not result.ready():
+                result.wait(report_interval)
+                curr_update, count = int(time.time()), freq_m_progress.value
+                if count == last_count: continue
+                print("{}, time: {}, total_time: {}, lines/sec: {:.1f}".format(
+                    count,
+                    str(datetime.timedelta(seconds=curr_update - last_update)),
+                    str(datetime.timedelta(seconds=curr_update - start_time)),
+                    count / max(curr_update - start_time, 1)))
+                last_update, last_count = curr_update, count
+            freq = sharding.tree_reduce(result.get(), merge_freq_counters, pool)
+    finally:
+        gc.unfreeze()
+
+    freq_m = {labels[mention_id]: count for mention_id, count in freq.items()}
+    print("Counted, lines: #{}, mentions: #{}, total_time: {}".format(
+        freq_m_progress.value, len(freq_m), str(datetime.timedelta(seconds=int(time.time()) - start_time))))
+    return freq_m
+
+
 def generate_entity_prior_file(entity_prior, entity_prior_path, entity_prior_json_path):
     json.dump(entity_prior, open(entity_prior_json_path, "w", encoding="utf-8"))
     with open(entity_prior_path, "w", encoding="utf-8") as wf:
@@ -222,6 +319,20 @@ def generate_link_prob_file(e_given_m, link_m, freq_m, link_prob_path):
                     e_given_m[m][e]
                 ))
 
+def prune_e_given_m(e_given_m, max_candidates=None, cum_prob_th=None):
+    """
+    Keeps the top candidates of each mention as generate_mention_anchors_txt_for_trie does,
+    p(e|m) of the kept ones are not renormalized.
+    """
+    from modules.ProbHolder import prune_candidates
+
+    if max_candidates is None and cum_prob_th is None: return e_given_m
+    pruned = dict()
+    for m in e_given_m:
+        pruned[m] = dict(prune_candidates(e_given_m[m].items(), max_candidates, cum_prob_th))
+    return pruned
+
+
 def update_mention_anchor_from_freq_m(ma, freq_m):
     mention_anchors = dict()
     for m in ma:
@@ -1,7 +1,13 @@
 import time
 import datetime
 
-def generate_mention_anchors_txt_for_trie(mention_anchors, mention_anchors_txt_path):
+def generate_mention_anchors_txt_for_trie(mention_anchors, mention_anchors_txt_path, max_candidates=None, cum_prob_th=None):
+    """
+    :param max_candidates: keep at most this many anchors of each mention, the most linked first
+    :param cum_prob_th: stop keeping anchors once their p(e|m), computed from all anchors, sum up to it
+    """
+    from modules.ProbHolder import prune_candidates
+
     print("\nGenerating file for building mention_anchor trie tree, target file path: \n\t{}"
           .format(mention_anchors_txt_path))
     start_at = int(time.time())
@@ -9,6 +15,10 @@ def generate_mention_anchors_txt_for_trie(mention_anchors, mention_anchors_txt_p
         for mention in mention_anchors:
             if mention.strip() == "": continue
             anchors = [a for a in mention_anchors[mention].keys() if a != "__all__"]
+            if max_candidates is not None or cum_prob_th is not None:
+                link_sum = sum(mention_anchors[mention][a] for a in anchors)
+                anchor_probs = [(a, float(mention_anchors[mention][a]) / link_sum) for a in anchors]
+                anchors = [a for a, _ in prune_candidates(anchor_probs, max_candidates, cum_prob_th)]
             wf.write(mention + "::=" + "::=".join(anchors) + "\n")
     print("Generated, time: {}".format(str(datetime.timedelta(seconds=int(time.time())-start_at))))
 
@@ -1,8 +1,11 @@
 import os
 import ahocorasick
+import json
 import pickle
 from tqdm import tqdm
 
+MERGED_WEIGHTS_SUFFIX = ".weights.json"
+
 
 def build_trie(txt_path, trie_path):
     A = ahocorasick.Automaton(ahocorasick.STORE_ANY, ahocorasick.KEY_STRING)
@@ -21,6 +24,80 @@ def build_trie(txt_path, trie_path):
     A.save(trie_path, pickle.dumps)
 
 
+def get_prob_payload(prob_holder, mention, eids):
+    """ (link_prob, (p(e_1|m), ..., p(e_n|m))) of a mention, None where prob_holder has no value.
+    """
+    return prob_holder.get_link_prob(mention), tuple(prob_holder.get_e_given_m(eid, mention) for eid in eids)
+
+
+def build_prob_trie(txt_path, trie_path, prob_holder):
+    """ Same keys as build_trie, payload (mention, (eid_1, ..., eid_n), link_prob, (p(e_1|m), ..., p(e_n|m))),
+    so one automaton hit also gives the priors without looking up prob_holder at prediction time.
+
+    :param prob_holder: modules.ProbHolder.ProbHolder or CompactProbHolder
+    """
+    A = ahocorasick.Automaton(ahocorasick.STORE_ANY, ahocorasick.KEY_STRING)
+    with open(txt_path, 'r', encoding='utf-8') as fin:
+        lines = fin.readlines()
+        for line in tqdm(lines):
+            words = line.strip().split('::=')
+            if (len(words) < 2):
+                continue
+
+            mention, eids = words[0], tuple(words[1:])
+            A.add_word(mention, (mention, eids) + get_prob_payload(prob_holder, mention, eids))
+
+    A.make_automaton()
+    A.save(trie_path, pickle.dumps)
+
+
+def build_merged_trie(sources, trie_path, prob_holders=None):
+    """ Compiles several mention dictionaries into one automaton.
+
+    :param sources: [(name, weight, txt_path), ...], e.g. [("ma", 100, ...), ("tt", 0, ...)]
+    :param trie_path: payload of each key is (mention, ((name, weight, (eid_1, ..., eid_n)), ...)),
+                      in the order of sources. {name: weight} of the sources is written next to it,
+                      see load_merged_weights.
+    :param prob_holders: {name: prob_holder}, entries of these sources are extended by
+                         (link_prob, (p(e_1|m), ..., p(e_n|m))) as in build_prob_trie.
+
+    A mention repeated in a source takes its last line, as build_trie does.
+    """
+    prob_holders = prob_holders or dict()
+    merged = dict()     # mention -> {name: entry}
+    for name, weight, txt_path in sources:
+        with open(txt_path, 'r', encoding='utf-8') as fin:
+            lines = fin.readlines()
+            for line in tqdm(lines):
+                words = line.strip().split('::=')
+                if (len(words) < 2):
+                    continue
+                mention, eids = words[0], tuple(words[1:])
+                entry = (name, weight, eids)
+                if name in prob_holders:
+                    entry += get_prob_payload(prob_holders[name], mention, eids)
+                merged.setdefault(mention, dict())[name] = entry
+
+    A = ahocorasick.Automaton(ahocorasick.STORE_ANY, ahocorasick.KEY_STRING)
+    for mention, entries in merged.items():
+        A.add_word(mention, (mention, tuple(entries.values())))
+
+    A.make_automaton()
+    A.save(trie_path, pickle.dumps)
+    with open(trie_path + MERGED_WEIGHTS_SUFFIX, "w", encoding="utf-8") as wf:
+        json.dump({name: weight for name, weight, _ in sources}, wf, ensure_ascii=False)
+
+
+def load_merged_weights(trie_path):
+    """ {name: weight} of the sources of a trie built by build_merged_trie, None if it was built without it.
+    """
+    weights_path = trie_path + MERGED_WEIGHTS_SUFFIX
+    if not os.path.exists(weights_path):
+        return None
+    with open(weights_path, "r", encoding="utf-8") as rf:
+        return json.load(rf)
+
+
 if __name__ == "__main__": 
     source = "bd"
     data_path = '/mnt/sdd/zfw/xlink2020/%s/' %(source)
@@ -33,6 +110,9 @@ if __name__ == "__main__":
     mention_trie_path = os.path.join(data_path, "mention_anchors.pytrie")
     build_trie(mention_txt_path, mention_trie_path)
 
+    merged_trie_path = os.path.join(data_path, "mentions_merged.pytrie")
+    build_merged_trie([("ma", 100, mention_txt_path), ("tt", 0, title_entity_txt_path)], merged_trie_path)
+
     vocab_txt_path = os.path.join(data_path, "vocab_word.txt")
     vocab_trie_path = os.path.join(data_path, "vocab_word.pytrie")
     build_trie(vocab_txt_path, vocab_trie_path)
\ No newline at end of file
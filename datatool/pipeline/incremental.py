@@ -0,0 +1,399 @@
+"""
+Incremental update of the per-corpus statistics of main.py, i.e. mention_anchors_<corpus>.json,
+out_links_<corpus>.json, self_links_<corpus>.json and freq_m_<corpus>.json, when only some documents changed.
+
+A document is all lines of one instance_id in standard_<corpus>.txt. The state directory (<data_path>/incremental/)
+keeps what the statistics were last computed from: the text of every document, the statistics themselves and the
+mention list freq(m) was counted over (mention_anchors.txt of step 3.1).
+
+The text is kept in documents_<corpus>.txt, an append-only store indexed by documents_<corpus>.index with the
+fingerprint and the byte ranges of each document. save_state appends only the added and changed documents to it
+and drops the changed and deleted ones from the index; the store is rewritten from the corpus only the first time
+and once less than half of it is still indexed.
+
+An update compares the documents by fingerprint. The contributions of changed and deleted documents are
+re-extracted from their previous text in the store and subtracted, those of changed and added documents
+are added. freq(m) of the mentions which are new to the mention list is counted over the whole corpus, since any
+unchanged document may contain them; mentions which left the list are dropped.
+
+The statistics are always updated from the state directory, which is only replaced by save_state, so an update
+interrupted before save_state can simply be run again: bytes appended to the store by an interrupted save_state
+are not in the index and never read.
+
+Usage (see main.py --incremental):
+    deltas = update_mention_anchors_and_out_links(data_path, corpus_list)
+    ... merge_multiple_mention_anchors, generate_mention_anchors_trie
+    update_freq_m(data_path, corpus_list, deltas, workers)
+    save_state(data_path, corpus_list, deltas)
+"""
+import datetime
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from collections import Counter
+from typing import Dict, List, Set, Tuple
+
+import ahocorasick
+
+from datatool.pipeline import generate_prob_files
+from datatool.pipeline.extract_mention_anchors import extract_from_lines, get_out_link_lists
+from modules import Snapshot
+from utils.mention import extract_mention_and_plain_text_from_annotated_doc
+
+STATE_DIR = "incremental"
+
+# {instance_id: (fingerprint, [(offset, length), ...])}, byte ranges of the document's lines in the store
+DocumentIndex = Dict[str, Tuple[str, List[Tuple[int, int]]]]
+
+
+class CorpusDelta:
+    corpus_name  = None     # type: str
+    fingerprints = None     # type: Dict[str, str]
+    added        = None     # type: Set[str]
+    changed      = None     # type: Set[str]
+    deleted      = None     # type: Set[str]
+
+    def __init__(self, corpus_name, fingerprints, added, changed, deleted):
+        self.corpus_name  = corpus_name
+        self.fingerprints = fingerprints
+        self.added        = added
+        self.changed      = changed
+        self.deleted      = deleted
+
+    @property
+    def removed(self) -> Set[str]:
+        """ Documents whose previous contributions are subtracted.
+        """
+        return self.changed | self.deleted
+
+    @property
+    def inserted(self) -> Set[str]:
+        """ Documents whose current contributions are added.
+        """
+        return self.changed | self.added
+
+    def __str__(self):
+        return "{}: documents #{}, added #{}, changed #{}, deleted #{}".format(
+            self.corpus_name, len(self.fingerprints), len(self.added), len(self.changed), len(self.deleted))
+
+
+def get_state_path(data_path) -> str:
+    return os.path.join(data_path, STATE_DIR)
+
+
+def get_instance_id(line) -> str:
+    return line.strip().split("\t\t", 1)[0]
+
+
+def fingerprint_corpus(corpus_path) -> Dict[str, str]:
+    """
+    :return: {instance_id: sha1 of all lines of the document in order}
+    """
+    fingerprints = dict()
+    with open(corpus_path, "r", encoding="utf-8") as rf:
+        for line in rf:
+            instance_id = get_instance_id(line)
+            sha1 = hashlib.sha1(fingerprints.get(instance_id, "").encode("ascii"))
+            sha1.update(line.encode("utf-8"))
+            fingerprints[instance_id] = sha1.hexdigest()
+    return fingerprints
+
+
+def get_documents_path(state_path, corpus_name) -> str:
+    return os.path.join(state_path, "documents_{}.txt".format(corpus_name))
+
+
+def get_document_index_path(state_path, corpus_name) -> str:
+    return os.path.join(state_path, "documents_{}.index".format(corpus_name))
+
+
+def load_document_index(index_path) -> DocumentIndex:
+    index = dict()
+    with open(index_path, "r", encoding="utf-8") as rf:
+        for line in rf:
+            instance_id, fingerprint, ranges = line.rstrip("\n").rsplit("\t", 2)
+            index[instance_id] = (fingerprint, [tuple(int(n) for n in r.split(":")) for r in ranges.split(",")])
+    return index
+
+
+def save_document_index(index: DocumentIndex, index_path) -> None:
+    with open(index_path, "w", encoding="utf-8") as wf:
+        for instance_id, (fingerprint, ranges) in index.items():
+            wf.write("{}\t{}\t{}\n".format(instance_id, fingerprint, ",".join("{}:{}".format(*r) for r in ranges)))
+
+
+def append_documents(corpus_path, wf, instance_ids, fingerprints, index: DocumentIndex) -> None:
+    """ Appends the lines of the documents in instance_ids (all documents if None) to the store opened as wf,
+    and indexes them with their fingerprints. Lines are split as fingerprint_corpus reads them.
+    """
+    offset = wf.tell()
+    with open(corpus_path, "r", encoding="utf-8") as rf:
+        for line in rf:
+            instance_id = get_instance_id(line)
+            if instance_ids is not None and instance_id not in instance_ids: continue
+            line = line.encode("utf-8")
+            wf.write(line)
+            if instance_id not in index:
+                index[instance_id] = (fingerprints[instance_id], [])
+            ranges = index[instance_id][1]
+            if len(ranges) > 0 and sum(ranges[-1]) == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + len(line))
+            else:
+                ranges.append((offset, len(line)))
+            offset += len(line)
+
+
+def iter_stored_document_lines(documents_path, index: DocumentIndex, instance_ids: Set[str]):
+    """ Stored lines of the documents in instance_ids, in store order.
+    """
+    ranges = sorted(r for instance_id in instance_ids if instance_id in index for r in index[instance_id][1])
+    if len(ranges) == 0: return
+    with open(documents_path, "rb") as rf:
+        for offset, length in ranges:
+            rf.seek(offset)
+            yield from io.StringIO(rf.read(length).decode("utf-8"))
+
+
+def diff_corpus(corpus_name, old_fingerprints, new_fingerprints) -> CorpusDelta:
+    added, changed = set(), set()
+    for instance_id, fingerprint in new_fingerprints.items():
+        old_fingerprint = old_fingerprints.get(instance_id)
+        if old_fingerprint is None:
+            added.add(instance_id)
+        elif old_fingerprint != fingerprint:
+            changed.add(instance_id)
+    deleted = set(instance_id for instance_id in old_fingerprints if instance_id not in new_fingerprints)
+    return CorpusDelta(corpus_name, new_fingerprints, added, changed, deleted)
+
+
+def iter_document_lines(corpus_path, instance_ids: Set[str]):
+    """ Lines of the documents in instance_ids, in corpus order.
+    """
+    if len(instance_ids) == 0: return
+    with open(corpus_path, "r", encoding="utf-8") as rf:
+        for line in rf:
+            if get_instance_id(line) in instance_ids:
+                yield line
+
+
+def apply_count_delta(counts: dict, delta: dict, sign) -> None:
+    """ counts[k] += sign * delta[k], keys whose count drops to 0 are removed as a full rebuild would not have them.
+    """
+    for key, count in delta.items():
+        count = counts.get(key, 0) + sign * count
+        if count > 0:
+            counts[key] = count
+        else:
+            counts.pop(key, None)
+
+
+def apply_mention_anchors_delta(mention_anchors: dict, delta: dict, sign) -> None:
+    for mention, anchors in delta.items():
+        if mention_anchors.get(mention) is None:
+            mention_anchors[mention] = dict()
+        apply_count_delta(mention_anchors[mention], anchors, sign)
+        if len(mention_anchors[mention]) == 0:
+            del mention_anchors[mention]
+
+
+def update_corpus_anchors(state_path, corpus_path, delta: CorpusDelta, index: DocumentIndex) -> tuple:
+    """
+    把一个语料中变化的文档应用到 state 中的 mention_anchors, out_links 和 self_links 上
+
+    :return: (mention_anchors, out_links, self_links) of the current corpus
+    """
+    corpus_name = delta.corpus_name
+    mention_anchors = json.load(open(os.path.join(state_path, "mention_anchors_{}.json".format(corpus_name)), "r", encoding="utf-8"))
+    out_links = json.load(open(os.path.join(state_path, "out_links_{}.json".format(corpus_name)), "r", encoding="utf-8"))
+    self_links = json.load(open(os.path.join(state_path, "self_links_{}.json".format(corpus_name)), "r", encoding="utf-8"))
+
+    old_ma, _, old_sl = extract_from_lines(iter_stored_document_lines(
+        get_documents_path(state_path, corpus_name), index, delta.removed))
+    new_ma, new_ol, new_sl = extract_from_lines(iter_document_lines(corpus_path, delta.inserted))
+
+    apply_mention_anchors_delta(mention_anchors, old_ma, -1)
+    apply_mention_anchors_delta(mention_anchors, new_ma, 1)
+    apply_count_delta(self_links, old_sl, -1)
+    apply_count_delta(self_links, new_sl, 1)
+    # 一个文档的 out_links 只由它自己决定, 直接替换
+    for instance_id in delta.removed:
+        out_links.pop(instance_id, None)
+    out_links.update(get_out_link_lists(new_ol))
+    return mention_anchors, out_links, self_links
+
+
+def update_mention_anchors_and_out_links(data_path, corpus_list) -> Dict[str, CorpusDelta]:
+    """
+    取代 main 第 2.1 步: 对比各语料与 state 中的文档指纹, 只重新抽取变化的文档,
+    结果写到 mention_anchors_<corpus>.json, out_links_<corpus>.json 和 self_links_<corpus>.json
+
+    :return: {corpus_name: CorpusDelta}, passed on to update_freq_m and save_state
+    """
+    state_path = get_state_path(data_path)
+    if not os.path.isdir(state_path):
+        raise ValueError("No incremental state in {}, run the full pipeline once first".format(state_path))
+
+    deltas = dict()
+    for corpus_name in corpus_list:
+        start_at = int(time.time())
+        corpus_path = os.path.join(data_path, "standard_{}.txt".format(corpus_name))
+        print("\nUpdating mention anchors and out links incrementally from: {}".format(corpus_path))
+        index = load_document_index(get_document_index_path(state_path, corpus_name))
+        old_fingerprints = {instance_id: fingerprint for instance_id, (fingerprint, _) in index.items()}
+        delta = diff_corpus(corpus_name, old_fingerprints, fingerprint_corpus(corpus_path))
+        print("\t{}".format(delta))
+
+        mention_anchors, out_links, self_links = update_corpus_anchors(state_path, corpus_path, delta, index)
+        json.dump(mention_anchors, open(os.path.join(data_path, "mention_anchors_{}.json".format(corpus_name)), "w", encoding="utf-8"))
+        json.dump(out_links, open(os.path.join(data_path, "out_links_{}.json".format(corpus_name)), "w", encoding="utf-8"))
+        json.dump(self_links, open(os.path.join(data_path, "self_links_{}.json".format(corpus_name)), "w", encoding="utf-8"))
+        deltas[corpus_name] = delta
+        print("Updated, mentions: #{}, time: {}".format(
+            len(mention_anchors), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+    return deltas
+
+
+def load_mention_list(mention_anchor_path) -> List[str]:
+    """ Mentions of mention_anchors.txt, parsed as generate_prob_files.get_mention_id_automaton does.
+    """
+    mentions = dict()
+    with open(mention_anchor_path, "r", encoding="utf-8") as rf:
+        for line in rf:
+            mentions[line.strip().split('::=')[0]] = None
+    return list(mentions)
+
+
+def build_mention_automaton(mentions):
+    A = ahocorasick.Automaton(ahocorasick.STORE_ANY, ahocorasick.KEY_STRING)
+    for mention in mentions:
+        A.add_word(mention, mention)
+    A.make_automaton()
+    return A
+
+
+def count_mentions(lines, automaton) -> Counter:
+    """ freq(m) of the lines, counted as generate_prob_files.cal_freq_m does.
+    """
+    freq = Counter()
+    for line in lines:
+        try:
+            _, plain_doc = extract_mention_and_plain_text_from_annotated_doc(line)
+            freq.update(mention for _, mention in automaton.iter(plain_doc.lower()))
+        except Exception:
+            traceback.print_exc()
+    return freq
+
+
+def update_freq_m(data_path, corpus_list, deltas: Dict[str, CorpusDelta], workers=1) -> None:
+    """
+    取代 main 第 4.1 步, 需在 generate_mention_anchors_trie 生成新的 mention_anchors.txt 之后运行:
+        - 仍在 mention 列表中的 mention: 减去变化/删除文档原来的 freq, 加上变化/新增文档现在的 freq
+        - 新加入列表的 mention: 在整个语料上统计
+        - 离开列表的 mention: 删除
+    结果写到 freq_m_<corpus>.json
+    """
+    state_path = get_state_path(data_path)
+    mention_anchor_path = os.path.join(data_path, "mention_anchors.txt")
+    old_mentions = set(load_mention_list(os.path.join(state_path, "mention_anchors.txt")))
+    new_mentions = load_mention_list(mention_anchor_path)
+    kept_mentions = set(m for m in new_mentions if m in old_mentions)
+    added_mentions = [m for m in new_mentions if m not in old_mentions]
+    print("\nUpdating freq(m) incrementally, mentions: #{}, added: #{}, removed: #{}".format(
+        len(new_mentions), len(added_mentions), len(old_mentions) - len(kept_mentions)))
+
+    kept_automaton = build_mention_automaton(kept_mentions) if len(kept_mentions) > 0 else None
+    added_mention_path = None
+    if len(added_mentions) > 0:
+        fd, added_mention_path = tempfile.mkstemp(suffix=".txt", prefix="added_mentions_", dir=data_path)
+        with open(fd, "w", encoding="utf-8") as wf:
+            for mention in added_mentions:
+                wf.write(mention + "\n")
+    try:
+        for corpus_name in corpus_list:
+            start_at = int(time.time())
+            delta = deltas[corpus_name]
+            corpus_path = os.path.join(data_path, "standard_{}.txt".format(corpus_name))
+            index = load_document_index(get_document_index_path(state_path, corpus_name))
+            freq_m = json.load(open(os.path.join(state_path, "freq_m_{}.json".format(corpus_name)), "r", encoding="utf-8"))
+            freq_m = {m: count for m, count in freq_m.items() if m in kept_mentions}
+
+            if kept_automaton is not None:
+                old_lines = iter_stored_document_lines(get_documents_path(state_path, corpus_name), index, delta.removed)
+                apply_count_delta(freq_m, count_mentions(old_lines, kept_automaton), -1)
+                apply_count_delta(freq_m, count_mentions(iter_document_lines(corpus_path, delta.inserted), kept_automaton), 1)
+            if added_mention_path is not None:
+                if workers > 1:
+                    added_freq_m = generate_prob_files.cal_freq_m_sharded(corpus_path, added_mention_path, workers)
+                else:
+                    with open(corpus_path, "r", encoding="utf-8") as rf:
+                        added_freq_m = count_mentions(rf, build_mention_automaton(added_mentions))
+                apply_count_delta(freq_m, added_freq_m, 1)
+
+            json.dump(freq_m, open(os.path.join(data_path, "freq_m_{}.json".format(corpus_name)), "w", encoding="utf-8"))
+            print("{}: freq(m) updated, mentions: #{}, time: {}".format(
+                corpus_name, len(freq_m), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+    finally:
+        if added_mention_path is not None:
+            os.remove(added_mention_path)
+
+
+def save_documents(data_path, corpus_name, tmp_path, delta: CorpusDelta = None) -> DocumentIndex:
+    """ Writes the document store of the corpus to tmp_path, by appending the inserted documents of delta to the
+    current store when there is one, by copying the whole corpus otherwise.
+
+    :return: the index of the new store
+    """
+    state_path = get_state_path(data_path)
+    corpus_path = os.path.join(data_path, "standard_{}.txt".format(corpus_name))
+    documents_path = get_documents_path(state_path, corpus_name)
+    tmp_documents_path = get_documents_path(tmp_path, corpus_name)
+    index_path = get_document_index_path(state_path, corpus_name)
+
+    if delta is not None and os.path.exists(documents_path) and os.path.exists(index_path):
+        index = load_document_index(index_path)
+        for instance_id in delta.removed:
+            index.pop(instance_id, None)
+        kept_size = sum(length for _, ranges in index.values() for _, length in ranges)
+        if os.path.getsize(documents_path) <= 2 * kept_size:
+            with open(documents_path, "ab") as wf:
+                append_documents(corpus_path, wf, delta.inserted, delta.fingerprints, index)
+            # 硬链接到新的 state 目录, 不复制整个文件; 旧 state 目录删除后仍然保留
+            try:
+                os.link(documents_path, tmp_documents_path)
+            except OSError:
+                shutil.copyfile(documents_path, tmp_documents_path)
+            return index
+        print("\tless than half of {} is indexed, rewriting it".format(documents_path))
+
+    fingerprints = delta.fingerprints if delta is not None else fingerprint_corpus(corpus_path)
+    index = dict()
+    with open(tmp_documents_path, "wb") as wf:
+        append_documents(corpus_path, wf, None, fingerprints, index)
+    return index
+
+
+def save_state(data_path, corpus_list, deltas: Dict[str, CorpusDelta] = None) -> None:
+    """
+    在第 4.1 步之后把当前文档的文本和指纹, 各语料的统计结果以及 mention_anchors.txt 保存为下次增量更新的基准,
+    全量运行之后调用即建立初始的 state
+
+    :param deltas: from update_mention_anchors_and_out_links, only their inserted documents are appended to the
+        document stores if given
+    """
+    state_path = get_state_path(data_path)
+    start_at = int(time.time())
+    print("\nSaving incremental state to: {}".format(state_path))
+    with Snapshot.writing(state_path) as tmp_path:
+        for corpus_name in corpus_list:
+            index = save_documents(data_path, corpus_name, tmp_path, deltas[corpus_name] if deltas is not None else None)
+            save_document_index(index, get_document_index_path(tmp_path, corpus_name))
+            for name in ["mention_anchors", "out_links", "self_links", "freq_m"]:
+                json_file = "{}_{}.json".format(name, corpus_name)
+                shutil.copyfile(os.path.join(data_path, json_file), os.path.join(tmp_path, json_file))
+        shutil.copyfile(os.path.join(data_path, "mention_anchors.txt"), os.path.join(tmp_path, "mention_anchors.txt"))
+    print("Saved, time: {}".format(str(datetime.timedelta(seconds=int(time.time())-start_at))))
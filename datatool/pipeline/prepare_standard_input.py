@@ -1,4 +1,7 @@
 import datetime
+import functools
+import gc
+import multiprocessing
 import time
 import urllib
 import urllib.parse
@@ -8,6 +11,7 @@ import re
 import utils.entity
 import utils.dictionary
 from utils.dictionary import EntityDictionary
+from datatool.pipeline import sharding
 
 
 def get_id2title_from_ttl(source, ttl_path):
@@ -330,7 +334,186 @@ Tool Functions:
 #         line_no, str(datetime.timedelta(seconds=int(time.time())-start_at)), annotation_refined_path))
 
 
-def corpus_full_refine(source, corpus_path, refined_path, mark_titles):
+def add_mention(s, eid, source='bd'):
+    if (source == 'bd'):
+        return '[[%s|%s]]' %(eid, s.group())
+    elif (source == 'wiki'):
+        return '[[%s|%s]]' %(s.group(), eid)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_title_pattern(title):
+    """
+    mark_titles 时用于标注实体 title 的正则, 每个 title 只编译一次, 同一行的所有片段共用
+    """
+    return re.compile(re.escape(title))
+
+
+def refine_corpus_line(source, line, entity_dict, mark_titles):
+    """
+    corpus_full_refine 对一行原始语料的处理
+
+    :return: (refined line or None, 1 if the line has no valid instance id else 0)
+    """
+    prefix = 'https://baike.baidu.com/item/'
+    if not is_corpus_line_valid(source, line):
+        return None, 0
+
+    line_arr = line.strip().split("\t\t")
+
+    if source == 'bd':
+        title = line_arr[0].strip()
+        sub_title = line_arr[1].strip()
+
+        full_title = title
+        if len(sub_title) > 1: 
+            full_title += sub_title
+
+        # strip fromtitle
+        url = prefix+line_arr[2][len(prefix):].split('?')[0]
+        # remove quotes
+        url = entity_dict.strip_quotation_marks(url)
+
+        eid = entity_dict.get_entity_by_uri_and_title(url, full_title)
+        if (eid is None):
+            return None, 1
+        eid = eid.get_id()
+
+        content = line_arr[3].split('::;', 1)[1].strip()
+        refined_annotated_text = ""
+        split_segs = content.split("[[")
+
+        if (mark_titles):
+            title_pattern = get_title_pattern(title)
+            mark_title = lambda s: add_mention(s, eid, source)
+            marked_text = title_pattern.sub(mark_title, split_segs[0])
+            refined_annotated_text += marked_text
+        else:
+            refined_annotated_text += split_segs[0]
+
+        for seg_index in range(1, len(split_segs)):
+            seg = split_segs[seg_index]
+            seg_segs = seg.split("]]")
+            annotated_item = seg_segs[0]
+            split_annotation = annotated_item.split("|")
+
+            is_plain, mention, instance_id = False, "", None
+            if len(split_annotation) == 1:
+                mention = annotated_item
+                is_plain = True
+            else:
+                mention = split_annotation[0]
+                # url = urllib.parse.unquote(split_annotation[1]).split("?")[0]
+                # strip fromtitle
+                # url = prefix+split_annotation[1][len(prefix):].split('/')[0]
+                url = prefix+split_annotation[1][len(prefix):].split('?')[0]
+
+                entity = entity_dict.get_entity_by_uri_and_title(url, mention) # type: utils.dictionary.Entity
+                if entity is None: 
+                    is_plain = True
+                else: 
+                    instance_id = entity.get_id()
+
+            if is_plain:
+                refined_annotated_text += mention
+            else:
+                refined_annotated_text += "[[{}|{}]]".format(instance_id, mention)
+
+            if len(seg_segs) > 1:
+                if (mark_titles):
+                    marked_text = title_pattern.sub(mark_title, seg_segs[1])
+                    refined_annotated_text += marked_text
+                else:
+                    refined_annotated_text += seg_segs[1]
+
+        if (refined_annotated_text != ""):
+            return "%s\t\t%s\n" %(eid, refined_annotated_text), 0
+
+
+    if source == 'wiki':
+        full_title = line_arr[0].strip()
+        eid = entity_dict.get_entity_by_full_title(full_title)
+        if (eid is None):
+            return None, 1
+        eid = eid.get_id()
+        if (len(line_arr[2].split('::;')) == 1):
+            # print(line)
+            return None, 1
+
+        processed_content = line_arr[2].replace("'''", '')
+        content = processed_content.split('::;', 1)[1].strip()
+        refined_annotated_text = ""
+        split_segs = content.split("[[")
+
+        if (mark_titles):
+            # marked_text = re.sub(re.escape(title), lambda s: add_mention(s, eid, source), split_segs[0])
+            # refined_annotated_text += marked_text
+            refined_annotated_text += split_segs[0]
+        else:
+            refined_annotated_text += split_segs[0]
+
+        for seg_index in range(1, len(split_segs)):
+            seg = split_segs[seg_index]
+            seg_segs = seg.split("]]")
+            annotated_item = seg_segs[0]
+            split_annotation = annotated_item.split("|")
+
+            is_plain, mention, instance_id = False, "", None
+            if len(split_annotation) == 1:
+                mention = annotated_item
+                entity = entity_dict.get_entity_by_full_title(mention)
+                if entity is None: 
+                    is_plain = True
+                else:
+                    instance_id = entity.get_id()
+            else:
+                title = split_annotation[0]
+                mention = split_annotation[1]
+
+                entity = entity_dict.get_entity_by_full_title(title)
+                if entity is None: 
+                    is_plain = True
+                else: 
+                    instance_id = entity.get_id()
+
+            if is_plain:
+                refined_annotated_text += mention
+            else:
+                refined_annotated_text += "[[{}|{}]]".format(instance_id, mention)
+
+            if len(seg_segs) > 1:
+                refined_annotated_text += seg_segs[1]
+
+        if (refined_annotated_text != ""):
+            return "%s\t\t%s\n" %(eid, refined_annotated_text), 0
+    return None, 0
+
+
+def refine_corpus_lines(source, mark_titles, batch):
+    """
+    处理一批语料, 在子进程中运行时 entity_dict 为 fork 前加载的单例
+
+    :param batch: (first_line_no, lines) from sharding.iter_line_batches
+    :return: (number of lines, refined lines, error_no)
+    """
+    first_line_no, lines = batch
+    entity_dict = EntityDictionary.get_instance(source)
+    refined_lines, error_no = [], 0
+    for line_no, line in enumerate(lines, first_line_no):
+        # noinspection PyBroadException
+        try:
+            refined_line, error = refine_corpus_line(source, line, entity_dict, mark_titles)
+            error_no += error
+            if refined_line is not None:
+                refined_lines.append(refined_line)
+        except Exception:
+            error_no += 1
+            print("Exception on line: {}".format(line_no))
+            traceback.print_exc()
+    return len(lines), refined_lines, error_no
+
+
+def corpus_full_refine(source, corpus_path, refined_path, mark_titles, workers=1, batch_size=10000):
     """
     提取 corpus_path 中所有的有效数据, 并将其保存到 refined_path 中
 
@@ -339,178 +522,55 @@ def corpus_full_refine(source, corpus_path, refined_path, mark_titles):
         2. abstract/article 的标注合法 (对于中文数据的处理要先把所有的空格去掉)
         3. 有对应的合法 instance id
 
+    workers > 1 时每 batch_size 行分发给 fork 出的进程池处理, 子进程共享已加载的 EntityDictionary,
+    结果按原顺序写出, 与单进程输出相同
+
     :param source: bd|wiki
     :param corpus_path: "./data/bd/raw_abstract.txt"
     :param refined_path: "./data/bd/standard_abstract.txt"
+    :param workers: number of worker processes
+    :param batch_size: number of lines sent to a worker at once
     :return: total, error_no
     """
 
     total = 0
     error_no = 0
-    entity_dict = EntityDictionary.get_instance(source)
+    # 在 fork 之前加载, 子进程直接使用同一份词典
+    EntityDictionary.get_instance(source)
 
     start = int(time.time())
     last_update = start
-    prefix = 'https://baike.baidu.com/item/'
-    print("\nRefining raw corpus: {}".format(corpus_path))
-
-    def add_mention(s, eid, source='bd'):
-        if (source == 'bd'):
-            return '[[%s|%s]]' %(eid, s.group())
-        elif (source == 'wiki'):
-            return '[[%s|%s]]' %(s.group(), eid)
-
-    with open(corpus_path, "r", encoding='utf-8') as rf:
+    print("\nRefining raw corpus: {}, workers: {}".format(corpus_path, workers))
+
+    pool = None
+    if workers > 1:
+        # 冻结已加载的词典, 避免 fork 后子进程的 gc 遍历触发写时复制
+        gc.freeze()
+        pool = multiprocessing.get_context("fork").Pool(workers)
+    try:
+        refine_batch = functools.partial(refine_corpus_lines, source, mark_titles)
+        batches = sharding.iter_line_batches(corpus_path, batch_size)
+        results = sharding.imap_bounded(pool, refine_batch, batches, workers * 2) if pool is not None \
+            else map(refine_batch, batches)
         with open(refined_path, 'w', encoding='utf-8') as wf:
-            for line in rf:
-                total += 1
-                curr_update = int(time.time())
-                # noinspection PyBroadException
-                try:
-                    if total % 1000000 == 0:
-                        print("\t#{}, batch_time: {}, total_time: {}".format(
-                            total,
-                            str(datetime.timedelta(seconds=curr_update-last_update)),
-                            str(datetime.timedelta(seconds=curr_update-start))
-                        ))
-                        last_update = curr_update
-
-                    if not is_corpus_line_valid(source, line):
-                        continue
-
-                    line_arr = line.strip().split("\t\t")
-
-                    if source == 'bd':
-                        title = line_arr[0].strip()
-                        sub_title = line_arr[1].strip()
-
-                        full_title = title
-                        if len(sub_title) > 1: 
-                            full_title += sub_title
-
-                        # strip fromtitle
-                        url = prefix+line_arr[2][len(prefix):].split('?')[0]
-                        # remove quotes
-                        url = entity_dict.strip_quotation_marks(url)
-
-                        eid = entity_dict.get_entity_by_uri_and_title(url, full_title)
-                        if (eid is None):
-                            error_no += 1
-                            continue
-                        eid = eid.get_id()
-
-                        content = line_arr[3].split('::;', 1)[1].strip()
-                        refined_annotated_text = ""
-                        split_segs = content.split("[[")
-                        
-                        if (mark_titles):
-                            marked_text = re.sub(re.escape(title), lambda s: add_mention(s, eid, source), split_segs[0])
-                            refined_annotated_text += marked_text
-                        else:
-                            refined_annotated_text += split_segs[0]
-
-                        for seg_index in range(1, len(split_segs)):
-                            seg = split_segs[seg_index]
-                            seg_segs = seg.split("]]")
-                            annotated_item = seg_segs[0]
-                            split_annotation = annotated_item.split("|")
-
-                            is_plain, mention, instance_id = False, "", None
-                            if len(split_annotation) == 1:
-                                mention = annotated_item
-                                is_plain = True
-                            else:
-                                mention = split_annotation[0]
-                                # url = urllib.parse.unquote(split_annotation[1]).split("?")[0]
-                                # strip fromtitle
-                                # url = prefix+split_annotation[1][len(prefix):].split('/')[0]
-                                url = prefix+split_annotation[1][len(prefix):].split('?')[0]
-
-                                entity = entity_dict.get_entity_by_uri_and_title(url, mention) # type: utils.dictionary.Entity
-                                if entity is None: 
-                                    is_plain = True
-                                else: 
-                                    instance_id = entity.get_id()
-
-                            if is_plain:
-                                refined_annotated_text += mention
-                            else:
-                                refined_annotated_text += "[[{}|{}]]".format(instance_id, mention)
-                            
-                            if len(seg_segs) > 1:
-                                if (mark_titles):
-                                    marked_text = re.sub(re.escape(title), lambda s: add_mention(s, eid), seg_segs[1])
-                                    refined_annotated_text += marked_text
-                                else:
-                                    refined_annotated_text += seg_segs[1]
-
-                        if (refined_annotated_text != ""):
-                            wf.write("%s\t\t%s\n" %(eid, refined_annotated_text))
-                            
-
-                    if source == 'wiki':
-                        full_title = line_arr[0].strip()
-                        eid = entity_dict.get_entity_by_full_title(full_title)
-                        if (eid is None):
-                            error_no += 1
-                            continue
-                        eid = eid.get_id()
-                        if (len(line_arr[2].split('::;')) == 1):
-                            # print(line)
-                            error_no += 1
-                            continue
-                        
-                        processed_content = line_arr[2].replace("'''", '')
-                        content = processed_content.split('::;', 1)[1].strip()
-                        refined_annotated_text = ""
-                        split_segs = content.split("[[")
-
-                        if (mark_titles):
-                            # marked_text = re.sub(re.escape(title), lambda s: add_mention(s, eid, source), split_segs[0])
-                            # refined_annotated_text += marked_text
-                            refined_annotated_text += split_segs[0]
-                        else:
-                            refined_annotated_text += split_segs[0]
-
-                        for seg_index in range(1, len(split_segs)):
-                            seg = split_segs[seg_index]
-                            seg_segs = seg.split("]]")
-                            annotated_item = seg_segs[0]
-                            split_annotation = annotated_item.split("|")
-
-                            is_plain, mention, instance_id = False, "", None
-                            if len(split_annotation) == 1:
-                                mention = annotated_item
-                                entity = entity_dict.get_entity_by_full_title(mention)
-                                if entity is None: 
-                                    is_plain = True
-                                else:
-                                    instance_id = entity.get_id()
-                            else:
-                                title = split_annotation[0]
-                                mention = split_annotation[1]
-
-                                entity = entity_dict.get_entity_by_full_title(title)
-                                if entity is None: 
-                                    is_plain = True
-                                else: 
-                                    instance_id = entity.get_id()
-                            
-                            if is_plain:
-                                refined_annotated_text += mention
-                            else:
-                                refined_annotated_text += "[[{}|{}]]".format(instance_id, mention)
-
-                            if len(seg_segs) > 1:
-                                refined_annotated_text += seg_segs[1]
+            for batch_total, refined_lines, batch_error_no in results:
+                wf.writelines(refined_lines)
+                error_no += batch_error_no
+                total += batch_total
+                if total // 1000000 != (total - batch_total) // 1000000:
+                    curr_update = int(time.time())
+                    print("\t#{}, batch_time: {}, total_time: {}".format(
+                        total,
+                        str(datetime.timedelta(seconds=curr_update-last_update)),
+                        str(datetime.timedelta(seconds=curr_update-start))
+                    ))
+                    last_update = curr_update
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            gc.unfreeze()
 
-                        if (refined_annotated_text != ""):
-                            wf.write("%s\t\t%s\n" %(eid, refined_annotated_text))
-                except Exception:
-                    error_no += 1
-                    print("Exception on line: {}".format(total))
-                    traceback.print_exc()
-                    
     print("Total processed: #{}, error lines: #{}, time: {}, refined corpus is saved to {}".format(
         total, error_no, str(datetime.timedelta(seconds=int(time.time())-start)), refined_path))
     return total, error_no
\ No newline at end of file
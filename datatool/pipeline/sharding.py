@@ -0,0 +1,101 @@
+"""
+Helpers to process a large line-based file by several worker processes.
+
+split_file cuts the file into byte ranges on line boundaries, iter_lines reads the lines of one range
+exactly as iterating the file opened in text mode would, and tree_reduce merges the partial results of
+adjacent shards pairwise, level by level, in the pool.
+
+For work whose output follows the input line by line, iter_line_batches cuts the file into batches of
+consecutive lines and imap_bounded runs them in the pool, yielding the results in input order.
+
+Usage:
+    shards = split_file(corpus_path, 64)
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        parts = pool.starmap(process_shard, [(corpus_path, start, end) for start, end in shards])
+        result = tree_reduce(parts, merge_two, pool)
+"""
+import collections
+import io
+import os
+from typing import Callable, List, Tuple
+
+
+def split_file(path, num_shards) -> List[Tuple[int, int]]:
+    """ At most num_shards (start, end) byte ranges covering the file, each starting at a line start.
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as rf:
+        for k in range(1, num_shards):
+            pos = size * k // num_shards
+            if pos <= boundaries[-1]: continue
+            # 从 pos-1 读到行尾, 若 pos 恰为行首则停在 pos
+            rf.seek(pos - 1)
+            rf.readline()
+            boundary = rf.tell()
+            if boundary >= size: break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1) if boundaries[i] < boundaries[i + 1]]
+
+
+def iter_lines(path, start, end, encoding="utf-8"):
+    """ Lines of the byte range [start, end), decoded with universal newlines like open(path, "r").
+    """
+    with open(path, "rb") as rf:
+        rf.seek(start)
+        pos = start
+        while pos < end:
+            raw = rf.readline()
+            if len(raw) == 0: break
+            pos += len(raw)
+            line = raw.decode(encoding)
+            if "\r" in line:
+                # 与文本模式一致: "\r\n" 与单独的 "\r" 均视为换行
+                yield from io.StringIO(line, newline=None)
+            else:
+                yield line
+
+
+def tree_reduce(parts: list, merge: Callable, pool=None):
+    """ Merges adjacent parts pairwise until one is left, the order of parts is kept,
+    so merge only needs to be associative. Each level runs in the pool if one is given.
+    """
+    if len(parts) == 0:
+        raise ValueError("Nothing to reduce")
+    while len(parts) > 1:
+        pairs = [(parts[i], parts[i + 1]) for i in range(0, len(parts) - 1, 2)]
+        merged = pool.starmap(merge, pairs) if pool is not None else [merge(*pair) for pair in pairs]
+        if len(parts) % 2 == 1:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+
+def iter_line_batches(path, batch_size, encoding="utf-8"):
+    """ (first_line_no, lines) of every batch_size consecutive lines, line numbers starting from 1.
+    """
+    with open(path, "r", encoding=encoding) as rf:
+        batch, first_line_no = [], 1
+        for line in rf:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield first_line_no, batch
+                first_line_no += len(batch)
+                batch = []
+        if len(batch) > 0:
+            yield first_line_no, batch
+
+
+def imap_bounded(pool, func: Callable, iterable, max_pending):
+    """ Results of func over iterable in order, like pool.imap, but with at most max_pending items
+    dispatched and not yet consumed, so a large file is never read into the task queue as a whole.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while len(pending) > 0:
+        yield pending.popleft().get()
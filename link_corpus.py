@@ -0,0 +1,148 @@
+"""
+Links every document of a corpus by XLinkPredictor in a pool of forked worker processes.
+
+Input:  <instance_id>\t\t<document> per line, the standard corpus format produced by datatool.
+Output: <instance_id>\t\t<json list of [start, end, mention, entity_id, believe_score]> per line, in input order.
+
+The predictor is loaded once in the parent process before the pool is forked, so the workers inherit
+the models copy-on-write. Embeddings converted by main.convert_embeddings_to_npy and the prob_store
+written by main.generate_prob_files are memory-mapped, their pages are shared by all workers.
+
+Usage:
+    python link_corpus.py --source bd --corpus /data/zfw/xlink/bd/standard_abstract.txt \
+        --output /data/zfw/xlink/bd/linked_abstract.txt --workers 32
+"""
+import argparse
+import datetime
+import gc
+import json
+import multiprocessing
+import os
+import time
+from typing import List
+
+from config import Config
+from models import Mention
+from modules.VecModel import get_npy_paths
+from modules.prob_gm_predictors.xlink import XLinkPredictor
+
+predictor = None    # type: XLinkPredictor
+
+
+def load_predictor(source, data_path, shared=True, use_snapshot=True) -> XLinkPredictor:
+    """ XLinkPredictor on the files generated by main.py under data_path.
+
+    :param shared: False to build a new predictor by XLinkPredictor.create instead of the singleton,
+        as modules.ModelBundle.HotSwapPredictor does to hold the old and the new bundle at once.
+    :param use_snapshot: False to always load the source files, as main.save_predictor_snapshot does
+        to rebuild a snapshot that may be stale.
+
+    The snapshot written by main.save_predictor_snapshot is loaded instead of the source files when present.
+    """
+    snapshot_path = os.path.join(data_path, "snapshot")
+    if use_snapshot and os.path.exists(snapshot_path):
+        return XLinkPredictor.load_snapshot(snapshot_path, shared=shared)
+
+    def get_vec_path(vec_path):
+        npy_path, _ = get_npy_paths(vec_path)
+        return npy_path if os.path.exists(npy_path) else vec_path
+
+    merged_mention_trie_path = os.path.join(data_path, "mentions_merged.pytrie")
+    prob_store_path = os.path.join(data_path, "prob_store")
+    return (XLinkPredictor if shared else XLinkPredictor.create)(source,
+                          Config.get_entity_id_path(source),
+                          get_vec_path(os.path.join(data_path, "emb/result300/vectors_entity")),
+                          get_vec_path(os.path.join(data_path, "emb/result300/vectors_word")),
+                          os.path.join(data_path, "mention_anchors.txt"),
+                          os.path.join(data_path, "mention_anchors_prob.pytrie"),
+                          os.path.join(data_path, "title_entities.txt"),
+                          os.path.join(data_path, "title_entities.pytrie"),
+                          os.path.join(data_path, "entity_prior.json"),
+                          os.path.join(data_path, "prob_mention_entity.json"),
+                          os.path.join(data_path, "e_given_m.json"),
+                          os.path.join(data_path, "link_prob.json"),
+                          merged_mention_trie_path=merged_mention_trie_path if os.path.exists(merged_mention_trie_path) else None,
+                          prob_store_path=prob_store_path if os.path.exists(prob_store_path) else None)
+
+
+def format_result(instance_id, mentions: List[Mention]) -> str:
+    linked = [[m.start, m.end, m.label, m.result_cand.entity_id, m.believe_score] for m in mentions]
+    return "{}\t\t{}\n".format(instance_id, json.dumps(linked, ensure_ascii=False))
+
+
+def link_lines(lines: List[str]) -> List[str]:
+    """ Runs in the worker processes on the predictor inherited from the parent.
+    """
+    instance_ids, documents = [], []
+    for line in lines:
+        segs = line.rstrip("\n").split("\t\t", 1)
+        instance_ids.append(segs[0])
+        documents.append(segs[1] if len(segs) > 1 else "")
+    results = predictor.predict_batch(documents)
+    return [format_result(instance_id, mentions) for instance_id, mentions in zip(instance_ids, results)]
+
+
+def read_batches(corpus_path, batch_size):
+    with open(corpus_path, "r", encoding="utf-8") as rf:
+        batch = []
+        for line in rf:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+
+def link_corpus(corpus_path, output_path, workers=1, batch_size=32, mode_cnt=10000) -> int:
+    """ Links corpus_path to output_path by the global predictor, which should be loaded before calling.
+
+    :return: number of documents linked
+    """
+    print("\nLinking corpus: {}, workers: {}, target file path: \n\t{}".format(corpus_path, workers, output_path))
+    start_at = int(time.time())
+    last_update, counter = start_at, 0
+
+    pool = None
+    if workers > 1:
+        # 冻结已加载模型的对象, 避免 fork 后子进程的 gc 遍历触发写时复制
+        gc.freeze()
+        pool = multiprocessing.get_context("fork").Pool(workers)
+    try:
+        batches = read_batches(corpus_path, batch_size)
+        results = pool.imap(link_lines, batches) if pool is not None else map(link_lines, batches)
+        with open(output_path, "w", encoding="utf-8") as wf:
+            for output_lines in results:
+                wf.writelines(output_lines)
+                counter += len(output_lines)
+                if counter // mode_cnt != (counter - len(output_lines)) // mode_cnt:
+                    curr_update = int(time.time())
+                    print("{}, time: {}, total_time: {}, docs/sec: {:.1f}".format(
+                        counter,
+                        str(datetime.timedelta(seconds=curr_update - last_update)),
+                        str(datetime.timedelta(seconds=curr_update - start_at)),
+                        counter / max(curr_update - start_at, 1)))
+                    last_update = curr_update
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            gc.unfreeze()
+
+    print("Linked #{}, time: {}".format(counter, str(datetime.timedelta(seconds=int(time.time()) - start_at))))
+    return counter
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, default='bd')
+    parser.add_argument('--data_path', type=str, default=None)
+    parser.add_argument('--corpus', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=32)
+    args = parser.parse_args()
+
+    data_path = args.data_path or Config.get_file_full_path(args.source, "")
+    predictor = load_predictor(args.source, data_path)
+    link_corpus(args.corpus, args.output, args.workers, args.batch_size)
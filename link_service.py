@@ -0,0 +1,308 @@
+"""
+Async HTTP linking service around XLinkPredictor, built on asyncio only.
+
+Concurrent requests are coalesced into micro-batches of at most max_batch_size documents, waiting at most
+max_wait_ms for a batch to fill, and each batch is linked by predictor.predict_batch on a worker pool.
+A single batcher fills the batches and hands them to the pool, at most one batch per worker at a time,
+so requests arriving while every worker is busy are coalesced into the next batch.
+
+    POST /link      {"text": "..."}  ->  {"mentions": [{"start", "end", "mention", "entity_id", "believe_score"}, ...]}
+    GET  /health                     ->  {"status": "ok", "queued": n, "version": "...", "last_load_error": null}
+    POST /reload    {"path": "...", "version": "..."}  ->  {"status": "loading", "version": "..."}
+
+/reload is available when batch_predictor is a modules.ModelBundle.HotSwapPredictor: the bundle under path
+is loaded in the background and replaces the current one once loaded, requests keep being served meanwhile.
+
+A request waiting longer than request_timeout seconds gets 504, and a request arriving while
+max_queue_size documents are already queued gets 503 instead of queueing without bound.
+
+Usage:
+    python link_service.py --source bd --port 8080                          # one worker thread
+    python link_service.py --source bd --port 8080 --workers 4 --processes  # forked worker processes
+    python link_service.py --source bd --port 8080 --workers 4 --hot_swap   # threads, /reload enabled
+
+    # or with any object having predict_batch(documents) -> List[List[Mention]], e.g. a stub in tests
+    service = LinkingService(stub_predictor)
+    asyncio.run(service.serve("127.0.0.1", 8080))
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+from typing import List
+
+from models import Mention
+from modules.ModelBundle import HotSwapPredictor
+
+predictor = None    # type: object, the predictor inherited by forked workers
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+def format_mentions(mentions: List[Mention]) -> list:
+    return [{"start": m.start, "end": m.end, "mention": m.label,
+             "entity_id": m.result_cand.entity_id, "believe_score": m.believe_score} for m in mentions]
+
+
+def link_documents(documents: List[str], batch_predictor=None) -> List[list]:
+    """ Runs in the worker pool, on batch_predictor or on the global predictor inherited by forked workers.
+    """
+    results = (batch_predictor or predictor).predict_batch(documents)
+    return [format_mentions(mentions) for mentions in results]
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LinkingService:
+
+    def __init__(self, batch_predictor=None, max_batch_size=32, max_wait_ms=5, max_queue_size=1024,
+                 request_timeout=10.0, workers=1, use_processes=False, max_body_size=4 * 1024 * 1024):
+        """
+        :param batch_predictor: object with predict_batch(documents), e.g. XLinkPredictor or a stub.
+        :param use_processes: link batches in forked processes on the global predictor instead of in threads,
+            the global predictor is set to batch_predictor before forking.
+        """
+        if use_processes and isinstance(batch_predictor, HotSwapPredictor):
+            raise ValueError("A HotSwapPredictor swaps bundles in this process only, use threads with it")
+        self.predictor       = batch_predictor
+        self.max_batch_size  = max_batch_size
+        self.max_wait        = max_wait_ms / 1000
+        self.max_queue_size  = max_queue_size
+        self.request_timeout = request_timeout
+        self.workers         = workers
+        self.use_processes   = use_processes
+        self.max_body_size   = max_body_size
+
+        self.queue    = None  # type: asyncio.Queue
+        self.executor = None  # type: concurrent.futures.Executor
+        self._free_workers = None   # type: asyncio.Semaphore
+        self._batcher = None        # type: asyncio.Future
+        self._linking = set()       # batches handed to the pool and not linked yet
+
+    async def start(self):
+        global predictor
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        if self.use_processes:
+            predictor = self.predictor
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("fork"))
+            # fork the workers now, before any client socket exists which they would inherit and keep open
+            await asyncio.get_event_loop().run_in_executor(self.executor, os.getpid)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._free_workers = asyncio.Semaphore(self.workers)
+        self._batcher = asyncio.ensure_future(self._run_batcher())
+
+    async def stop(self):
+        self._batcher.cancel()
+        await asyncio.gather(self._batcher, *self._linking, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+    async def link(self, document: str) -> list:
+        """ Linked mentions of one document, raises HttpError 503 when the queue is full and 504 on timeout.
+        """
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self.queue.put_nowait((document, future))
+        except asyncio.QueueFull:
+            raise HttpError(503, "Too many queued requests")
+        try:
+            return await asyncio.wait_for(future, self.request_timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(504, "Linking timed out after {}s".format(self.request_timeout))
+
+    async def _run_batcher(self):
+        while True:
+            # a batch is only started once a worker is free, until then the queued requests keep coalescing
+            await self._free_workers.acquire()
+            try:
+                batch = await self._next_batch()
+            except BaseException:
+                self._free_workers.release()
+                raise
+            task = asyncio.ensure_future(self._link_batch(batch))
+            self._linking.add(task)
+            task.add_done_callback(self._linking.discard)
+
+    async def _next_batch(self) -> list:
+        """ The queued requests, at most max_batch_size of them, waiting at most max_wait for more after the first.
+        """
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0: break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _link_batch(self, batch):
+        """ Links the batch on a worker, then frees the worker for the next batch.
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            # requests which already timed out are not linked
+            batch = [(document, future) for document, future in batch if not future.done()]
+            if len(batch) == 0: return
+            documents = [document for document, _ in batch]
+            try:
+                if self.use_processes:
+                    results = await loop.run_in_executor(self.executor, link_documents, documents)
+                else:
+                    results = await loop.run_in_executor(self.executor, link_documents, documents, self.predictor)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done(): future.set_exception(e)
+                return
+            for (_, future), result in zip(batch, results):
+                if not future.done(): future.set_result(result)
+        finally:
+            self._free_workers.release()
+
+    async def handle_request(self, method: str, path: str, body: bytes):
+        """ :return: (status, json-able response)
+        """
+        if path == "/health":
+            response = {"status": "ok", "queued": self.queue.qsize()}
+            if isinstance(self.predictor, HotSwapPredictor):
+                response["version"] = self.predictor.version
+                response["last_load_error"] = self.predictor.last_load_error
+            return 200, response
+        if path == "/reload":
+            return self.reload(method, body)
+        if path != "/link":
+            raise HttpError(404, "Unknown path: {}".format(path))
+        if method != "POST":
+            raise HttpError(405, "Use POST for /link")
+        try:
+            document = json.loads(body.decode("utf-8"))["text"]
+        except (ValueError, KeyError, TypeError):
+            raise HttpError(400, 'Body should be a json object like {"text": "..."}')
+        if not isinstance(document, str):
+            raise HttpError(400, '"text" should be a string')
+        return 200, {"mentions": await self.link(document)}
+
+    def reload(self, method: str, body: bytes):
+        if not isinstance(self.predictor, HotSwapPredictor):
+            raise HttpError(404, "Reloading needs a HotSwapPredictor")
+        if method != "POST":
+            raise HttpError(405, "Use POST for /reload")
+        try:
+            request = json.loads(body.decode("utf-8"))
+            bundle_path, version = request["path"], request.get("version")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise HttpError(400, 'Body should be a json object like {"path": "...", "version": "..."}')
+        if not isinstance(bundle_path, str) or not os.path.isdir(bundle_path):
+            raise HttpError(400, "Not a bundle directory: {}".format(bundle_path))
+        try:
+            loading = self.predictor.load_async(bundle_path, version)
+        except RuntimeError as e:
+            raise HttpError(409, str(e))
+        return 200, {"status": "loading", "version": loading.name, "current_version": self.predictor.version}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                request_line = lines[0].split(" ")
+                headers = dict()
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                try:
+                    if len(request_line) != 3:
+                        raise HttpError(400, "Malformed request line")
+                    method, path, _ = request_line
+                    try:
+                        content_length = int(headers.get("content-length", 0))
+                    except ValueError:
+                        keep_alive = False
+                        raise HttpError(400, "Invalid Content-Length")
+                    if content_length > self.max_body_size:
+                        keep_alive = False
+                        raise HttpError(413, "Body larger than {} bytes".format(self.max_body_size))
+                    body = await reader.readexactly(content_length) if content_length > 0 else b""
+                    status, response = await self.handle_request(method, path.split("?", 1)[0], body)
+                except HttpError as e:
+                    status, response = e.status, {"error": str(e)}
+                except Exception as e:
+                    status, response = 500, {"error": "Linking failed: {}".format(e)}
+
+                payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                             "Content-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                    status, HTTP_REASONS.get(status, ""), len(payload), "keep-alive" if keep_alive else "close"
+                ).encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive: break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="0.0.0.0", port=8080):
+        await self.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print("Serving on {}:{}, max_batch_size: {}, max_wait_ms: {}, workers: {}".format(
+            host, port, self.max_batch_size, int(self.max_wait * 1000), self.workers))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+if __name__ == "__main__":
+    from config import Config
+    from link_corpus import load_predictor
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, default='bd')
+    parser.add_argument('--data_path', type=str, default=None)
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=int, default=5)
+    parser.add_argument('--max_queue_size', type=int, default=1024)
+    parser.add_argument('--request_timeout', type=float, default=10.0)
+    parser.add_argument('--processes', action='store_true', help='link in forked processes instead of threads')
+    parser.add_argument('--hot_swap', action='store_true', help='enable POST /reload, links in threads')
+    args = parser.parse_args()
+    if args.processes and args.hot_swap:
+        parser.error("--hot_swap links in threads, it cannot be used with --processes")
+
+    data_path = args.data_path or Config.get_file_full_path(args.source, "")
+    if args.hot_swap:
+        batch_predictor = HotSwapPredictor(lambda bundle_path: load_predictor(args.source, bundle_path, shared=False))
+        batch_predictor.load(data_path)
+    else:
+        batch_predictor = load_predictor(args.source, data_path)
+    service = LinkingService(batch_predictor,
+                             max_batch_size=args.max_batch_size,
+                             max_wait_ms=args.max_wait_ms,
+                             max_queue_size=args.max_queue_size,
+                             request_timeout=args.request_timeout,
+                             workers=args.workers,
+                             use_processes=args.processes)
+    asyncio.run(service.serve(args.host, args.port))
@@ -10,7 +10,7 @@ def generate_standard_entity_dict(source, old_entity_path, entity_ttl_path, stan
     standard_id2title = prep_input.get_id2title_from_ttl(source, entity_ttl_path)
     prep_input.generate_standard_entity_id(standard_entity_path, old_entity_holder, standard_id2title)
 
-def generate_standard_corpus(source, data_path, corpus_name, mark_titles=False) -> None:
+def generate_standard_corpus(source, data_path, corpus_name, mark_titles=False, workers=1) -> None:
     import os, imp
 
     if (source == 'bd'):
@@ -26,10 +26,10 @@ def generate_standard_corpus(source, data_path, corpus_name, mark_titles=False)
         prep_input.infobox_pre_refine(source, raw_corpus_path,
             os.path.join(data_path, "pre_raw_{}.txt".format(corpus_name)))
         # prep_input.corpus_refine(source, os.path.join(data_path, "pre_raw_{}.txt".format(corpus_name)), refined_corpus_path)
-        prep_input.corpus_full_refine(source, os.path.join(data_path, "pre_raw_{}.txt".format(corpus_name)), standard_corpus_path, mark_titles)
+        prep_input.corpus_full_refine(source, os.path.join(data_path, "pre_raw_{}.txt".format(corpus_name)), standard_corpus_path, mark_titles, workers)
     else:    
         # prep_input.corpus_refine(source, raw_corpus_path, refined_corpus_path)
-        prep_input.corpus_full_refine(source, raw_corpus_path, standard_corpus_path, mark_titles)
+        prep_input.corpus_full_refine(source, raw_corpus_path, standard_corpus_path, mark_titles, workers)
     # prep_input.corpus_annotation_refine(source, refined_corpus_path, standard_corpus_path)
 
 def statistics_about_mention_anchors_and_out_links(mention_anchors: dict, out_links: dict) -> None:
@@ -48,13 +48,14 @@ def statistics_about_mention_anchors_and_out_links(mention_anchors: dict, out_li
     print("\tcandidate>1: #{}".format(tools.cal_mention_bigger(mention_anchors, 1)))
     print("\tcandidate>2: #{}".format(tools.cal_mention_bigger(mention_anchors, 2)))
 
-def generate_mention_anchors_and_out_links(data_path: str, corpus_name: str) -> tuple:
+def generate_mention_anchors_and_out_links(data_path: str, corpus_name: str, workers=1) -> tuple:
     import os, json
     import time, datetime
     from datatool.pipeline import extract_mention_anchors
     standard_corpus_path = os.path.join(data_path, "standard_{}.txt".format(corpus_name))
     # mention_anchors, out_links = extract_mention_anchors.extract_mention_and_out_links_from_corpus(standard_corpus_path)
-    mention_anchors, out_links, self_links = extract_mention_anchors.extract_mention_and_out_links_from_corpus(standard_corpus_path)
+    mention_anchors, out_links, self_links = extract_mention_anchors.extract_mention_and_out_links_from_corpus(
+        standard_corpus_path, workers)
 
     mention_anchors_json_path   = os.path.join(data_path, "mention_anchors_{}.json".format(corpus_name))
     out_links_json_path         = os.path.join(data_path, "out_links_{}.json".format(corpus_name))
@@ -142,7 +143,7 @@ def init_JVM():
     return JDClass
 
 # def calculate_freq_m(data_path, corpus_name, JDClass) -> dict:
-def calculate_freq_m(data_path, corpus_name) -> dict:
+def calculate_freq_m(data_path, corpus_name, workers=1) -> dict:
     import os, json
     from datatool.pipeline import generate_prob_files
 
@@ -155,10 +156,22 @@ def calculate_freq_m(data_path, corpus_name) -> dict:
 
     # freq_m = generate_prob_files.cal_freq_m(standard_corpus_path, mention_anchors_txt_path, mention_anchors_trie_path,
     #                                         JDClass)
-    freq_m = generate_prob_files.cal_freq_m(standard_corpus_path, mention_anchors_txt_path)
+    freq_m = generate_prob_files.cal_freq_m(standard_corpus_path, mention_anchors_txt_path, workers)
     json.dump(freq_m, open(os.path.join(data_path, "freq_m_{}.json".format(corpus_name)), "w", encoding="utf-8"))
     return freq_m
 
+def update_mention_anchors_and_out_links(data_path, corpus_list) -> dict:
+    from datatool.pipeline import incremental
+    return incremental.update_mention_anchors_and_out_links(data_path, corpus_list)
+
+def update_freq_m(data_path, corpus_list, deltas, workers=1) -> None:
+    from datatool.pipeline import incremental
+    incremental.update_freq_m(data_path, corpus_list, deltas, workers)
+
+def save_incremental_state(data_path, corpus_list, deltas=None) -> None:
+    from datatool.pipeline import incremental
+    incremental.save_state(data_path, corpus_list, deltas)
+
 def merge_freq_m(data_path, corpus_list, is_save=False) -> dict:
     from datatool.pipeline import generate_prob_files
     import os, json
@@ -224,7 +237,7 @@ def filter_mention_anchors_by_len_and_prob(
     print("\nFiltered, time: {}".format(str(datetime.timedelta(seconds=int(time.time())-start_at))))
     return ma
 
-def generate_mention_anchors_trie(data_path) -> None:
+def generate_mention_anchors_trie(data_path, max_candidates=None, cum_prob_th=None) -> None:
     import os, json, imp, time, datetime
     from datatool.pipeline import generate_trie_dict
     imp.reload(generate_trie_dict)
@@ -234,7 +247,8 @@ def generate_mention_anchors_trie(data_path) -> None:
     print("Generating mention_anchors.txt for building trie tree.\n\tdata_from: {}\n\tsaved_to: {}".format(
         mention_anchors_json_path, mention_anchors_txt_path))
     mention_anchors = json.load(open(mention_anchors_json_path, "r", encoding="utf-8"))
-    generate_trie_dict.generate_mention_anchors_txt_for_trie(mention_anchors, mention_anchors_txt_path)
+    generate_trie_dict.generate_mention_anchors_txt_for_trie(mention_anchors, mention_anchors_txt_path,
+                                                            max_candidates, cum_prob_th)
     print("Generated. Time: {}".format(str(datetime.timedelta(seconds=int(time.time())-start_at))))
 
     if (os.path.exists(os.path.join(data_path, "mention_anchors.trie"))):
@@ -251,7 +265,7 @@ def generate_vocab_word_for_trie(data_path):
     generate_trie_dict.generate_vocab_word_for_trie(vocab_word_path, vocab_word_txt_path)
     print("\nVocab word txt file is saved to: {}".format(vocab_word_txt_path))
 
-def generate_input_for_tries(data_path) -> None:
+def generate_input_for_tries(data_path, max_candidates=None, cum_prob_th=None) -> None:
     import os, json
     from datatool.pipeline import generate_trie_dict
 
@@ -263,7 +277,8 @@ def generate_input_for_tries(data_path) -> None:
     mention_anchors_txt_path = os.path.join(data_path, "mention_anchors.txt")
     title_entities_txt_path  = os.path.join(data_path, "title_entities.txt")
 
-    generate_trie_dict.generate_mention_anchors_txt_for_trie(mention_anchors, mention_anchors_txt_path)
+    generate_trie_dict.generate_mention_anchors_txt_for_trie(mention_anchors, mention_anchors_txt_path,
+                                                            max_candidates, cum_prob_th)
     generate_trie_dict.generate_title_entities_txt_for_trie(title_entities, title_entities_txt_path)
 
 def generate_emb_train_kg(data_path) -> None:
@@ -274,14 +289,14 @@ def generate_emb_train_kg(data_path) -> None:
     out_links = json.load(open(os.path.join(data_path, "out_links.json"), "r", encoding="utf-8"))
     extract_embedding_train.generate_train_kg_from_out_links(out_links, train_kg_path)
 
-def generate_emb_train_text(source, data_path, corpus_name) -> None:
+def generate_emb_train_text(source, data_path, corpus_name, workers=1) -> None:
     import os
     from datatool.pipeline import extract_embedding_train
 
     train_text_path = os.path.join(data_path, "emb/train_text_{}.txt".format(corpus_name))
     standard_corpus_path = os.path.join(data_path, "standard_{}.txt".format(corpus_name))
     if source == "bd":
-        extract_embedding_train.extract_bd_corpus(standard_corpus_path, train_text_path)
+        extract_embedding_train.extract_bd_corpus(standard_corpus_path, train_text_path, workers)
     elif source == "wiki":
         # TODO: 没验证过
         extract_embedding_train.extract_wiki_corpus(standard_corpus_path, train_text_path)
@@ -305,7 +320,7 @@ def filter_mention_anchor_by_entity_emb(source, mention_anchors, entity_dict_pat
             del mas[m]
     return mas
 
-def generate_prob_files(data_path) -> None:
+def generate_prob_files(data_path, max_candidates=None, cum_prob_th=None) -> None:
     import os, json, time, datetime
     from datatool.pipeline import generate_prob_files
 
@@ -313,6 +328,8 @@ def generate_prob_files(data_path) -> None:
     mention_anchors = json.load(open(os.path.join(data_path, "mention_anchors.json"), encoding="utf-8"))
     entity_prior, m_given_e, e_given_m, mention_link = generate_prob_files.cal_4_prob_from_mention_anchors(
         mention_anchors)
+    # 与 mention_anchors.txt 一致地裁剪每个 mention 的候选实体, p(e|m) 仍按全部 anchor 计算
+    e_given_m = generate_prob_files.prune_e_given_m(e_given_m, max_candidates, cum_prob_th)
 
     entity_prior_path = os.path.join(data_path, "entity_prior.dat")
     entity_prior_json_path = os.path.join(data_path, "entity_prior.json")
@@ -327,13 +344,23 @@ def generate_prob_files(data_path) -> None:
     for m in e_given_m: link_prob[m] = float(mention_link[m])/freq_m[m]
     json.dump(link_prob, open(link_prob_json_path, "w", encoding="utf-8"))
 
+    # ProbHolder 从 json 加载 p(e|m), 与 link_prob.dat 一样是裁剪后的候选实体
+    e_given_m_json_path = os.path.join(data_path, "e_given_m.json")
+    json.dump(e_given_m, open(e_given_m_json_path, "w", encoding="utf-8"))
+
     prob_mention_entity_path = os.path.join(data_path, "prob_mention_entity.dat")
     prob_mention_entity_json_path = os.path.join(data_path, "prob_mention_entity.json")
     generate_prob_files.generate_prob_mention_entity_file(m_given_e, prob_mention_entity_path,
                                                           prob_mention_entity_json_path)
-    print("Four prob files generated, time: {}, saved to: \n\t{}\n\t{}\n\t{}\n\t{}".format(
+
+    # 供 CompactProbHolder 内存映射的紧凑格式
+    from modules.ProbHolder import save_compact_prob_store
+    prob_store_path = os.path.join(data_path, "prob_store")
+    save_compact_prob_store(prob_store_path, entity_prior, m_given_e, e_given_m, link_prob)
+    print("Four prob files generated, time: {}, saved to: \n\t{}\n\t{}\n\t{}\n\t{}\n\t{}\n\t{}".format(
         str(datetime.timedelta(seconds=int(time.time()) - start_at)),
-        entity_prior_path, link_prob_path, prob_mention_entity_path, link_prob_json_path))
+        entity_prior_path, link_prob_path, prob_mention_entity_path, link_prob_json_path, e_given_m_json_path,
+        prob_store_path))
 
 def filter_title_entities(source, data_path):
     import json, os, imp
@@ -387,8 +414,15 @@ def train_embeddings(data_path, corpus_list, source, merge=True, train=True, mov
                                                                  out_path='%s/emb/result300/vectors_abstract' %data_path)
 
 
+def convert_embeddings_to_npy(data_path):
+    from modules.VecModel import convert_to_npy
+    for vec_name in ["vectors_entity", "vectors_word"]:
+        convert_to_npy(os.path.join(data_path, "emb/result300/{}".format(vec_name)))
+
+
 def generate_tries(data_path):
     from datatool.pipeline import generate_tries
+    from modules.ProbHolder import CompactProbHolder
     title_entity_txt_path = os.path.join(data_path, "title_entities.txt")
     title_entity_trie_path = os.path.join(data_path, "title_entities.pytrie")
     generate_tries.build_trie(title_entity_txt_path, title_entity_trie_path)
@@ -397,16 +431,36 @@ def generate_tries(data_path):
     mention_trie_path = os.path.join(data_path, "mention_anchors.pytrie")
     generate_tries.build_trie(mention_txt_path, mention_trie_path)
 
+    # 带 link_prob 和 p(e|m) 的 mention_anchors 字典树, 预测时无需再查 ProbHolder
+    prob_holder = CompactProbHolder(os.path.join(data_path, "prob_store"))
+    mention_prob_trie_path = os.path.join(data_path, "mention_anchors_prob.pytrie")
+    generate_tries.build_prob_trie(mention_txt_path, mention_prob_trie_path, prob_holder)
+
+    merged_trie_path = os.path.join(data_path, "mentions_merged.pytrie")
+    generate_tries.build_merged_trie([("ma", 100, mention_txt_path), ("tt", 0, title_entity_txt_path)], merged_trie_path,
+                                     prob_holders={"ma": prob_holder})
+
     vocab_txt_path = os.path.join(data_path, "vocab_word.txt")
     vocab_trie_path = os.path.join(data_path, "vocab_word.pytrie")
     generate_tries.build_trie(vocab_txt_path, vocab_trie_path)
 
 
+def save_predictor_snapshot(source, data_path):
+    from link_corpus import load_predictor
+    # 从源文件重新加载, 旧的 snapshot 可能已过期
+    load_predictor(source, data_path, use_snapshot=False).save_snapshot(os.path.join(data_path, "snapshot"))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--source', type=str, default='bd')
+    parser.add_argument('--workers', type=int, default=1)
+    # 只按变化的文档更新第二步和第四步的统计结果, 需要之前全量运行过一次
+    parser.add_argument('--incremental', action='store_true')
     args = parser.parse_args()
     source = args.source
+    workers = args.workers
+    incremental = args.incremental
     data_path = '/data/zfw/xlink/%s/' %(source)
     corpus_list = ["abstract", "article", "infobox"]
 
@@ -417,18 +471,23 @@ if __name__ == "__main__":
     # old_entity_path         = data_path + "old_entity_id.txt"
     # generate_standard_entity_dict(source, old_entity_path, ttl_path, standard_entity_id_path)
     for c in corpus_list:
-        generate_standard_corpus(source, data_path, c, True)
+        generate_standard_corpus(source, data_path, c, True, workers)
     
 
     # 第二步
     # 2.1 抽取 mention_anchors 和 out_links
-    for c in corpus_list:
-        _m, _o = generate_mention_anchors_and_out_links(data_path, c)
+    deltas = None
+    if incremental:
+        deltas = update_mention_anchors_and_out_links(data_path, corpus_list)
+    else:
+        for c in corpus_list:
+            _m, _o = generate_mention_anchors_and_out_links(data_path, c, workers)
     _, __ = merge_multiple_mention_anchors(data_path, corpus_list, is_save=True)
 
-    # 2.2 由 standard_corpus 生成 train_text
-    for c in corpus_list:
-        generate_emb_train_text(source, data_path, c) # 中文 30h，英文很快
+    # 2.2 由 standard_corpus 生成 train_text, 增量更新时 embedding 不重新训练, 跳过
+    if not incremental:
+        for c in corpus_list:
+            generate_emb_train_text(source, data_path, c, workers) # 中文单进程 30h，英文很快
     
     # 第三步
     # 3.1 生成 mention_anchors.trie 来计算 freq(m)
@@ -439,15 +498,22 @@ if __name__ == "__main__":
     
     # 第四步
     # 4.1 全文统计 freq(m)
-    for c in corpus_list: 
-        _fm = calculate_freq_m(data_path, c)
+    if incremental:
+        update_freq_m(data_path, corpus_list, deltas, workers)
+    else:
+        for c in corpus_list: 
+            _fm = calculate_freq_m(data_path, c, workers)
     
     freq_m = merge_freq_m(data_path, corpus_list, is_save=True)
+    # 保存文档 (增量运行时只追加变化的文档), 文档指纹和各语料的统计结果, 作为下次 --incremental 的基准
+    save_incremental_state(data_path, corpus_list, deltas)
     
     # 4.2
     # TrainJointModel 训练 Embedding.
     # train_embeddings(data_path, corpus_list, source, merge=True, train=True, move=True)
     train_embeddings(data_path, corpus_list, source, merge=False, train=False, move=False)
+    # 4.3 把词向量和实体向量转换为 .npy 矩阵和词表索引，供 predictor 以 mmap 方式加载
+    convert_embeddings_to_npy(data_path)
     
     
     # 第五步
@@ -469,14 +535,19 @@ if __name__ == "__main__":
     # 7.1 生成 title_entities.txt 和 mention_anchors.txt
     #       - mention_anchors.txt
     #       - title_entities.txt
-    generate_input_for_tries(data_path)
+    # max_candidates / cum_prob_th: 每个 mention 保留的候选实体数以及累计 p(e|m) 阈值, None 表示不裁剪
+    max_candidates, cum_prob_th = None, None
+    generate_input_for_tries(data_path, max_candidates, cum_prob_th)
 
     # 7.2 & 8 生成三个概率文件
     #     - baidu_entity_prior.dat        entity::;prior
     #     - prob_mention_entity.dat       entity::;mention::;prob
     #     - link_prob.dat                 mention::;entity_id::;link(a)::;freq(a)::;link_prob::;p(e|m)
-    generate_prob_files(data_path)
+    generate_prob_files(data_path, max_candidates, cum_prob_th)
 
     # 9 生成各个字典树
     generate_tries(data_path)
+
+    # 10 保存已加载模型的快照 snapshot/, 之后启动 predictor 只需数秒
+    save_predictor_snapshot(source, data_path)
     
\ No newline at end of file
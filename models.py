@@ -26,19 +26,66 @@ class Entity:
         return self.full_title
 
 
+class EntityView:
+    """ Entity created on demand from a row of modules.EntityManager.EntityDictionary,
+    with the attributes and methods of Entity but no __dict__.
+    """
+    __slots__ = ("row", "ID", "full_title", "title", "sub_title", "source", "language", "embed")
+
+    def __init__(self, row, entity_id, title, sub_title, source, language, embed=None):
+        self.row = row
+        self.ID = entity_id
+        self.full_title = title + sub_title
+        self.title = title
+        self.sub_title = sub_title
+        self.source = source
+        self.language = language
+        self.embed = embed
+
+    def set_embed(self, embed: List[float]):
+        self.embed = embed
+
+    def get_full_title(self):
+        return self.full_title
+
+
 class Candidate:
     entity_id = None            # type: str
-    entity    = None            # type: Entity
+    entity_row = None           # type: int
     context_words_sim = None    # type: float
     context_entities_sim = None # type: float
     e_given_m = None            # type: float
 
     believe_score = None        # type: float
 
+    _entity = None              # type: Entity
+    _entity_dictionary = None   # type: object, modules.EntityManager.EntityDictionary
+
     def __init__(self, entity_id, entity_title=""):
         self.entity_id = entity_id
         self.entity_title = entity_title
 
+    @property
+    def entity(self):
+        """ The Entity set by set_entity, or created from the entity dictionary on first access.
+        """
+        if self._entity is None and self._entity_dictionary is not None:
+            if self.entity_row is None:
+                self.entity_row = self._entity_dictionary.get_row(self.entity_id)
+            if self.entity_row >= 0:
+                self._entity = self._entity_dictionary.get_entity(self.entity_row)
+            self._entity_dictionary = None
+        return self._entity
+
+    def set_entity_dictionary(self, entity_dictionary, entity_row=None):
+        """ Defers looking up the entity until .entity is read, only the returned results usually are.
+
+        :param entity_row: the row of entity_id if already looked up, -1 if it is absent.
+        """
+        self._entity = None
+        self._entity_dictionary = entity_dictionary
+        self.entity_row = entity_row
+
     def set_context_words_sim(self, similarity: float):
         self.context_words_sim = similarity
 
@@ -49,7 +96,8 @@ class Candidate:
         self.e_given_m = prob
 
     def set_entity(self, entity: Entity):
-        self.entity = entity
+        self._entity = entity
+        self._entity_dictionary = None
 
     def set_believe_score(self, score: float):
         self.believe_score = score
@@ -69,6 +117,7 @@ class Mention:
     gold_entity = None      # type: Entity
 
     believe_score = None    # type: float
+    link_prob = None        # type: float
 
     parse_from = None       # type: str
 
@@ -102,6 +151,9 @@ class Mention:
     def set_believe_score(self, score: float):
         self.believe_score = score
 
+    def set_link_prob(self, prob: float):
+        self.link_prob = prob
+
     def __str__(self):
         return "{}, {}, {}, {}".format(self.start, self.end, self.label, "::=".join([cand.entity_id for cand in self.candidates]))
 
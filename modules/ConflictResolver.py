@@ -0,0 +1,132 @@
+"""
+ConflictResolver keeps non-overlapping matches out of overlapping ones.
+
+Input: raw matches as (start, end, weight, payload) tuples, e.g. straight from an automaton.
+Output: the surviving tuples, ordered by start.
+
+Usage:
+    resolver = ConflictResolver(LONGEST_MATCH)
+    survivors = resolver.resolve(matches, ordered_by_end=True)
+"""
+import bisect
+from typing import List, Tuple
+
+LONGEST_MATCH    = "longest"            # the longest match of each overlapping cluster
+HIGHEST_WEIGHT   = "highest_weight"     # matches by weight, then length, each kept unless it overlaps a kept one
+LEFTMOST_LONGEST = "leftmost_longest"   # the leftmost match, the longest if several start there, and so on
+
+POLICIES = (LONGEST_MATCH, HIGHEST_WEIGHT, LEFTMOST_LONGEST)
+
+Match = Tuple[int, int, float, object]
+
+
+class ConflictResolver:
+    """ Resolves overlapping matches by one of LONGEST_MATCH, HIGHEST_WEIGHT and LEFTMOST_LONGEST.
+
+    Matches ordered by end offset, which is how pyahocorasick reports them, are grouped into
+    clusters of transitively overlapping matches by a stack in O(n) without sorting. Ties are
+    broken by the leftmost start, then by the input order.
+
+    HIGHEST_WEIGHT does not keep one match per cluster, a low weight match bridging two
+    non-overlapping heavier ones must not drop either of them. It picks matches greedily by
+    weight, then length, in O(n log n).
+    """
+
+    def __init__(self, policy: str = LONGEST_MATCH):
+        if policy not in POLICIES:
+            raise ValueError("Unknown conflict policy: {}, expected one of {}".format(policy, POLICIES))
+        self.policy = policy
+
+    def resolve(self, matches: List[Match], ordered_by_end: bool = False) -> List[Match]:
+        if self.policy == HIGHEST_WEIGHT:
+            return self._highest_weight(matches)
+        if self.policy == LEFTMOST_LONGEST:
+            result = []
+            for members in self.clusters(matches, ordered_by_end):
+                result.extend(self._leftmost_longest(members))
+            return result
+
+        # stack of [start, end, best_match], clusters are disjoint and ordered by end
+        stack = []
+        for match in (matches if ordered_by_end else sorted(matches, key=lambda m: m[1])):
+            start, best = match[0], match
+            while len(stack) > 0 and match[0] < stack[-1][1]:
+                cluster = stack.pop()
+                start = min(start, cluster[0])
+                if not self._is_better(best, cluster[2]):
+                    best = cluster[2]
+            stack.append([start, match[1], best])
+        return [cluster[2] for cluster in stack]
+
+    def clusters(self, matches: List[Match], ordered_by_end: bool = False) -> List[List[Match]]:
+        """ Clusters of transitively overlapping matches, members of each cluster ordered by start.
+        """
+        stack = []
+        for match in (matches if ordered_by_end else sorted(matches, key=lambda m: m[1])):
+            start, members = match[0], [match]
+            while len(stack) > 0 and match[0] < stack[-1][1]:
+                cluster = stack.pop()
+                start = min(start, cluster[0])
+                cluster[2].extend(members)
+                members = cluster[2]
+            stack.append([start, match[1], members])
+        return [sorted(cluster[2], key=lambda m: m[0]) for cluster in stack]
+
+    def _is_better(self, a: Match, b: Match) -> bool:
+        """ Whether a wins over b, b being earlier in the input.
+        """
+        if a[1] - a[0] != b[1] - b[0]:
+            return a[1] - a[0] > b[1] - b[0]
+        return a[0] < b[0]
+
+    @staticmethod
+    def _highest_weight(matches: List[Match]) -> List[Match]:
+        order = sorted(range(len(matches)), key=lambda i: (
+            -matches[i][2], matches[i][0] - matches[i][1], matches[i][0], i))
+        # kept matches never overlap each other, so the only one a match may overlap is the kept match
+        # starting last before its end. That one is found by a Fenwick tree counting the kept matches
+        # over the distinct starts, in O(log n) instead of inserting into a sorted list.
+        starts = sorted(set(match[0] for match in matches))
+        size = len(starts)
+        tree = [0] * (size + 1)
+        kept_ends = [None] * size   # end of the kept match at each distinct start
+        top = 1 << size.bit_length()
+        kept = []
+        for i in order:
+            match = matches[i]
+            count, j = 0, bisect.bisect_left(starts, match[1])
+            while j > 0:
+                count += tree[j]
+                j -= j & -j
+            if count > 0:
+                # the count-th kept start is the last one before the match's end
+                pos, step = 0, top
+                while step > 0:
+                    if pos + step <= size and tree[pos + step] < count:
+                        pos += step
+                        count -= tree[pos]
+                    step >>= 1
+                if kept_ends[pos] > match[0]: continue
+
+            idx = bisect.bisect_left(starts, match[0])
+            if kept_ends[idx] is None:
+                j = idx + 1
+                while j <= size:
+                    tree[j] += 1
+                    j += j & -j
+                kept_ends[idx] = match[1]
+            else:
+                kept_ends[idx] = max(kept_ends[idx], match[1])
+            kept.append(match)
+        kept.sort(key=lambda m: (m[0], m[1]))
+        return kept
+
+    @staticmethod
+    def _leftmost_longest(members: List[Match]) -> List[Match]:
+        result = []
+        end = None
+        for match in sorted(members, key=lambda m: (m[0], m[0] - m[1])):
+            if end is None or match[0] >= end:
+                result.append(match)
+                end = match[1]
+        return result
@@ -0,0 +1,86 @@
+""" DocumentContext tokenizes a document once and answers the context window of every mention.
+
+The document is parsed by WordParser.tokenize a single time, words without embeddings are
+dropped once, and the context words of any [start, end) character window are found by
+bisecting the token offsets instead of re-parsing document slices for every mention.
+
+The embedding sum of any window comes from a prefix-sum matrix over the words' embeddings,
+so a mention's context centroid costs two row subtractions whatever the window size.
+
+Example Usage:
+
+    context = DocumentContext(document, word_parser, word_manager)
+    prev_context, after_context = context.get_context_words(mention.start, mention.end, window)
+    context_embed = context.get_context_embed(mention.start, mention.end, window)
+"""
+import bisect
+from typing import List, Tuple
+
+import numpy
+
+from modules import WordManager, WordParser
+from modules.VecModel import normalize
+
+
+class DocumentContext:
+    document = None     # type: str
+    words = None        # type: List[str]
+    starts = None       # type: List[int]
+    ends = None         # type: List[int]
+
+    def __init__(self, document: str, word_parser: WordParser.WordParser, word_manager: WordManager.WordManager):
+        self.document = document
+        self.words, self.starts, self.ends = [], [], []
+        self.vec_model = word_manager.vec_model
+        self._prefix_sum = None     # type: numpy.ndarray
+
+        vectors = self.vec_model.vectors
+        for word, start, end in word_parser.tokenize(document):
+            if word in vectors:
+                self.words.append(word)
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def get_window_range(self, start: int, end: int) -> Tuple[int, int]:
+        """ [lo, hi) indices of the words lying entirely in document[start: end].
+        """
+        lo = bisect.bisect_left(self.starts, start)
+        hi = bisect.bisect_right(self.ends, end)
+        return lo, max(lo, hi)
+
+    def get_window_words(self, start: int, end: int) -> List[str]:
+        lo, hi = self.get_window_range(start, end)
+        return self.words[lo: hi]
+
+    def get_context_words(self, mention_start: int, mention_end: int, window: int) -> Tuple[List[str], List[str]]:
+        """ Words with embeddings in the `window` characters before and after the mention.
+        """
+        prev_start = max(0, mention_start - window)
+        after_end = min(len(self.document), mention_end + window)
+        return self.get_window_words(prev_start, mention_start), self.get_window_words(mention_end, after_end)
+
+    @property
+    def prefix_sum(self) -> numpy.ndarray:
+        """ (len(words)+1, dim) float64 matrix, row i is the embedding sum of words[:i].
+        """
+        if self._prefix_sum is None:
+            prefix_sum = numpy.zeros((len(self.words) + 1, self.vec_model.vec_size), dtype=numpy.float64)
+            if len(self.words) > 0:
+                numpy.cumsum(self.vec_model.matrix[self.vec_model.get_rows(self.words)], axis=0,
+                             dtype=numpy.float64, out=prefix_sum[1:])
+            self._prefix_sum = prefix_sum
+        return self._prefix_sum
+
+    def get_window_sum(self, start: int, end: int) -> Tuple[numpy.ndarray, int]:
+        """ Embedding sum and number of the words lying entirely in document[start: end].
+        """
+        lo, hi = self.get_window_range(start, end)
+        return self.prefix_sum[hi] - self.prefix_sum[lo], hi - lo
+
+    def get_context_embed(self, mention_start: int, mention_end: int, window: int):
+        """ Normalized centroid of the mention's prev and after context words, None if there is none.
+        """
+        prev_sum, prev_num = self.get_window_sum(max(0, mention_start - window), mention_start)
+        after_sum, after_num = self.get_window_sum(mention_end, min(len(self.document), mention_end + window))
+        if prev_num + after_num == 0: return None
+        return normalize(prev_sum + after_sum)
@@ -1,29 +1,131 @@
 import datetime
+import itertools
+import os
 import re
 import time
 from abc import ABCMeta, abstractmethod
-from typing import Dict
+from collections.abc import Mapping
+from typing import Dict, List
 
-from models import Entity
+import numpy
+
+from models import EntityView
+from modules.StringColumn import HashIndex, StringColumn
 from modules.VecModel import VecModel
 
 
+class EntityKeyIndex:
+    """ Keys (uris, full titles or title mentions) to entity rows: a string column of the keys,
+    its HashIndex and the rows of each key as CSR arrays.
+    """
+
+    def __init__(self, keys: StringColumn, index: HashIndex, offsets: numpy.ndarray, rows: numpy.ndarray):
+        self.keys    = keys
+        self.index   = index
+        self.offsets = offsets
+        self.rows    = rows
+
+    @classmethod
+    def from_dict(cls, key_2_rows: dict):
+        """ :param key_2_rows: {key: row} or {key: iterable of rows}
+        """
+        keys = StringColumn.from_strings(key_2_rows.keys())
+        values = list(key_2_rows.values())
+        if len(values) > 0 and isinstance(values[0], int):
+            offsets = numpy.arange(len(values) + 1, dtype=numpy.int64)
+            rows = numpy.array(values, dtype=numpy.int32)
+        else:
+            offsets = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(value) for value in values], out=offsets[1:])
+            rows = numpy.fromiter(itertools.chain.from_iterable(values), dtype=numpy.int32, count=int(offsets[-1]))
+        return cls(keys, HashIndex.build(keys), offsets, rows)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        keys = StringColumn.load(prefix, mmap_mode)
+        return cls(keys, HashIndex.load(keys, prefix, mmap_mode),
+                   numpy.load(prefix + ".entity_offsets.npy", mmap_mode=mmap_mode),
+                   numpy.load(prefix + ".entity_rows.npy", mmap_mode=mmap_mode))
+
+    def save(self, prefix) -> None:
+        self.keys.save(prefix)
+        self.index.save(prefix)
+        numpy.save(prefix + ".entity_offsets.npy", self.offsets)
+        numpy.save(prefix + ".entity_rows.npy", self.rows)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_rows(self, key: str) -> numpy.ndarray:
+        idx = self.index.find(key)
+        if idx < 0: return self.rows[:0]
+        return self.rows[self.offsets[idx]: self.offsets[idx + 1]]
+
+
+class EntityMapping(Mapping):
+    """ Read-only Dict[str, Entity] view of an EntityDictionary, entities are created on access.
+    """
+
+    def __init__(self, entity_dictionary):
+        self.entity_dictionary = entity_dictionary  # type: EntityDictionary
+
+    def __getitem__(self, entity_id):
+        entity = self.entity_dictionary.get_entity_from_id(entity_id)
+        if entity is None: raise KeyError(entity_id)
+        return entity
+
+    def get(self, entity_id, default=None):
+        entity = self.entity_dictionary.get_entity_from_id(entity_id)
+        return default if entity is None else entity
+
+    def __contains__(self, entity_id):
+        return self.entity_dictionary.get_row(entity_id) >= 0
+
+    def __iter__(self):
+        return iter(self.entity_dictionary.ids)
+
+    def __len__(self):
+        return len(self.entity_dictionary)
+
+
 class EntityDictionary:
+    """ Columnar entity table, the row of an entity is its int id.
+
+    entity_id, title and sub_title are string columns, entity_id, uri, full title and title mention
+    are looked up by HashIndex, and an EntityView is only created for the entity asked for.
+    Embeddings are read from the attached VecModel instead of being copied to every entity.
+    """
     source = None               # type: str
     language = None             # type: str
 
-    entity_dict = dict()        # type: Dict[str, Entity]
+    ids = None                  # type: StringColumn
+    titles = None               # type: StringColumn
+    sub_titles = None           # type: StringColumn
+    id_index = None             # type: HashIndex
+
+    uri_index = None            # type: EntityKeyIndex
+    fulltitle_index = None      # type: EntityKeyIndex
+    mention_index = None        # type: EntityKeyIndex
 
-    _fulltitle_2_id = dict()    # type: Dict[str, str]
-    _uri_2_id = dict()          # type: Dict[str, str]
-    _mention_2_ids = dict()     # type: Dict[str, Dict[str, None]]
+    vec_model = None            # type: VecModel
 
     def __init__(self, source, language, dict_path):
-        self.load_dictionary(source, language, dict_path)
+        self.source = source
+        self.language = language
+        # dict_path 为 save 写出的目录时直接映射各列, 不再逐行解析文本
+        if os.path.isdir(dict_path):
+            self.load(dict_path)
+        else:
+            self.load_dictionary(source, language, dict_path)
 
     def load_dictionary(self, source, language, dict_path):
         counter, start_at = 0, int(time. time())
         print("\nLoading entity_dictionary from: {}".format(dict_path))
+        # 以下 dict 只在构建期间使用, 构建完成后只保留各列数组
+        entity_rows = dict()        # type: Dict[str, int]
+        titles, sub_titles = [], []
+        uri_2_row, fulltitle_2_row = dict(), dict()     # type: Dict[str, int]
+        mention_2_rows = dict()     # type: Dict[str, Dict[int, None]]
         with open(dict_path, "r", encoding="utf-8") as rf:
             for line in rf:
                 line_arr = line.strip().split("\t\t")
@@ -33,21 +135,70 @@ class EntityDictionary:
 
                 counter += 1
 
-                entity = Entity(entity_id, title, sub_title, source, language)
-                for uri in uris:
-                    self._uri_2_id[uri] = entity_id
-
-                self._fulltitle_2_id[entity.get_full_title()] = entity_id
-
-                title_mention = self.get_mention_from_title(entity.get_full_title())
-                if self._mention_2_ids.get(title_mention) is None:
-                    self._mention_2_ids[title_mention] = dict()
-                self._mention_2_ids[title_mention][entity_id] = None
-
-                self.entity_dict[entity_id] = entity
+                # a duplicated entity_id keeps its row and takes the latest titles
+                row = entity_rows.setdefault(entity_id, len(entity_rows))
+                if row == len(titles):
+                    titles.append(title)
+                    sub_titles.append(sub_title)
+                else:
+                    titles[row], sub_titles[row] = title, sub_title
 
+                for uri in uris:
+                    uri_2_row[uri] = row
+
+                full_title = title + sub_title
+                fulltitle_2_row[full_title] = row
+
+                title_mention = self.get_mention_from_title(full_title)
+                if mention_2_rows.get(title_mention) is None:
+                    mention_2_rows[title_mention] = dict()
+                mention_2_rows[title_mention][row] = None
+
+        self.ids = StringColumn.from_strings(entity_rows.keys())
+        self.id_index = HashIndex.build(self.ids)
+        self.titles = StringColumn.from_strings(titles)
+        self.sub_titles = StringColumn.from_strings(sub_titles)
+        self.uri_index = EntityKeyIndex.from_dict(uri_2_row)
+        self.fulltitle_index = EntityKeyIndex.from_dict(fulltitle_2_row)
+        self.mention_index = EntityKeyIndex.from_dict(mention_2_rows)
         print("Loaded, #{}, time: {}.".format(counter, str(datetime.timedelta(seconds=int(time.time())-start_at))))
 
+    def save(self, path) -> None:
+        """ Writes every column and index as .npy files, memory-mapped back by load.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.ids.save(os.path.join(path, "ids"))
+        self.id_index.save(os.path.join(path, "ids"))
+        self.titles.save(os.path.join(path, "titles"))
+        self.sub_titles.save(os.path.join(path, "sub_titles"))
+        self.uri_index.save(os.path.join(path, "uris"))
+        self.fulltitle_index.save(os.path.join(path, "fulltitles"))
+        self.mention_index.save(os.path.join(path, "mentions"))
+
+    def load(self, path):
+        start_at = int(time.time())
+        print("\nMapping entity_dictionary columns from: {}".format(path))
+        self.ids = StringColumn.load(os.path.join(path, "ids"))
+        self.id_index = HashIndex.load(self.ids, os.path.join(path, "ids"))
+        self.titles = StringColumn.load(os.path.join(path, "titles"))
+        self.sub_titles = StringColumn.load(os.path.join(path, "sub_titles"))
+        self.uri_index = EntityKeyIndex.load(os.path.join(path, "uris"))
+        self.fulltitle_index = EntityKeyIndex.load(os.path.join(path, "fulltitles"))
+        self.mention_index = EntityKeyIndex.load(os.path.join(path, "mentions"))
+        print("Mapped, #{}, time: {}.".format(len(self), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+
+    def attach_vec_model(self, vec_model: VecModel):
+        """ Entities created afterwards get their embed from vec_model.
+        """
+        self.vec_model = vec_model
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def entity_dict(self) -> EntityMapping:
+        return EntityMapping(self)
+
     @staticmethod
     def get_mention_from_title(title: str) -> str:
         mention = ""
@@ -56,16 +207,35 @@ class EntityDictionary:
             mention += re.split("[)）]", t)[-1]
         return mention
 
+    def get_row(self, entity_id) -> int:
+        """ int id of the entity, -1 if absent.
+        """
+        return self.id_index.find(entity_id)
+
+    def get_entity(self, row) -> EntityView:
+        entity_id = self.ids[row]
+        embed = self.vec_model.vectors.get(entity_id) if self.vec_model is not None else None
+        return EntityView(row, entity_id, self.titles[row], self.sub_titles[row], self.source, self.language, embed)
+
     def get_entity_from_id(self, entity_id):
-        return self.entity_dict.get(entity_id)
+        row = self.get_row(entity_id)
+        if row < 0: return None
+        return self.get_entity(row)
 
     def get_entity_from_uri(self, entity_uri):
-        if self._uri_2_id.get(entity_uri) is None: return None
-        return self.entity_dict.get(self._uri_2_id.get(entity_uri))
+        rows = self.uri_index.get_rows(entity_uri)
+        if len(rows) == 0: return None
+        return self.get_entity(int(rows[0]))
 
     def get_entity_from_fulltitle(self, entity_title):
-        if self._fulltitle_2_id.get(entity_title) is None: return None
-        return self.entity_dict.get(self._fulltitle_2_id.get(entity_title))
+        rows = self.fulltitle_index.get_rows(entity_title)
+        if len(rows) == 0: return None
+        return self.get_entity(int(rows[0]))
+
+    def get_entities_from_mention(self, mention) -> List[EntityView]:
+        """ Entities whose full title gives this mention by get_mention_from_title.
+        """
+        return [self.get_entity(int(row)) for row in self.mention_index.get_rows(mention)]
 
 class EntityManager(metaclass=ABCMeta):
     @abstractmethod
@@ -90,16 +260,21 @@ class BaiduEntityManager(EntityManager):
             cls.instance.init(dict_path, vec_path)
         return cls.instance
 
+    @classmethod
+    def create(cls, dict_path, vec_path):
+        """ A new instance, neither cached as nor replacing the singleton instance.
+        """
+        manager = object.__new__(cls)
+        manager.init(dict_path, vec_path)
+        return manager
+
     def init(self, dict_pth, vec_path):
         source, language = "bd", "zh"
         self.source = source
         self.language = language
         self.entity_dictionary = EntityDictionary(source, language, dict_pth)
         self.vec_model = VecModel(vec_path)
-        for entity_id in self.vec_model.vectors:
-            if self.entity_dictionary.entity_dict.get(entity_id) is not None:
-                self.entity_dictionary.entity_dict[entity_id].set_embed(
-                    self.vec_model.vectors.get(entity_id))
+        self.entity_dictionary.attach_vec_model(self.vec_model)
         print("BaiduEntityManager prepared.\n")
 
     def get_entity_dictionary(self):
@@ -122,6 +297,14 @@ class WikiEntityManager(EntityManager):
             cls.instance.init(dict_path, vec_path)
         return cls.instance
 
+    @classmethod
+    def create(cls, dict_path, vec_path):
+        """ A new instance, neither cached as nor replacing the singleton instance.
+        """
+        manager = object.__new__(cls)
+        manager.init(dict_path, vec_path)
+        return manager
+
 
     def init(self, dict_pth, vec_path):
         source, language = "wiki", "en"
@@ -129,10 +312,7 @@ class WikiEntityManager(EntityManager):
         self.language = language
         self.entity_dictionary = EntityDictionary(source, language, dict_pth)
         self.vec_model = VecModel(vec_path)
-        for entity_id in self.vec_model.vectors:
-            if self.entity_dictionary.entity_dict.get(entity_id) is not None:
-                self.entity_dictionary.entity_dict[entity_id].set_embed(
-                    self.vec_model.vectors.get(entity_id))
+        self.entity_dictionary.attach_vec_model(self.vec_model)
         print("WikiEntityManager prepared.\n")
 
     def get_entity_dictionary(self):
@@ -5,15 +5,23 @@ Input: a span of plain text
 Output: a list of mentions with their positions in the text.
 """
 import datetime
-import heapq
+import pickle
 import time
 from abc import ABCMeta, abstractmethod
 from typing import Dict, List
 
+import ahocorasick
 from jpype import *
 
 from config import Config
 from models import Candidate, Mention
+from modules.ConflictResolver import ConflictResolver, HIGHEST_WEIGHT, LONGEST_MATCH
+
+
+PYTRIE_SUFFIX = ".pytrie"
+
+longest_match_resolver  = ConflictResolver(LONGEST_MATCH)
+highest_weight_resolver = ConflictResolver(HIGHEST_WEIGHT)
 
 
 class MentionParser(metaclass=ABCMeta):
@@ -22,6 +30,26 @@ class MentionParser(metaclass=ABCMeta):
     def parse_text(self, text: str):
         pass
 
+    @staticmethod
+    def build_mentions(parsed_result, parse_from: str) -> List[Mention]:
+        """ Build Mention objects from (start, end, label, candidate_ids) items, or
+        (start, end, label, candidate_ids, link_prob, candidate_e_given_m) items of a prob trie.
+        """
+        mention_list = []  # type: List[Mention]
+        for item in parsed_result:
+            mention = Mention(int(item[0]), int(item[1]), item[2])
+            mention.candidates = []
+            for cand_id in item[3]:
+                candidate = Candidate(cand_id)
+                mention.add_candidate(candidate)
+                mention.parse_from = parse_from
+            if len(item) > 4:
+                mention.set_link_prob(item[4])
+                for candidate, prob in zip(mention.candidates, item[5]):
+                    candidate.set_e_given_m(prob)
+            mention_list.append(mention)
+        return mention_list
+
 
 class TrieTreeConfig:
     dict_path = ""
@@ -55,49 +83,14 @@ class TrieTreeMentionParser(MentionParser):
             attachThreadToJVM()
 
         parsed_result = self.solve_conflict(self.format_output(self.parser.parseText(text), text))
-
-        mention_list = []  # type: List[Mention]
-        for item in parsed_result:
-            mention = Mention(int(item[0]), int(item[1]), item[2])
-            mention.candidates = []
-            for cand_id in item[3]:
-                candidate = Candidate(cand_id)
-                mention.add_candidate(candidate)
-                mention.parse_from = self.param_config.name
-            mention_list.append(mention)
-        return mention_list
+        return self.build_mentions(parsed_result, self.param_config.name)
 
     @staticmethod
     def solve_conflict(formatted_result):
-        if len(formatted_result) == 0: return []
-        mention_list = []
-
-        formatted_result = sorted(formatted_result, key=lambda item: item[0])
-        conflict_items = [formatted_result[0]]
-        start, end = formatted_result[0][:2]
-
-        for item in formatted_result[1:]:
-            if item[0] < end:
-                conflict_items.append(item)
-                end = max(item[1], end)
-            else:
-                max_mention_length, max_item = -1, None
-                for conflict_item in conflict_items:
-                    if len(conflict_item[2]) > max_mention_length:
-                        max_mention_length = len(conflict_item[2])
-                        max_item = conflict_item
-                mention_list.append(max_item)
-                conflict_items = [item]
-                start, end = item[:2]
-
-        max_mention_length, max_item = -1, None
-        for conflict_item in conflict_items:
-            if len(conflict_item[2]) > max_mention_length:
-                max_mention_length = len(conflict_item[2])
-                max_item = conflict_item
-        mention_list.append(max_item)
-
-        return mention_list
+        """ Keeps the longest of each overlapping cluster of (start, end, label, candidate_ids) items.
+        """
+        matches = [(item[0], item[1], 0, item) for item in formatted_result]
+        return [match[3] for match in longest_match_resolver.resolve(matches)]
 
     @staticmethod
     def format_output(parsed_result, doc):
@@ -115,6 +108,110 @@ class TrieTreeMentionParser(MentionParser):
         return result
 
 
+class AhoCorasickMentionParser(MentionParser):
+    """ Parses mentions by a pyahocorasick automaton in the current process.
+
+    It loads the `.pytrie` file built by datatool.pipeline.generate_tries.build_trie, whose
+    payload is [mention, entity_id_1, ..., entity_id_n], so there is no JVM to start, no thread
+    to attach, and no string round-trip which would break mentions containing "," or "=".
+    Tries built by build_prob_trie also give each mention's link_prob and candidates' p(e|m).
+    """
+    param_config = None # type: TrieTreeConfig
+
+    def __init__(self, trie_tree_config: TrieTreeConfig):
+        start_at = int(time.time())
+        print("\nLoading mention trie from: {}".format(trie_tree_config.trie_path))
+        self.automaton = ahocorasick.load(trie_tree_config.trie_path, pickle.loads)
+        self.param_config = trie_tree_config
+        print("Loaded, #{}, time: {}".format(
+            len(self.automaton), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+
+    def parse_text(self, text: str) -> List[Mention]:
+        survivors = longest_match_resolver.resolve(self.parse_raw(text), ordered_by_end=True)
+        return self.build_mentions([(m[0], m[1]) + self.unpack_payload(m[3]) for m in survivors], self.param_config.name)
+
+    @staticmethod
+    def unpack_payload(words) -> tuple:
+        """ (label, candidate_ids) of a build_trie payload, (label, candidate_ids, link_prob, candidate_e_given_m)
+        of a build_prob_trie payload.
+        """
+        if isinstance(words[1], tuple):
+            return tuple(words)
+        return words[0], words[1:]
+
+    def parse_raw(self, text: str) -> list:
+        """ All matches in the text as (start, end, weight, payload), ordered by end offset.
+        """
+        result = []
+        for end_index, words in self.automaton.iter(text):
+            result.append((end_index - len(words[0]) + 1, end_index + 1, self.param_config.weight, words))
+        return result
+
+
+class MergedAhoCorasickMentionParser(MentionParser):
+    """ Parses mentions of several dictionaries by one pyahocorasick automaton.
+
+    It loads the `.pytrie` file built by datatool.pipeline.generate_tries.build_merged_trie,
+    whose payload is (mention, ((name, weight, entity_ids), ...)), so one scan of the
+    document yields the matches of every dictionary. The weight of each dictionary is
+    read from the file written next to the trie.
+    """
+
+    def __init__(self, trie_path: str):
+        from datatool.pipeline.generate_tries import load_merged_weights
+        start_at = int(time.time())
+        print("\nLoading merged mention trie from: {}".format(trie_path))
+        self.automaton = ahocorasick.load(trie_path, pickle.loads)
+        self.trie_path = trie_path
+        self.weights = load_merged_weights(trie_path)   # type: Dict[str, int]
+        if self.weights is None:
+            # a trie built before the weights file existed, collect them from every payload
+            self.weights = dict()
+            for _, entries in self.automaton.values():
+                for name, weight in (entry[:2] for entry in entries):
+                    self.weights[name] = weight
+        print("Loaded, #{}, dictionaries: {}, time: {}".format(
+            len(self.automaton), list(self.weights), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+
+    def parse_text(self, text: str) -> List[Mention]:
+        return merge_by_weight(self.parse_text_by_source(text), self.weights)
+
+    def parse_text_by_source(self, text: str) -> Dict[str, List[Mention]]:
+        """ Non-overlapping mentions of each dictionary, same as parsing by its own trie.
+        """
+        raw_result = {name: [] for name in self.weights}
+        for end_index, (label, entries) in self.automaton.iter(text):
+            start_index = end_index - len(label) + 1
+            for entry in entries:
+                # entry: (name, weight, entity_ids) or (name, weight, entity_ids, link_prob, e_given_m)
+                raw_result[entry[0]].append((start_index, end_index + 1, entry[1], (label,) + entry[2:]))
+
+        parse_result = dict()
+        for name in raw_result:
+            survivors = longest_match_resolver.resolve(raw_result[name], ordered_by_end=True)
+            parse_result[name] = self.build_mentions([(m[0], m[1]) + m[3] for m in survivors], name)
+        return parse_result
+
+
+def merge_by_weight(parse_result: Dict[str, List[Mention]], weights: Dict[str, int]) -> List[Mention]:
+    """ Merges non-overlapping mention lists of several dictionaries, keeping mentions by weight,
+    then length, unless they overlap a mention already kept.
+    """
+    matches = []
+    for name in parse_result:
+        matches.extend((m.start, m.end, weights[name], m) for m in parse_result[name])
+    return [match[3] for match in highest_weight_resolver.resolve(matches)]
+
+
+def create_mention_parser(trie_tree_config: TrieTreeConfig,
+                          jar_path=Config.project_root + "data/jar/BuildIndex.jar") -> MentionParser:
+    """ AhoCorasickMentionParser for `.pytrie` files, the JVM based TrieTreeMentionParser otherwise.
+    """
+    if trie_tree_config.trie_path.endswith(PYTRIE_SUFFIX):
+        return AhoCorasickMentionParser(trie_tree_config)
+    return TrieTreeMentionParser(trie_tree_config, jar_path)
+
+
 class TrieTreeMultiDictParser(MentionParser):
     """ Parses mentions by multiple trie trees.
     """
@@ -134,7 +231,7 @@ class TrieTreeMultiDictParser(MentionParser):
 
         self._parsers = dict()
         for trie_tree_config in trie_tree_configs:
-            self._parsers[trie_tree_config.name] = TrieTreeMentionParser(trie_tree_config, jar_path)
+            self._parsers[trie_tree_config.name] = create_mention_parser(trie_tree_config, jar_path)
 
         print("{} trie tree(s) loaded, time: {}".format(len(trie_tree_configs), str(datetime.timedelta(seconds=int(time.time())-start_at))))
 
@@ -142,73 +239,8 @@ class TrieTreeMultiDictParser(MentionParser):
         parse_result = dict()
         for name in self._parsers:
             parse_result[name] = self.parse_text_by_trie(name, document)
-
-        valid_result = []   # type: List[Mention]
-
-        # 合并 k 个有序数组
-        head_items = []
-        for name in parse_result:
-            if len(parse_result[name]) == 0: continue
-            mention = parse_result[name][0]
-            heapq.heappush(head_items, (
-                mention.start,
-                mention.end,
-                name,
-                self._parsers[name].param_config.weight,
-                0,
-                mention)) # (start, name, weight, index, mention)
-
-        while len(head_items) > 0:
-            # 假设这里第一个是最小值
-            conflict_items = []
-            smallest_item = head_items[0]
-            for item in head_items:
-                if item[0] < smallest_item[1]:
-                    conflict_items.append(item)
-            if len(conflict_items) == 1:
-                valid_result.append(smallest_item[5])
-                heapq.heappop(head_items)
-                start, end, trie_name, trie_weight, trie_idx, mention = smallest_item
-                if trie_idx+1 < len(parse_result[trie_name]):
-                    trie_idx += 1
-                    mention = parse_result[trie_name][trie_idx]
-                    heapq.heappush(head_items, (
-                        mention.start,
-                        mention.end,
-                        trie_name,
-                        self._parsers[trie_name].param_config.weight,
-                        trie_idx,
-                        mention
-                    ))
-            else:
-                highest_weight = conflict_items[0][3]
-                highest_idx = 0
-                for idx in range(1, len(conflict_items)):
-                    if conflict_items[idx][3] > highest_weight:
-                        highest_weight = conflict_items[idx][3]
-                        highest_idx = idx
-                for idx, item in enumerate(conflict_items):
-                    if idx != highest_idx:
-                        for head_idx, head_item in enumerate(head_items):
-                            if head_item[0] == item[0] and head_item[1] == item[1] and head_item[2] == head_item[2]:
-                                del head_items[head_idx]
-                                break
-                        start, end, trie_name, trie_weight, trie_idx, mention = item
-                        if trie_idx + 1 < len(parse_result[trie_name]):
-                            trie_idx += 1
-                            mention = parse_result[trie_name][trie_idx]
-                            head_items.append((
-                                mention.start,
-                                mention.end,
-                                trie_name,
-                                self._parsers[trie_name].param_config.weight,
-                                trie_idx,
-                                mention
-                            ))
-                heapq.heapify(head_items)
-
-        return valid_result
-
+        weights = {name: self._parsers[name].param_config.weight for name in self._parsers}
+        return merge_by_weight(parse_result, weights)
 
     def parse_text_by_trie(self, trie_name: str, document: str) -> List[Mention]:
         parser = self._parsers.get(trie_name)   # type: TrieTreeMentionParser
@@ -0,0 +1,133 @@
+"""
+ModelBundle holds one loaded version of the models (tries, prob files, embeddings, entity dictionary),
+HotSwapPredictor serves predictions from the current bundle and switches to a new one atomically.
+
+A bundle is a directory laid out as the data_path of main.py, e.g. /data/zfw/xlink/bd/20201001/.
+Each request acquires the current bundle and releases it when done, so in-flight requests finish
+on the bundle they started with, and an old bundle is dropped as soon as its last request is released.
+
+Usage:
+    predictor = HotSwapPredictor(lambda bundle_path: link_corpus.load_predictor("bd", bundle_path, shared=False))
+    predictor.load("/data/zfw/xlink/bd/20201001")
+    predictor.predict(document)
+    predictor.load_async("/data/zfw/xlink/bd/20201015")   # keeps serving 20201001 until 20201015 is loaded
+"""
+import datetime
+import gc
+import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Callable, List
+
+from models import Mention
+from modules import Predictor
+
+
+class ModelBundle:
+    version   = None    # type: str
+    path      = None    # type: str
+    predictor = None    # type: Predictor.Predictor
+
+    def __init__(self, version, path, predictor):
+        self.version   = version
+        self.path      = path
+        self.predictor = predictor
+        self.loaded_at = time.time()
+        self.ref_count = 0
+
+
+class HotSwapPredictor(Predictor.Predictor):
+
+    def __init__(self, loader: Callable[[str], Predictor.Predictor]):
+        """
+        :param loader: builds a new, non-singleton predictor from a bundle path, e.g. XLinkPredictor.create
+        """
+        self.loader   = loader
+        self._current = None    # type: ModelBundle
+        self._lock    = threading.Lock()
+        self._loading = None    # type: threading.Thread
+        # "<version>: <error>" of the last failed load_async, None once a bundle loads
+        self.last_load_error = None     # type: str
+
+    @property
+    def version(self):
+        bundle = self._current
+        return bundle.version if bundle is not None else None
+
+    def load(self, bundle_path, version=None) -> ModelBundle:
+        """ Loads the bundle in the calling thread, then makes it current.
+        """
+        version = version or os.path.basename(os.path.normpath(bundle_path))
+        print("\nLoading model bundle {} from: {}".format(version, bundle_path))
+        start_at = int(time.time())
+        bundle = ModelBundle(version, bundle_path, self.loader(bundle_path))
+        print("Bundle {} loaded, time: {}".format(version, str(datetime.timedelta(seconds=int(time.time())-start_at))))
+        self.swap(bundle)
+        self.last_load_error = None
+        return bundle
+
+    def _load_in_background(self, bundle_path, version):
+        """ Target of load_async, a failure is kept in last_load_error since no caller waits for the thread.
+        """
+        try:
+            self.load(bundle_path, version)
+        except Exception as e:
+            traceback.print_exc()
+            self.last_load_error = "{}: {!r}".format(version or bundle_path, e)
+
+    def load_async(self, bundle_path, version=None) -> threading.Thread:
+        """ Loads the bundle in a background thread, the current bundle keeps serving meanwhile.
+        If loading fails the current bundle stays, and the error is kept in last_load_error.
+        """
+        with self._lock:
+            if self._loading is not None and self._loading.is_alive():
+                raise RuntimeError("Bundle {} is still being loaded".format(self._loading.name))
+            self._loading = threading.Thread(target=self._load_in_background, args=(bundle_path, version),
+                                             name=version or bundle_path, daemon=True)
+            self._loading.start()
+            return self._loading
+
+    def swap(self, bundle: ModelBundle):
+        with self._lock:
+            old_bundle, self._current = self._current, bundle
+            bundle.ref_count += 1   # held by being current
+        if old_bundle is not None:
+            print("Switched model bundle {} -> {}".format(old_bundle.version, bundle.version))
+            self._release(old_bundle)
+
+    def acquire(self) -> ModelBundle:
+        with self._lock:
+            if self._current is None:
+                raise RuntimeError("No model bundle loaded")
+            self._current.ref_count += 1
+            return self._current
+
+    def _release(self, bundle: ModelBundle):
+        with self._lock:
+            bundle.ref_count -= 1
+            freed = bundle.ref_count == 0
+            if freed:
+                bundle.predictor = None
+        if freed:
+            gc.collect()
+            print("Model bundle {} released".format(bundle.version))
+
+    @contextmanager
+    def using(self):
+        """ with predictor.using() as bundle: ... bundle.predictor stays valid until the block exits.
+        """
+        bundle = self.acquire()
+        try:
+            yield bundle
+        finally:
+            self._release(bundle)
+
+    def predict(self, document) -> List[Mention]:
+        with self.using() as bundle:
+            return bundle.predictor.predict(document)
+
+    def predict_batch(self, documents: List[str]) -> List[List[Mention]]:
+        with self.using() as bundle:
+            return bundle.predictor.predict_batch(documents)
@@ -1,12 +1,10 @@
 from abc import ABCMeta, abstractmethod
 from typing import Any, List
 
-import numpy
-from numpy import linalg as LA
-
 from config import Config
 from models import Candidate, Mention
 from modules import EntityManager, MentionParser, WordManager, WordParser
+from modules.VecModel import normalize
 
 
 class Predictor(metaclass=ABCMeta):
@@ -116,10 +114,11 @@ class GenerativeModelPredictor(Predictor):
             # 按照 context_words_sim 初步筛选出 valid candidate for mention
             valid_candidates = []  # type: List[Candidate]
             for candidate_id in candidates:
-                if self.entity_manager.is_entity_has_embed(candidate_id) and \
-                        self.entity_manager.entity_dictionary.entity_dict.get(candidate_id) is not None:
+                if not self.entity_manager.is_entity_has_embed(candidate_id): continue
+                entity_row = self.entity_manager.entity_dictionary.get_row(candidate_id)
+                if entity_row >= 0:
                     candidate = Candidate(candidate_id)
-                    candidate.set_entity(self.entity_manager.entity_dictionary.entity_dict.get(candidate_id))
+                    candidate.set_entity_dictionary(self.entity_manager.entity_dictionary, entity_row)
 
                     candidate.set_context_words_sim(self.cal_candidate_context_words_sim(candidate_id, context_words))
                     if candidate.context_words_sim > self.context_words_sim_th:
@@ -198,23 +197,19 @@ class GenerativeModelPredictor(Predictor):
 
     def cal_candidate_context_words_sim(self, entity_id, context_words) -> float:
         if len(context_words) == 0: return 0
-        context_embed = numpy.zeros(self.word_manager.vec_model.vec_size)
-        for word in context_words:
-            context_embed += numpy.array(self.word_manager.vec_model.vectors.get(word))
-        context_embed /= len(context_words)
-
-        entity_embed = self.entity_manager.vec_model.vectors.get(entity_id)
-        return numpy.matmul(entity_embed, context_embed)/(LA.norm(entity_embed, 2) * LA.norm(context_embed, 2))
+        context_centroid = self.word_manager.vec_model.get_centroid(context_words)
+        # get_centroid 在没有任何 context word 有向量时返回 None
+        if context_centroid is None: return 0
+        context_embed = normalize(context_centroid)
+        return self.entity_manager.vec_model.cosine_similarity(entity_id, context_embed)
 
     def cal_candidate_context_entities_sim(self, entity_id, context_entities) -> float:
         if len(context_entities) == 0: return 0
-        context_embed = numpy.zeros(self.entity_manager.vec_model.vec_size)
-        for candidate in context_entities:
-            context_embed += numpy.array(self.entity_manager.vec_model.vectors.get(candidate.entity_id))
-        context_embed /= len(context_entities)
-
-        entity_embed = self.entity_manager.vec_model.vectors.get(entity_id)
-        return numpy.matmul(entity_embed, context_embed)/(LA.norm(entity_embed, 2) * LA.norm(context_embed, 2))
+        context_centroid = self.entity_manager.vec_model.get_centroid(
+            [candidate.entity_id for candidate in context_entities])
+        if context_centroid is None: return 0
+        context_embed = normalize(context_centroid)
+        return self.entity_manager.vec_model.cosine_similarity(entity_id, context_embed)
 
 
 class ProbGenerativeModelPredictor(Predictor):
@@ -1,8 +1,16 @@
+import bisect
 import datetime
 import json
+import math
+import os
+import shutil
 import time
 from typing import Dict
 
+import numpy
+
+from modules.StringColumn import HASHES_SUFFIX, HashIndex, StringColumn, sort_strings
+
 
 class ProbHolder:
     # entity->prob
@@ -51,6 +59,148 @@ class ProbHolder:
         return self.entity_prior.get(entity_id)
 
 
+def prune_candidates(candidate_probs, max_candidates=None, cum_prob_th=None) -> list:
+    """ Keeps the top max_candidates (key, prob) pairs by prob, stopping once their cumulative prob
+    reaches cum_prob_th. Probs are kept as they are, missing ones (None) rank last.
+
+    :return: the kept pairs, highest prob first
+    """
+    ranked = sorted(candidate_probs, key=lambda item: -item[1] if item[1] is not None else 1)
+    if max_candidates is not None:
+        ranked = ranked[:max_candidates]
+    if cum_prob_th is not None:
+        cum_prob = 0
+        for idx, (_, prob) in enumerate(ranked):
+            cum_prob += prob or 0
+            if cum_prob >= cum_prob_th:
+                return ranked[:idx + 1]
+    return ranked
+
+
+def save_csr(rows: Dict[str, Dict[str, float]], row_keys: list, col_index: Dict[str, int], prefix: str):
+    """ Saves dict-of-dicts as CSR arrays <prefix>_offsets (int64), <prefix>_ids (int32), <prefix>_probs (float32),
+    columns of each row sorted by id.
+    """
+    offsets = numpy.zeros(len(row_keys) + 1, dtype=numpy.int64)
+    for row_idx, row_key in enumerate(row_keys):
+        offsets[row_idx + 1] = offsets[row_idx] + len(rows.get(row_key, {}))
+    ids   = numpy.empty(offsets[-1], dtype=numpy.int32)
+    probs = numpy.empty(offsets[-1], dtype=numpy.float32)
+    for row_idx, row_key in enumerate(row_keys):
+        row = sorted((col_index[col_key], prob) for col_key, prob in rows.get(row_key, {}).items())
+        start = offsets[row_idx]
+        ids[start: start + len(row)]   = [item[0] for item in row]
+        probs[start: start + len(row)] = [item[1] for item in row]
+    numpy.save(prefix + "_offsets.npy", offsets)
+    numpy.save(prefix + "_ids.npy", ids)
+    numpy.save(prefix + "_probs.npy", probs)
+
+
+def save_compact_prob_store(store_path, entity_prior, m_given_e, e_given_m, link_prob) -> None:
+    """ Writes the four prob dicts as the directory read by CompactProbHolder.
+
+    Mentions and entities are interned to their rows in sorted string columns looked up by their HashIndex,
+    e_given_m and m_given_e are CSR arrays, link_prob and entity_prior are float32 arrays with NaN for missing values.
+    """
+    os.makedirs(store_path, exist_ok=True)
+
+    mention_set = set(e_given_m) | set(link_prob)
+    for entity_id in m_given_e: mention_set.update(m_given_e[entity_id])
+    entity_set = set(entity_prior) | set(m_given_e)
+    for mention in e_given_m: entity_set.update(e_given_m[mention])
+
+    mentions = sort_strings(mention_set)
+    entities = sort_strings(entity_set)
+    mention_index = {mention: idx for idx, mention in enumerate(mentions)}
+    entity_index  = {entity_id: idx for idx, entity_id in enumerate(entities)}
+    for strings, name in ((mentions, "mentions"), (entities, "entities")):
+        column = StringColumn.from_strings(strings)
+        column.save(os.path.join(store_path, name))
+        HashIndex.build(column).save(os.path.join(store_path, name))
+
+    numpy.save(os.path.join(store_path, "link_prob.npy"),
+               numpy.array([link_prob.get(mention, numpy.nan) for mention in mentions], dtype=numpy.float32))
+    numpy.save(os.path.join(store_path, "entity_prior.npy"),
+               numpy.array([entity_prior.get(entity_id, numpy.nan) for entity_id in entities], dtype=numpy.float32))
+
+    save_csr(e_given_m, mentions, entity_index, os.path.join(store_path, "e_given_m"))
+    save_csr(m_given_e, entities, mention_index, os.path.join(store_path, "m_given_e"))
+
+
+def save_prob_store(prob_holder, store_path) -> None:
+    """ Writes any loaded prob holder as the directory read by CompactProbHolder.
+    """
+    if isinstance(prob_holder, CompactProbHolder):
+        shutil.copytree(prob_holder.store_path, store_path)
+    else:
+        save_compact_prob_store(store_path, prob_holder.entity_prior, prob_holder.m_given_e,
+                                prob_holder.e_given_m, prob_holder.link_prob)
+
+
+class CompactProbHolder(ProbHolder):
+    """ ProbHolder answering from the memory-mapped arrays written by save_compact_prob_store.
+
+    Loading takes no time and the pages are shared by every process mapping the same store.
+    """
+
+    def __init__(self, store_path):
+        print("\nLoading compact prob store: {}".format(store_path))
+        start_at = int(time.time())
+        self.store_path = store_path
+
+        # memoryviews of the mapped arrays, a lookup reads a few scalars, which numpy indexing makes slow
+        def load(name):
+            return memoryview(numpy.load(os.path.join(store_path, name), mmap_mode="r"))
+
+        self.mentions, self.mention_index = self.load_column(os.path.join(store_path, "mentions"))
+        self.entities, self.entity_index = self.load_column(os.path.join(store_path, "entities"))
+        self.link_prob    = load("link_prob.npy")
+        self.entity_prior = load("entity_prior.npy")
+        self.e_given_m_offsets, self.e_given_m_ids, self.e_given_m_probs = \
+            load("e_given_m_offsets.npy"), load("e_given_m_ids.npy"), load("e_given_m_probs.npy")
+        self.m_given_e_offsets, self.m_given_e_ids, self.m_given_e_probs = \
+            load("m_given_e_offsets.npy"), load("m_given_e_ids.npy"), load("m_given_e_probs.npy")
+        print("Loaded, #mentions: {}, #entities: {}, time: {}".format(
+            len(self.mentions), len(self.entities), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+
+    @staticmethod
+    def load_column(prefix):
+        """ The string column and its HashIndex, which is built in memory for a store saved without it.
+        """
+        column = StringColumn.load(prefix)
+        if os.path.exists(prefix + HASHES_SUFFIX):
+            return column, HashIndex.load(column, prefix)
+        return column, HashIndex.build(column)
+
+    @staticmethod
+    def _get_value(values, idx):
+        if idx < 0 or math.isnan(values[idx]): return None
+        return values[idx]
+
+    @staticmethod
+    def _get_csr_value(offsets, ids, probs, row_idx, col_idx):
+        if row_idx < 0 or col_idx < 0: return None
+        end = offsets[row_idx + 1]
+        pos = bisect.bisect_left(ids, col_idx, offsets[row_idx], end)
+        if pos < end and ids[pos] == col_idx:
+            return probs[pos]
+        return None
+
+    def get_link_prob(self, mention: str):
+        return self._get_value(self.link_prob, self.mention_index.find(mention))
+
+    def get_m_given_e(self, mention: str, entity_id: str):
+        return self._get_csr_value(self.m_given_e_offsets, self.m_given_e_ids, self.m_given_e_probs,
+                                   self.entity_index.find(entity_id), self.mention_index.find(mention))
+
+    def get_e_given_m(self, entity_id: str, mention: str):
+        return self._get_csr_value(self.e_given_m_offsets, self.e_given_m_ids, self.e_given_m_probs,
+                                   self.mention_index.find(mention), self.entity_index.find(entity_id))
+
+    def get_entity_prior(self, entity_id):
+        return self._get_value(self.entity_prior, self.entity_index.find(entity_id))
+
+
 class BaiduProbHolder(ProbHolder):
     source = "bd"
     language = "en"
@@ -60,6 +210,14 @@ class BaiduProbHolder(ProbHolder):
             cls.instance = super(BaiduProbHolder, cls).__new__(cls)
         return cls.instance
 
+    @classmethod
+    def create(cls, entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path):
+        """ A new instance, neither cached as nor replacing the singleton instance.
+        """
+        holder = object.__new__(cls)
+        holder.__init__(entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path)
+        return holder
+
 class WikiProbHolder(ProbHolder):
     source = "bd"
     language = "en"
@@ -67,4 +225,12 @@ class WikiProbHolder(ProbHolder):
     def __new__(cls, entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path):
         if not hasattr(WikiProbHolder, 'instance'):
             cls.instance = super(WikiProbHolder, cls).__new__(cls)
-        return cls.instance
\ No newline at end of file
+        return cls.instance
+
+    @classmethod
+    def create(cls, entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path):
+        """ A new instance, neither cached as nor replacing the singleton instance.
+        """
+        holder = object.__new__(cls)
+        holder.__init__(entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path)
+        return holder
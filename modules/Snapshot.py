@@ -0,0 +1,130 @@
+"""
+Snapshot is a directory holding every structure of a loaded predictor in a form which loads in seconds:
+the entity dictionary as string columns, the embeddings as .npy matrices, the probs as a compact prob store
+and the mention tries as .pytrie files, most of them memory-mapped.
+
+Its manifest.json records the format version, the size of every file in the snapshot and the size, mtime
+and sha1 of every source file the predictor was loaded from. Loading checks the files of the snapshot,
+and by default that no source file still present has changed since, i.e. that the snapshot is not stale.
+
+Usage:
+    predictor.save_snapshot("/data/zfw/xlink/bd/snapshot")
+    predictor = XLinkPredictor.load_snapshot("/data/zfw/xlink/bd/snapshot")
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+SNAPSHOT_VERSION = 2
+MANIFEST_NAME    = "manifest.json"
+
+
+def file_sha1(path) -> str:
+    """ sha1 of a file, or of the relative names and contents of all files under a directory.
+    """
+    sha1 = hashlib.sha1()
+    if os.path.isdir(path):
+        for rel_path in sorted(list_files(path)):
+            sha1.update(rel_path.encode("utf-8"))
+            sha1.update(file_sha1(os.path.join(path, rel_path)).encode("ascii"))
+        return sha1.hexdigest()
+    with open(path, "rb") as rf:
+        for chunk in iter(lambda: rf.read(1 << 24), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def list_files(path) -> Dict[str, int]:
+    """ {relative path: size} of all files under path.
+    """
+    files = dict()
+    for root, _, names in os.walk(path):
+        for name in names:
+            full_path = os.path.join(root, name)
+            files[os.path.relpath(full_path, path)] = os.path.getsize(full_path)
+    return files
+
+
+def stat_input(path) -> dict:
+    if os.path.isdir(path):
+        files = list_files(path)
+        mtime = max([os.path.getmtime(os.path.join(path, f)) for f in files] or [os.path.getmtime(path)])
+        return {"size": sum(files.values()), "mtime": mtime}
+    return {"size": os.path.getsize(path), "mtime": os.path.getmtime(path)}
+
+
+@contextmanager
+def writing(snapshot_path):
+    """ Yields a temporary directory which replaces snapshot_path once the block succeeds,
+    so that a reader never sees a half written snapshot.
+    """
+    tmp_path = os.path.normpath(snapshot_path) + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    try:
+        yield tmp_path
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    if os.path.exists(snapshot_path):
+        shutil.rmtree(snapshot_path)
+    os.rename(tmp_path, snapshot_path)
+
+
+def write_manifest(snapshot_path, inputs: Dict[str, str], **fields) -> dict:
+    """ :param inputs: {name: source file or directory path}, None or missing paths are skipped.
+    :param fields: other json-able fields, e.g. source and hyper_params.
+    """
+    print("Computing checksums of the source files")
+    start_at = int(time.time())
+    manifest = {"format_version": SNAPSHOT_VERSION,
+                "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "inputs": dict(),
+                "files": list_files(snapshot_path)}
+    manifest.update(fields)
+    for name, path in inputs.items():
+        if path is None or not os.path.exists(path): continue
+        manifest["inputs"][name] = dict(path=os.path.abspath(path), sha1=file_sha1(path), **stat_input(path))
+    with open(os.path.join(snapshot_path, MANIFEST_NAME), "w", encoding="utf-8") as wf:
+        json.dump(manifest, wf, ensure_ascii=False, indent=2)
+    print("Checksums computed, #{}, time: {}".format(
+        len(manifest["inputs"]), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+    return manifest
+
+
+def read_manifest(snapshot_path, verify_inputs=True) -> dict:
+    """ Manifest of a snapshot, raises ValueError if it is of another format version, misses or has
+    truncated files, or if verify_inputs and a source file it was built from has changed.
+
+    Source files are compared by size and mtime first, sha1 is only computed for the ones touched since.
+    """
+    manifest_path = os.path.join(snapshot_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        raise ValueError("Not a snapshot, {} is missing".format(manifest_path))
+    with open(manifest_path, "r", encoding="utf-8") as rf:
+        manifest = json.load(rf)
+    if manifest.get("format_version") != SNAPSHOT_VERSION:
+        raise ValueError("Snapshot {} has format version {}, expected {}".format(
+            snapshot_path, manifest.get("format_version"), SNAPSHOT_VERSION))
+
+    for rel_path, size in manifest["files"].items():
+        path = os.path.join(snapshot_path, rel_path)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            raise ValueError("Snapshot {} is corrupted, {} is missing or truncated".format(snapshot_path, rel_path))
+
+    if verify_inputs:
+        for name, recorded in manifest["inputs"].items():
+            # 部署机器上可能没有源文件, 只校验仍然存在的
+            if not os.path.exists(recorded["path"]): continue
+            current = stat_input(recorded["path"])
+            if current["size"] == recorded["size"] and current["mtime"] == recorded["mtime"]: continue
+            if current["size"] != recorded["size"] or file_sha1(recorded["path"]) != recorded["sha1"]:
+                raise ValueError("Snapshot {} is stale, {} changed since it was built: {}".format(
+                    snapshot_path, name, recorded["path"]))
+    return manifest
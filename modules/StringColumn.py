@@ -0,0 +1,135 @@
+"""
+StringColumn stores a list of strings as one utf-8 blob plus int64 offsets, both numpy arrays.
+
+Saved as <prefix>.blob.npy and <prefix>.offsets.npy, so a column can be memory-mapped and
+shared by every worker instead of being unpickled into millions of str objects.
+
+A HashIndex finds the row of a string in any column, sorted or not, by its crc32.
+
+Usage:
+    save_string_column(sorted_strings, prefix)
+    column = StringColumn.load(prefix)
+    idx = column.find("some string")    # -1 if absent, the column must be sorted
+
+    index = HashIndex.build(column)
+    idx = index.find("some string")     # -1 if absent, the first row if the column has duplicates
+"""
+import bisect
+import zlib
+from typing import Iterable
+
+import numpy
+
+BLOB_SUFFIX    = ".blob.npy"
+OFFSETS_SUFFIX = ".offsets.npy"
+HASHES_SUFFIX  = ".hashes.npy"
+ROWS_SUFFIX    = ".hash_rows.npy"
+
+
+def sort_strings(strings: Iterable[str]) -> list:
+    """ Sorted by utf-8 bytes, the order StringColumn.find expects.
+    """
+    return sorted(strings, key=lambda s: s.encode("utf-8"))
+
+
+def save_string_column(strings: Iterable[str], prefix: str) -> int:
+    column = StringColumn.from_strings(strings)
+    column.save(prefix)
+    return len(column)
+
+
+class StringColumn:
+
+    def __init__(self, blob: numpy.ndarray, offsets: numpy.ndarray):
+        self.blob    = blob
+        self.offsets = offsets
+        # memoryviews of the same buffers, indexing them is much cheaper than indexing a numpy memmap
+        self._blob_view    = memoryview(numpy.ascontiguousarray(blob))
+        self._offsets_view = memoryview(numpy.ascontiguousarray(offsets))
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8), offsets)
+
+    @classmethod
+    def load(cls, prefix: str, mmap_mode="r"):
+        return cls(numpy.load(prefix + BLOB_SUFFIX, mmap_mode=mmap_mode),
+                   numpy.load(prefix + OFFSETS_SUFFIX, mmap_mode=mmap_mode))
+
+    def save(self, prefix: str) -> None:
+        numpy.save(prefix + BLOB_SUFFIX, self.blob)
+        numpy.save(prefix + OFFSETS_SUFFIX, self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        return self.get_bytes(idx).decode("utf-8")
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def get_bytes(self, idx: int) -> bytes:
+        return self._blob_view[self._offsets_view[idx]: self._offsets_view[idx + 1]].tobytes()
+
+    def find(self, s: str) -> int:
+        """ Binary search in a column saved in sort_strings order, -1 if s is absent.
+        """
+        target = s.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_bytes(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.get_bytes(lo) == target:
+            return lo
+        return -1
+
+
+class HashIndex:
+    """ crc32 of every string of a column sorted together with its row, 8 bytes per string.
+
+    A lookup is one binary search on the hashes, the rows sharing the hash are then
+    compared with the column, so collisions never give a wrong row.
+    """
+
+    def __init__(self, column: StringColumn, hashes: numpy.ndarray, rows: numpy.ndarray):
+        self.column = column
+        self.hashes = hashes
+        self.rows   = rows
+        self._hashes_view = memoryview(numpy.ascontiguousarray(hashes))
+        self._rows_view   = memoryview(numpy.ascontiguousarray(rows))
+
+    @classmethod
+    def build(cls, column: StringColumn):
+        hashes = numpy.fromiter((zlib.crc32(column.get_bytes(idx)) for idx in range(len(column))),
+                                dtype=numpy.uint32, count=len(column))
+        rows = numpy.argsort(hashes, kind="stable").astype(numpy.int32)
+        return cls(column, hashes[rows], rows)
+
+    @classmethod
+    def load(cls, column: StringColumn, prefix: str, mmap_mode="r"):
+        return cls(column, numpy.load(prefix + HASHES_SUFFIX, mmap_mode=mmap_mode),
+                   numpy.load(prefix + ROWS_SUFFIX, mmap_mode=mmap_mode))
+
+    def save(self, prefix: str) -> None:
+        numpy.save(prefix + HASHES_SUFFIX, self.hashes)
+        numpy.save(prefix + ROWS_SUFFIX, self.rows)
+
+    def find(self, s: str) -> int:
+        target = s.encode("utf-8")
+        h = zlib.crc32(target)
+        hashes = self._hashes_view
+        pos = bisect.bisect_left(hashes, h)
+        while pos < len(hashes) and hashes[pos] == h:
+            row = self._rows_view[pos]
+            if self.column.get_bytes(row) == target:
+                return row
+            pos += 1
+        return -1
@@ -1,6 +1,13 @@
 import datetime
+import mmap
+import os
 import struct
 import time
+from typing import Dict
+
+import numpy
+
+from modules.StringColumn import BLOB_SUFFIX, HashIndex, StringColumn
 
 
 class BinaryReader:
@@ -42,17 +49,176 @@ class BinaryReader:
             pass
 
 
+NPY_SUFFIX = ".npy"
+VOCAB_SUFFIX = ".vocab"
+WORDS_SUFFIX = ".words"
+NORMS_SUFFIX = ".norms.npy"
+
+
+def get_npy_paths(vec_path):
+    """ The .npy matrix path of an embedding file, and the .vocab word list of older conversions.
+    """
+    if vec_path.endswith(NPY_SUFFIX):
+        vec_path = vec_path[:-len(NPY_SUFFIX)]
+    return vec_path + NPY_SUFFIX, vec_path + VOCAB_SUFFIX
+
+
+def get_words_prefix(npy_path):
+    """ Prefix of the StringColumn and HashIndex files of the words of npy_path.
+    """
+    return get_npy_paths(npy_path)[0][:-len(NPY_SUFFIX)] + WORDS_SUFFIX
+
+
+def get_norms_path(npy_path):
+    """ Path of the row norms of npy_path, written with the matrix so that loading it reads no row.
+    """
+    return get_npy_paths(npy_path)[0][:-len(NPY_SUFFIX)] + NORMS_SUFFIX
+
+
+def convert_to_npy(vec_path, npy_path=None):
+    """ One-time conversion of a TrainJointModel binary file to the .npy layout.
+
+    The matrix is written with numpy.save, whose header keeps the data 64-byte
+    aligned, next to the words as a StringColumn with its HashIndex and the row
+    norms. Load the result with VecModel(npy_path) to memory-map it read-only.
+    """
+    npy_path = npy_path or get_npy_paths(vec_path)[0]
+
+    vec_model = VecModel(vec_path)
+    start_at = int(time.time())
+    print("Converting embeddings to: {}".format(npy_path))
+    save_npy(vec_model, npy_path)
+    print("Converted, #{}, time: {}".format(
+        len(vec_model.vectors), str(datetime.timedelta(seconds=int(time.time())-start_at))))
+    return npy_path
+
+
+def convert_vocab(npy_path):
+    """ Builds the words files of a .npy written with a .vocab word list by an older convert_to_npy.
+    """
+    npy_path, vocab_path = get_npy_paths(npy_path)
+    print("Converting {} to the words index of {}".format(vocab_path, npy_path))
+    with open(vocab_path, "r", encoding="utf-8", newline="\n") as rf:
+        words = rf.read().split("\n")
+    if len(words) > 0 and words[-1] == '':
+        words.pop()
+    vectors = VectorIndex.from_words(words, numpy.load(npy_path, mmap_mode='r'))
+    vectors.save(get_words_prefix(npy_path))
+    numpy.save(get_norms_path(npy_path), cal_norms(vectors.matrix))
+
+
+def save_npy(vec_model, npy_path):
+    """ Writes a loaded VecModel in the layout of convert_to_npy, e.g. into a snapshot.
+    """
+    numpy.save(npy_path, vec_model.matrix)
+    vec_model.vectors.save(get_words_prefix(npy_path))
+    numpy.save(get_norms_path(npy_path), vec_model.norms)
+    return npy_path
+
+
+def cal_norms(matrix):
+    """ L2 norm of every row.
+    """
+    return numpy.sqrt(numpy.einsum('ij,ij->i', matrix, matrix)).astype(numpy.float32)
+
+
+def normalize(vec):
+    """ L2-normalized float32 copy of vec, zero vectors are returned unchanged.
+    """
+    vec = numpy.asarray(vec, dtype=numpy.float32)
+    norm = numpy.linalg.norm(vec)
+    if norm == 0: return vec
+    return vec / norm
+
+
+class VectorIndex:
+    """ Read-only token->embedding mapping backed by one contiguous matrix.
+
+    It behaves like the Dict[str, List[float]] that VecModel used to hold, but
+    every value is a float32 row view of the matrix instead of a Python list, and
+    the tokens are a StringColumn looked up by its HashIndex, both memory-mapped
+    like the matrix when loaded from the .npy layout.
+    """
+    def __init__(self, words, word_index, matrix):
+        self.words = words              # type: StringColumn
+        self.word_index = word_index    # type: HashIndex
+        self.matrix = matrix            # type: numpy.ndarray
+
+    @classmethod
+    def from_words(cls, words, matrix):
+        """ :param words: the token of every row of matrix.
+        """
+        if len(words) != matrix.shape[0]:
+            raise ValueError("#{} words for #{} rows".format(len(words), matrix.shape[0]))
+        column = StringColumn.from_strings(words)
+        return cls(column, HashIndex.build(column), matrix)
+
+    @classmethod
+    def load(cls, prefix, matrix):
+        column = StringColumn.load(prefix)
+        if len(column) != matrix.shape[0]:
+            raise ValueError("{} has #{} words but the matrix has #{} rows".format(prefix, len(column), matrix.shape[0]))
+        return cls(column, HashIndex.load(column, prefix), matrix)
+
+    def save(self, prefix):
+        self.words.save(prefix)
+        self.word_index.save(prefix)
+
+    def get(self, word, default=None):
+        row = self.word_index.find(word)
+        if row < 0: return default
+        return self.matrix[row]
+
+    def get_row(self, word):
+        row = self.word_index.find(word)
+        return None if row < 0 else row
+
+    def __getitem__(self, word):
+        row = self.word_index.find(word)
+        if row < 0: raise KeyError(word)
+        return self.matrix[row]
+
+    def __contains__(self, word):
+        return self.word_index.find(word) >= 0
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def keys(self):
+        return iter(self.words)
+
+    def items(self):
+        for row, word in enumerate(self.words):
+            yield word, self.matrix[row]
+
+
 class VecModel:
     def __init__(self, vec_path):
+        """
+        :param vec_path: a TrainJointModel binary file, or a .npy file written by
+            convert_to_npy, which is memory-mapped read-only so that all processes
+            on a host share the same page-cache pages.
+        """
         self.vec_path = vec_path
+        self.file = None
+        if vec_path.endswith(NPY_SUFFIX):
+            self.loadNpy()
+            return
+
         self.file = open(self.vec_path, 'rb')
         self.words_num = int(BinaryReader.readStringWithoutBlank(self.file))
         self.vec_size  = int(BinaryReader.readStringWithoutBlank(self.file))
-        self.vectors   = {}
+        self.matrix    = None   # type: numpy.ndarray
+        self.norms     = None   # type: numpy.ndarray
+        self.vectors   = VectorIndex.from_words([], numpy.zeros((0, self.vec_size), dtype=numpy.float32))
         self.loadAllWords()
 
     def __del__(self):
-        self.file.close()
+        if self.file is not None:
+            self.file.close()
 
     def refreshFilePointer(self):
         self.file.close()
@@ -76,26 +242,114 @@ class VecModel:
             pass
 
     def loadAllWords(self):
+        """ Bulk-load the binary file into a (words_num, vec_size) float32 matrix.
+
+        The layout is the one written by TrainJointModel:
+            <words_num> <vec_size>\n(<word>\t<vec_size float32>\n)*
+        """
         try:
             print('\nLoading embeddings from {}，expected num: #{}'.format(self.vec_path, self.words_num))
             start_time = time.time()
             self.refreshFilePointer()
-            self.vectors = {}
-            counter = 0
-            while 1:
-                counter += 1
-                if counter %100000 == 0:
-                    print("\t#"+str(counter))
-                word, vec = self.readOneWordEmbedding()
+            header_size = self.file.tell()
+
+            vec_bytes = 4 * self.vec_size
+            matrix = numpy.empty((self.words_num, self.vec_size), dtype=numpy.float32)
+            index = dict()  # type: Dict[str, int]
+
+            buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                buf_size, pos, counter = len(buf), header_size, 0
+                while counter < self.words_num and pos < buf_size:
+                    tab = buf.find(b'\t', pos)
+                    newline = buf.find(b'\n', pos)
+                    if tab == -1 or (newline != -1 and newline < tab): tab = newline
+                    if tab == -1 or tab + 1 + vec_bytes > buf_size: break
+
+                    word = bytes.decode(buf[pos: tab])
+                    pos = tab + 1
+                    if word != '':
+                        # a duplicated word keeps its row and takes the latest vector, as the dict loader did
+                        row = index.setdefault(word, len(index))
+                        matrix[row] = numpy.frombuffer(buf, dtype=numpy.float32, count=self.vec_size, offset=pos)
+                    pos += vec_bytes
+                    # skip the separator written after each vector, like readStringWithoutBlank does
+                    while pos < buf_size and buf[pos: pos + 1] not in (b' ', b'\n', b'\t'):
+                        pos += 1
+                    pos += 1
+                    counter += 1
+                    if counter % 100000 == 0:
+                        print("\t#"+str(counter))
+            finally:
+                buf.close()
 
-                if word != '':
-                    self.vectors[word] = vec
-                else:
-                    if counter >= self.words_num:
-                        break
+            if len(index) < self.words_num:
+                matrix = matrix[:len(index)].copy()
+            self.matrix = matrix
+            self.vectors = VectorIndex.from_words(list(index), matrix)
+            self.norms = cal_norms(matrix)
 
             print('Loaded, excepted num #{}, loaded: #{}, time: {}'.format(
-                self.words_num, counter, str(datetime.timedelta(seconds=int(time.time())-start_time))))
+                self.words_num, len(index), str(datetime.timedelta(seconds=int(time.time()-start_time)))))
             return self.vectors
         except EnvironmentError:
-            pass
\ No newline at end of file
+            pass
+
+    def loadNpy(self):
+        """ Maps the matrix, the words and the norms written by convert_to_npy, nothing is read
+        until it is looked up.
+        """
+        print('\nMapping embeddings from {}'.format(self.vec_path))
+        start_time = time.time()
+        npy_path = get_npy_paths(self.vec_path)[0]
+        words_prefix = get_words_prefix(npy_path)
+        if not os.path.exists(words_prefix + BLOB_SUFFIX):
+            convert_vocab(npy_path)
+
+        matrix = numpy.load(npy_path, mmap_mode='r')
+        self.words_num, self.vec_size = matrix.shape
+        self.matrix = matrix
+        self.vectors = VectorIndex.load(words_prefix, matrix)
+        norms_path = get_norms_path(npy_path)
+        if os.path.exists(norms_path):
+            self.norms = numpy.load(norms_path, mmap_mode='r')
+        else:
+            self.norms = cal_norms(matrix)
+        print('Mapped, #{}, time: {:.3f}s'.format(self.words_num, time.time()-start_time))
+        return self.vectors
+
+    def get_norm(self, word):
+        row = self.vectors.get_row(word)
+        if row is None: return None
+        return self.norms[row]
+
+    def get_rows(self, words):
+        """ Row ids of the words which have embeddings.
+        """
+        word_index = self.vectors.word_index
+        rows = (word_index.find(word) for word in words)
+        return numpy.array([row for row in rows if row >= 0], dtype=numpy.int64)
+
+    def get_sum(self, words):
+        """ float64 sum of the embeddings of the words which have embeddings, and their number.
+        """
+        rows = self.get_rows(words)
+        if len(rows) == 0: return numpy.zeros(self.vec_size, dtype=numpy.float64), 0
+        return self.matrix[rows].sum(axis=0, dtype=numpy.float64), len(rows)
+
+    def get_centroid(self, words):
+        """ Average embedding of the words which have embeddings, None if there is none.
+        """
+        rows = self.get_rows(words)
+        if len(rows) == 0: return None
+        return self.matrix[rows].mean(axis=0)
+
+    def cosine_similarity(self, word, unit_vec) -> float:
+        """ cos(word, unit_vec) as a single dot product.
+
+        :param word: the token whose embedding is compared, its norm is cached.
+        :param unit_vec: a vector already normalized by `normalize`.
+        """
+        row = self.vectors.get_row(word)
+        if row is None or self.norms[row] == 0: return 0
+        return float(numpy.dot(self.matrix[row], unit_vec) / self.norms[row])
@@ -33,6 +33,14 @@ class BaiduWordManager(WordManager):
             cls.instance.vec_model = VecModel(vec_path)
         return cls.instance
 
+    @classmethod
+    def create(cls, vec_path):
+        """ A new instance, neither cached as nor replacing the singleton instance.
+        """
+        manager = object.__new__(cls)
+        manager.vec_model = VecModel(vec_path)
+        return manager
+
 class WikiWordManager(WordManager):
     source = "wiki"
     language = "en"
@@ -43,4 +51,12 @@ class WikiWordManager(WordManager):
             cls.instance.vec_model = VecModel(vec_path)
         if force_reload:
             cls.instance.vec_model = VecModel(vec_path)
-        return cls.instance
\ No newline at end of file
+        return cls.instance
+
+    @classmethod
+    def create(cls, vec_path):
+        """ A new instance, neither cached as nor replacing the singleton instance.
+        """
+        manager = object.__new__(cls)
+        manager.vec_model = VecModel(vec_path)
+        return manager
@@ -7,10 +7,11 @@ Example Usage:
 
     parser = TrieTreeWordParser(dict_path, trie_path)
     result = parser.parse_text(text) # [word1, word2, word3, ...]
+    tokens = parser.tokenize(text)   # [(word1, start1, end1), ...]
 """
 
 from abc import ABCMeta, abstractmethod
-from typing import List
+from typing import List, Tuple
 
 import jieba
 from jpype import *
@@ -31,6 +32,23 @@ class WordParser(metaclass=ABCMeta):
         """
         pass
 
+    def tokenize(self, text: str) -> List[Tuple[str, int, int]]:
+        """ parse the text into a word sequence with character offsets.
+
+        Args:
+            text: the text for parsing.
+
+        Return:
+            List[Tuple[str, int, int]], (word, start, end) where text[start: end] == word.
+        """
+        tokens, offset = [], 0
+        for word in self.parse_text(text) or []:
+            start = text.find(word, offset)
+            if start < 0: continue
+            tokens.append((word, start, start + len(word)))
+            offset = start + len(word)
+        return tokens
+
 
 class TrieTreeWordParser(WordParser):
     def __new__(cls, dict_path, trie_path, jar_path=Config.project_root + "data/jar/BuildIndex.jar"):
@@ -78,6 +96,9 @@ class JiebaWordParser(WordParser):
         words = [item for item in jieba.cut(text)]
         return words
 
+    def tokenize(self, text):
+        return list(jieba.tokenize(text))
+
 class EnWordParser(WordParser):
     def parse_text(self, text: str):
         return [item.strip() for item in text.strip().split(" ") if len(item.strip())>0]
\ No newline at end of file
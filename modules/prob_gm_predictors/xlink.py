@@ -1,18 +1,75 @@
-import copy
+import datetime
 import imp
+import json
+import os
+import shutil
+import time
 from typing import List
 
 import numpy
-from numpy import linalg as LA
 
 from models import Candidate, Mention
 from modules import EntityManager, MentionParser, ProbHolder, WordManager, WordParser
-from modules import Predictor
+from modules import Predictor, Snapshot
+from modules.ConflictResolver import ConflictResolver
+from modules.DocumentContext import DocumentContext
+from modules.VecModel import normalize, save_npy
 
 imp.reload(ProbHolder)
 imp.reload(MentionParser)
 
-class XLinkPredictor(Predictor.Predictor):
+conflict_resolver = ConflictResolver()
+
+class ContextSimilarity:
+    """ P(C|e) and P(N|e) of a candidate, shared by XLinkPredictor and XLinkEntityDisambiguator.
+    """
+    entity_manager = None   # type: EntityManager.EntityManager
+    word_manager = None     # type: WordManager.WordManager
+
+    def cal_candidate_context_words_sim(self, entity_id, context_words) -> float:
+        if len(context_words) == 0: return 0
+        context_centroid = self.word_manager.vec_model.get_centroid(context_words)
+        # 没有任何 context word 有向量时与 cal_candidate_context_words_sim_by_embed 一致
+        if context_centroid is None: return 0
+        context_embed = normalize(context_centroid)
+        return self.entity_manager.get_vec_model().cosine_similarity(entity_id, context_embed)
+
+    def cal_candidate_context_entities_sim(self, entity_id, context_entities: List[Candidate]) -> float:
+        if len(context_entities) == 0: return 1
+        context_centroid = self.entity_manager.get_vec_model().get_centroid(
+            [candidate.entity_id for candidate in context_entities])
+        if context_centroid is None: return 1
+        context_embed = normalize(context_centroid)
+        return self.entity_manager.get_vec_model().cosine_similarity(entity_id, context_embed)
+
+    def cal_candidate_context_words_sim_by_embed(self, entity_id, context_words_embed) -> float:
+        """ cal_candidate_context_words_sim with the context words centroid from DocumentContext.get_context_embed.
+        """
+        if context_words_embed is None: return 0
+        return self.entity_manager.get_vec_model().cosine_similarity(entity_id, context_words_embed)
+
+    def cal_context_entities_embed(self, context_sum, context_num, left_out_entity_ids=None):
+        """ Normalized centroid of the context entities, computed from their embedding sum.
+
+        :param context_sum, context_num: VecModel.get_sum of the document's context entities.
+        :param left_out_entity_ids: context entities to leave out, they are subtracted from the sum
+            instead of rebuilding the context entities list.
+        :return: None if no context entity is left.
+        """
+        if left_out_entity_ids:
+            left_out_sum, left_out_num = self.entity_manager.get_vec_model().get_sum(left_out_entity_ids)
+            context_sum, context_num = context_sum - left_out_sum, context_num - left_out_num
+        if context_num <= 0: return None
+        return normalize(context_sum)
+
+    def cal_candidate_context_entities_sim_by_embed(self, entity_id, context_entities_embed) -> float:
+        """ cal_candidate_context_entities_sim with the context entities centroid from cal_context_entities_embed.
+        """
+        if context_entities_embed is None: return 1
+        return self.entity_manager.get_vec_model().cosine_similarity(entity_id, context_entities_embed)
+
+
+class XLinkPredictor(ContextSimilarity, Predictor.Predictor):
 
     entity_manager = None   # type: EntityManager.EntityManager
     word_manager = None     # type: WordManager.WordManager
@@ -20,6 +77,7 @@ class XLinkPredictor(Predictor.Predictor):
 
     prob_mention_parser = None      # type: MentionParser.MentionParser
     no_prob_mention_parser = None   # type: MentionParser.MentionParser
+    merged_mention_parser = None    # type: MentionParser.MergedAhoCorasickMentionParser
 
     prob_holder = None      # type: ProbHolder.ProbHolder
 
@@ -28,6 +86,9 @@ class XLinkPredictor(Predictor.Predictor):
     entity_popularity_power = 0.02
     link_prob_th = 0.008
     mention_believe_score_th = 0.2
+    # 查询时每个 mention 保留的候选实体数以及累计 p(e|m) 阈值, None 表示不裁剪
+    max_candidates = None
+    candidates_cum_prob_th = None
 
     no_prob_context_words_window = 50
     no_prob_context_words_sim_th = 0.3
@@ -47,7 +108,9 @@ class XLinkPredictor(Predictor.Predictor):
                 m_given_e_path,
                 e_given_m_path,
                 link_prob_path,
-                force_reload=False):
+                force_reload=False,
+                merged_mention_trie_path=None,
+                prob_store_path=None):
 
         if not hasattr(XLinkPredictor, 'instance'):
             cls.instance = super(XLinkPredictor, cls).__new__(cls)
@@ -63,9 +126,20 @@ class XLinkPredictor(Predictor.Predictor):
                 m_given_e_path,
                 e_given_m_path,
                 link_prob_path,
-                force_reload)
+                force_reload,
+                merged_mention_trie_path,
+                prob_store_path)
         return cls.instance
 
+    @classmethod
+    def create(cls, *args, **kwargs):
+        """ Takes the same arguments as XLinkPredictor(...), but returns a new predictor with its own
+        entity manager, word manager and prob holder, neither cached as nor replacing the singleton instance.
+        """
+        predictor = object.__new__(cls)
+        predictor._init(*args, shared=False, **kwargs)
+        return predictor
+
     def _init(self, source,
                 entity_dict_path,
                 entity_vec_path,
@@ -78,9 +152,12 @@ class XLinkPredictor(Predictor.Predictor):
                 m_given_e_path,
                 e_given_m_path,
                 link_prob_path,
-                force_reload = False):
+                force_reload = False,
+                merged_mention_trie_path = None,
+                prob_store_path = None,
+                shared = True):
 
-        EManager, PHolder, WManager, WParser, MParser = None, None, None, None, MentionParser.TrieTreeMentionParser
+        EManager, PHolder, WManager, WParser = None, None, None, None
 
         if source == 'bd':
             EManager = EntityManager.BaiduEntityManager
@@ -93,38 +170,240 @@ class XLinkPredictor(Predictor.Predictor):
             PHolder  = ProbHolder.WikiProbHolder
             WParser  = WordParser.EnWordParser
 
-        self.entity_manager = EManager(entity_dict_path, entity_vec_path, force_reload)
-        self.word_manager   = WManager(word_vec_path, force_reload)
+        # 记录加载所用的源文件, save_snapshot 据此计算校验和
+        self.source = source
+        self.input_paths = {
+            "entity_dict": entity_dict_path,
+            "entity_vec": entity_vec_path,
+            "word_vec": word_vec_path,
+            "prob_mention_dict_txt": prob_mention_dict_txt_path,
+            "prob_mention_dict_trie": prob_mention_dict_trie_path,
+            "no_prob_mention_dict_txt": no_prob_mention_dict_txt_path,
+            "no_prob_mention_dict_trie": no_prob_mention_dict_trie_path,
+            "entity_prior": entity_prior_path,
+            "m_given_e": m_given_e_path,
+            "e_given_m": e_given_m_path,
+            "link_prob": link_prob_path,
+            "merged_mention_trie": merged_mention_trie_path,
+            "prob_store": prob_store_path,
+        }
+
+        # shared=False 时不使用单例, 供 ModelBundle 同时持有新旧两份模型
+        if shared:
+            self.entity_manager = EManager(entity_dict_path, entity_vec_path, force_reload)
+            self.word_manager   = WManager(word_vec_path, force_reload)
+        else:
+            self.entity_manager = EManager.create(entity_dict_path, entity_vec_path)
+            self.word_manager   = WManager.create(word_vec_path)
         self.word_parser    = WParser()
 
-        ma_trie_config = MentionParser.TrieTreeConfig(prob_mention_dict_txt_path, prob_mention_dict_trie_path, "ma", 100)
-        tt_trie_config = MentionParser.TrieTreeConfig(no_prob_mention_dict_txt_path, no_prob_mention_dict_trie_path, "tt", 0)
-        self.prob_mention_parser = MParser(ma_trie_config)
-        self.no_prob_mention_parser = MParser(tt_trie_config)
+        # "ma" 与 "tt" 两个词典编译到同一个自动机时, 一次扫描即可得到两组 mention
+        self.merged_mention_parser = None
+        if merged_mention_trie_path is not None:
+            self.merged_mention_parser = MentionParser.MergedAhoCorasickMentionParser(merged_mention_trie_path)
+        else:
+            ma_trie_config = MentionParser.TrieTreeConfig(prob_mention_dict_txt_path, prob_mention_dict_trie_path, "ma", 100)
+            tt_trie_config = MentionParser.TrieTreeConfig(no_prob_mention_dict_txt_path, no_prob_mention_dict_trie_path, "tt", 0)
+            self.prob_mention_parser = MentionParser.create_mention_parser(ma_trie_config)
+            self.no_prob_mention_parser = MentionParser.create_mention_parser(tt_trie_config)
+
+        # prob_store_path 指向 main.generate_prob_files 生成的 prob_store 目录时, 以内存映射方式加载
+        if prob_store_path is not None:
+            self.prob_holder = ProbHolder.CompactProbHolder(prob_store_path)
+        elif shared:
+            self.prob_holder = PHolder(entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path)
+        else:
+            self.prob_holder = PHolder.create(entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path)
 
-        self.prob_holder    = PHolder(entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path)
+    def save_snapshot(self, snapshot_path) -> dict:
+        """ Writes every loaded structure to the snapshot directory read by load_snapshot.
+
+        :return: the manifest
+        """
+        print("\nSaving snapshot to: {}".format(snapshot_path))
+        start_at = int(time.time())
+        with Snapshot.writing(snapshot_path) as tmp_path:
+            self.entity_manager.get_entity_dictionary().save(os.path.join(tmp_path, "entity_dictionary"))
+            save_npy(self.entity_manager.get_vec_model(), os.path.join(tmp_path, "entity_vectors.npy"))
+            save_npy(self.word_manager.vec_model, os.path.join(tmp_path, "word_vectors.npy"))
+            ProbHolder.save_prob_store(self.prob_holder, os.path.join(tmp_path, "prob_store"))
+            if self.merged_mention_parser is not None:
+                self.save_merged_trie(self.merged_mention_parser, os.path.join(tmp_path, "mentions_merged.pytrie"))
+            else:
+                self.save_parser_trie(self.prob_mention_parser, os.path.join(tmp_path, "mention_anchors_prob.pytrie"))
+                self.save_parser_trie(self.no_prob_mention_parser, os.path.join(tmp_path, "title_entities.pytrie"))
+            manifest = Snapshot.write_manifest(tmp_path, self.input_paths,
+                                               source=self.source, hyper_params=self.get_hyper_params())
+        print("Snapshot saved, time: {}".format(str(datetime.timedelta(seconds=int(time.time())-start_at))))
+        return manifest
+
+    @staticmethod
+    def save_merged_trie(merged_mention_parser: MentionParser.MergedAhoCorasickMentionParser, trie_path):
+        from datatool.pipeline.generate_tries import MERGED_WEIGHTS_SUFFIX
+        shutil.copyfile(merged_mention_parser.trie_path, trie_path)
+        with open(trie_path + MERGED_WEIGHTS_SUFFIX, "w", encoding="utf-8") as wf:
+            json.dump(merged_mention_parser.weights, wf, ensure_ascii=False)
+
+    def save_parser_trie(self, mention_parser: MentionParser.MentionParser, trie_path):
+        if isinstance(mention_parser, MentionParser.AhoCorasickMentionParser):
+            shutil.copyfile(mention_parser.param_config.trie_path, trie_path)
+            return
+        # JVM 词典树没有可复制的 .pytrie, 由其文本词典重新构建
+        from datatool.pipeline.generate_tries import build_prob_trie, build_trie
+        if mention_parser.param_config.name == "ma":
+            build_prob_trie(mention_parser.param_config.dict_path, trie_path, self.prob_holder)
+        else:
+            build_trie(mention_parser.param_config.dict_path, trie_path)
+
+    @classmethod
+    def load_snapshot(cls, snapshot_path, verify=True, shared=True):
+        """ Predictor loaded from a directory written by save_snapshot, with the same hyper params.
+
+        :param verify: raise ValueError if a source file the snapshot was built from has changed since.
+        :param shared: False to build it by create instead of as the singleton.
+        """
+        manifest = Snapshot.read_manifest(snapshot_path, verify)
+
+        def get_path(name):
+            return os.path.join(snapshot_path, name)
+
+        merged_mention_trie_path = get_path("mentions_merged.pytrie")
+        args = (manifest["source"],
+                get_path("entity_dictionary"),
+                get_path("entity_vectors.npy"),
+                get_path("word_vectors.npy"),
+                None, get_path("mention_anchors_prob.pytrie"),
+                None, get_path("title_entities.pytrie"),
+                None, None, None, None)
+        kwargs = dict(merged_mention_trie_path=merged_mention_trie_path if os.path.exists(merged_mention_trie_path) else None,
+                      prob_store_path=get_path("prob_store"))
+        predictor = cls(*args, **kwargs) if shared else cls.create(*args, **kwargs)
+        predictor.set_hyper_params(**manifest["hyper_params"])
+        return predictor
 
     def predict(self, document) -> List[Mention]:
-        prob_link_result = self.predict_has_prob(document)
-        no_prob_link_result = self.predict_no_prob(document)
-        return self.merge_two_result(prob_link_result, no_prob_link_result)
+        return self.predict_batch([document])[0]
 
-    def predict_has_prob(self, document) -> List[Mention]:
-        prob_mentions = self.prob_mention_parser.parse_text(document)   # type: List[Mention]
+    def predict_batch(self, documents: List[str]) -> List[List[Mention]]:
+        """ Same results as predict on each document, but the candidates of all documents are
+        scored together by a few large matrix operations.
+        """
+        document_contexts = [DocumentContext(document, self.word_parser, self.word_manager) for document in documents]
+        parse_results = [self.parse_mentions(document) for document in documents]
+        prob_link_results = self.predict_has_prob_batch(
+            documents, document_contexts, [prob_mentions for prob_mentions, _ in parse_results])
+
+        results = []
+        for document, document_context, parse_result, prob_link_result in zip(
+                documents, document_contexts, parse_results, prob_link_results):
+            no_prob_link_result = self.predict_no_prob(document, document_context, parse_result[1])
+            results.append(self.merge_two_result(prob_link_result, no_prob_link_result))
+        return results
+
+    def parse_mentions(self, document):
+        """ Mentions of the "ma" and "tt" dictionaries, in one scan if a merged trie is loaded.
+        """
+        if self.merged_mention_parser is not None:
+            parse_result = self.merged_mention_parser.parse_text_by_source(document)
+            return parse_result.get("ma", []), parse_result.get("tt", [])
+        return self.prob_mention_parser.parse_text(document), self.no_prob_mention_parser.parse_text(document)
+
+    def predict_has_prob(self, document, document_context: DocumentContext = None, prob_mentions: List[Mention] = None) -> List[Mention]:
+        if prob_mentions is None:
+            prob_mentions = self.parse_mentions(document)[0]   # type: List[Mention]
+        if document_context is None:
+            document_context = DocumentContext(document, self.word_parser, self.word_manager)
+        return self.predict_has_prob_batch([document], [document_context], [prob_mentions])[0]
+
+    def predict_has_prob_batch(self, documents: List[str], document_contexts: List[DocumentContext],
+                               prob_mentions_list: List[List[Mention]]) -> List[List[Mention]]:
+        # 1. Find all unambiguous mentions of each document
+        prob_link_results, unambiguous_mentions_list = [], []
+        for document_context, prob_mentions in zip(document_contexts, prob_mentions_list):
+            prob_link_result, unambiguous_mentions = self.find_unambiguous_mentions(document_context, prob_mentions)
+            prob_link_results.append(prob_link_result)
+            unambiguous_mentions_list.append(unambiguous_mentions)
 
+        # 2. Calculate candidates' believe score.
+        # All candidates of the batch are gathered into one (n_candidates x dim) matrix and scored at once.
+        entity_vec_model = self.entity_manager.get_vec_model()
+        all_mentions, mention_doc_idx = [], []
+        for doc_idx, prob_link_result in enumerate(prob_link_results):
+            all_mentions.extend(prob_link_result)
+            mention_doc_idx.extend([doc_idx] * len(prob_link_result))
+
+        context_embeds = numpy.zeros((len(all_mentions), self.word_manager.vec_model.vec_size), dtype=numpy.float32)
+        scored_candidates, candidate_rows, candidate_mention_idx = [], [], []
+        for i, mention in enumerate(all_mentions):
+            context_embed = document_contexts[mention_doc_idx[i]].get_context_embed(
+                mention.start, mention.end, self.context_words_window)
+            if context_embed is not None:
+                context_embeds[i] = context_embed
+            for candidate in mention.candidates:
+                row = entity_vec_model.vectors.get_row(candidate.entity_id)
+                if row is not None:
+                    scored_candidates.append(candidate)
+                    candidate_rows.append(row)
+                    candidate_mention_idx.append(i)
+
+        context_entities_embeds = numpy.zeros((len(documents), entity_vec_model.vec_size), dtype=numpy.float32)
+        has_context_entities = numpy.zeros(len(documents), dtype=bool)
+        for doc_idx, unambiguous_mentions in enumerate(unambiguous_mentions_list):
+            context_entities_embed = self.cal_context_entities_embed(*entity_vec_model.get_sum(
+                [mention.result_cand.entity_id for mention in unambiguous_mentions]))
+            if context_entities_embed is not None:
+                context_entities_embeds[doc_idx] = context_entities_embed
+                has_context_entities[doc_idx] = True
+
+        candidate_mention_idx = numpy.array(candidate_mention_idx, dtype=numpy.int64)
+        candidate_doc_idx = numpy.array(mention_doc_idx, dtype=numpy.int64)[candidate_mention_idx]
+        context_words_sims, context_entities_sims = self.cal_candidates_context_sims(
+            numpy.array(candidate_rows, dtype=numpy.int64),
+            context_embeds[candidate_mention_idx],
+            context_entities_embeds[candidate_doc_idx],
+            has_context_entities[candidate_doc_idx])
+        believe_scores = self.cal_candidates_believe_score_v2(
+            [all_mentions[i] for i in candidate_mention_idx], scored_candidates,
+            context_words_sims, context_entities_sims)
+
+        mention_candidates = [[] for _ in all_mentions]
+        for k, candidate in enumerate(scored_candidates):
+            candidate.set_context_words_sim(float(context_words_sims[k]))
+            candidate.set_context_entities_sim(float(context_entities_sims[k]))
+            candidate.set_believe_score(float(believe_scores[k]))
+            mention_candidates[candidate_mention_idx[k]].append(candidate)
+
+        results = [[] for _ in documents]
+        for i, mention in enumerate(all_mentions):
+            # mentions without any embedded candidate can not be scored
+            if len(mention_candidates[i]) == 0: continue
+            mention.candidates = sorted(mention_candidates[i], key=lambda item: item.believe_score, reverse=True)
+            mention.set_result_cand(mention.candidates[0])
+
+            # 3. Refine mentions' believe score
+            link_prob = self.get_link_prob(mention)
+            if link_prob is not None and link_prob > self.link_prob_th:
+                mention.set_believe_score((mention.result_cand.believe_score + link_prob) / 2)
+                if mention.believe_score > self.mention_believe_score_th:
+                    results[mention_doc_idx[i]].append(mention)
+        return results
+
+    def find_unambiguous_mentions(self, document_context: DocumentContext, prob_mentions: List[Mention]):
+        """ Sets mentions' context and candidates' entities.
+
+        :return: (prob_link_result, unambiguous_mentions)
+        """
         # 1. Find all unambiguous mentions
         unambiguous_mentions = []  # type: List[Mention]
         prob_link_result = []  # type: List[Mention]
+        # 候选实体只在读取 candidate.entity 时才查词典, 打分过程只用 entity_id
+        entity_dictionary = self.entity_manager.get_entity_dictionary()
         for mention in prob_mentions:
+            if self.max_candidates is not None or self.candidates_cum_prob_th is not None:
+                mention.candidates = self.prune_candidates(mention)
 
-            prev_start = mention.start - self.context_words_window
-            if prev_start < 0: prev_start = 0
-            after_end = mention.end + self.context_words_window
-            if after_end > len(document): after_end = len(document)
-            prev_context_words = [word for word in self.word_parser.parse_text(document[prev_start: mention.start]) if
-                                  word in self.word_manager.vec_model.vectors]
-            after_context_words = [word for word in self.word_parser.parse_text(document[mention.end: after_end]) if
-                                   word in self.word_manager.vec_model.vectors]
+            prev_context_words, after_context_words = document_context.get_context_words(
+                mention.start, mention.end, self.context_words_window)
 
             mention.set_prev_context(prev_context_words)
             mention.set_after_context(after_context_words)
@@ -133,75 +412,46 @@ class XLinkPredictor(Predictor.Predictor):
                 entity_id = mention.candidates[0].entity_id
                 candidate = mention.candidates[0]
                 if self.entity_manager.is_entity_has_embed(entity_id):
-                    candidate.set_entity(self.entity_manager.get_entity_dictionary().get_entity_from_id(entity_id))
+                    candidate.set_entity_dictionary(entity_dictionary)
                     mention.set_result_cand(candidate)
                     unambiguous_mentions.append(mention)
 
             else:
                 for candidate in mention.candidates:
                     if self.entity_manager.is_entity_has_embed(candidate.entity_id):
-                        candidate.set_entity(self.entity_manager.get_entity_dictionary().get_entity_from_id(candidate.entity_id))
+                        candidate.set_entity_dictionary(entity_dictionary)
 
             prob_link_result.append(mention)
+        return prob_link_result, unambiguous_mentions
 
-        # 2. Calculate candidates' believe score.
-        tmp_mentions_holder = []
-        for mention in prob_link_result:
-            context_words = copy.deepcopy(mention.prev_context)
-            context_words.extend(mention.after_context)
-            tmp_cands = []
-            for candidate in mention.candidates:
-                if self.entity_manager.is_entity_has_embed(candidate.entity_id):
-                    candidate.set_context_words_sim(
-                        self.cal_candidate_context_words_sim(candidate.entity_id, context_words))
-                    candidate.set_context_entities_sim(self.cal_candidate_context_entities_sim(candidate.entity_id,
-                                                                                           [mention.result_cand for
-                                                                                            mention in
-                                                                                            unambiguous_mentions]))
-                    candidate.set_believe_score(self.cal_candidate_believe_score_v2(mention, candidate))
-                    tmp_cands.append(candidate)
-            mention.candidates = sorted(tmp_cands, key=lambda item: item.believe_score, reverse=True)
-            mention.set_result_cand(mention.candidates[0])
-            tmp_mentions_holder.append(mention)
-
-        # 3. Refine mentions' believe score
-        prob_link_result = []
-        for mention in tmp_mentions_holder:
-            if self.prob_holder.get_link_prob(mention.label) is not None and self.prob_holder.get_link_prob(
-                    mention.label) > self.link_prob_th:
-                mention.set_believe_score(
-                    (mention.result_cand.believe_score + self.prob_holder.get_link_prob(mention.label)) / 2)
-                if mention.believe_score > self.mention_believe_score_th:
-                    prob_link_result.append(mention)
-        return prob_link_result
-
-
-    def predict_no_prob(self, document) -> List[Mention]:
-        mention_list = self.no_prob_mention_parser.parse_text(document)
+    def predict_no_prob(self, document, document_context: DocumentContext = None, mention_list: List[Mention] = None) -> List[Mention]:
+        if mention_list is None:
+            mention_list = self.parse_mentions(document)[1]
+        if document_context is None:
+            document_context = DocumentContext(document, self.word_parser, self.word_manager)
 
+        entity_dictionary = self.entity_manager.get_entity_dictionary()
         mentions = []
         for mention in mention_list:
 
-            prev_start = mention.start - self.no_prob_context_words_window
-            if prev_start < 0: prev_start = 0
-            after_end = mention.end + self.no_prob_context_words_window
-            if after_end > len(document): after_end = len(document)
-            prev_context_words = [word for word in self.word_parser.parse_text(document[prev_start: mention.start]) if
-                                  word in self.word_manager.vec_model.vectors]
-            after_context_words = [word for word in self.word_parser.parse_text(document[mention.end: after_end]) if
-                                   word in self.word_manager.vec_model.vectors]
+            prev_context_words, after_context_words = document_context.get_context_words(
+                mention.start, mention.end, self.no_prob_context_words_window)
             context_words = prev_context_words
             context_words.extend(after_context_words)
+            context_words_embed = document_context.get_context_embed(
+                mention.start, mention.end, self.no_prob_context_words_window)
 
             # 按照 context_words_sim 初步筛选出 valid candidate for mention
             valid_candidates = []  # type: List[Candidate]
             for candidate in mention.candidates:
                 candidate_id = candidate.entity_id
-                if self.entity_manager.is_entity_has_embed(candidate_id) and \
-                        self.entity_manager.get_entity_dictionary().entity_dict.get(candidate_id) is not None:
-                    candidate.set_entity(self.entity_manager.get_entity_dictionary().entity_dict.get(candidate_id))
+                if not self.entity_manager.is_entity_has_embed(candidate_id): continue
+                entity_row = entity_dictionary.get_row(candidate_id)
+                if entity_row >= 0:
+                    candidate.set_entity_dictionary(entity_dictionary, entity_row)
 
-                    candidate.set_context_words_sim(self.cal_candidate_context_words_sim(candidate_id, context_words))
+                    candidate.set_context_words_sim(
+                        self.cal_candidate_context_words_sim_by_embed(candidate_id, context_words_embed))
                     if candidate.context_words_sim > self.no_prob_context_words_sim_th:
                         valid_candidates.append(candidate)
 
@@ -229,29 +479,25 @@ class XLinkPredictor(Predictor.Predictor):
         for cand in seed_candidates:
             context_entities.append(cand.entity)
 
+        # seed_candidates 的 embedding 之和每个文档只计算一次
+        seed_sum, seed_num = self.entity_manager.get_vec_model().get_sum([cand.entity_id for cand in seed_candidates])
+        seed_embed = self.cal_context_entities_embed(seed_sum, seed_num)
+
         # 为所有的 mention 的 candidate 计算 context_entities_sim
         for i, mention in enumerate(mentions):
             if mention.result_cand is None:
                 # 如果是未消歧的 mention，直接计算与 seed_candidates 的相似度
-                for j, candidate in enumerate(mentions[i].candidates):
-                    mentions[i].set_context_entities(context_entities)
-                    mentions[i].candidates[j].set_context_entities_sim(
-                        self.cal_candidate_context_entities_sim(candidate.entity_id, seed_candidates))
+                context_entities_embed = seed_embed
             else:
-                # 如果是已消歧的 mention，则去掉该 mention 的 candidates 得到 seed_candidates_for_mention，计算相似度
-                seed_entities_for_mention = []  # type: List[Candidate]
-                for seed_cand in seed_candidates:
-                    belong_to_mention = False
-                    for cand in mention.candidates:
-                        if cand.entity_id == seed_cand.entity_id:
-                            belong_to_mention = True
-                    if not belong_to_mention:
-                        seed_entities_for_mention.append(seed_cand)
-
-                for j, candidate in enumerate(mentions[i].candidates):
-                    mentions[i].set_context_entities(context_entities)
-                    mentions[i].candidates[j].set_context_entities_sim(
-                        self.cal_candidate_context_entities_sim(candidate.entity_id, seed_entities_for_mention))
+                # 如果是已消歧的 mention，则从 seed_candidates 的和中减去属于该 mention 的 candidates，计算相似度
+                mention_entity_ids = set([cand.entity_id for cand in mention.candidates])
+                context_entities_embed = self.cal_context_entities_embed(seed_sum, seed_num, [
+                    seed_cand.entity_id for seed_cand in seed_candidates if seed_cand.entity_id in mention_entity_ids])
+
+            mentions[i].set_context_entities(context_entities)
+            for j, candidate in enumerate(mentions[i].candidates):
+                mentions[i].candidates[j].set_context_entities_sim(
+                    self.cal_candidate_context_entities_sim_by_embed(candidate.entity_id, context_entities_embed))
 
         # 设置 candidates 的 believe_score
         for i, mention in enumerate(mentions):
@@ -278,63 +524,22 @@ class XLinkPredictor(Predictor.Predictor):
 
         result = [] # type: List[Mention]
 
-        def key_for_compare(i):
-            return i.start
-
-        original_results = sorted(original_results, key=key_for_compare)
-        conflict_mentions = [original_results[0]]
-        start, end = conflict_mentions[0].start, conflict_mentions[0].end
-
-        for item in original_results[1:]:
-            if item.start < end:
-                conflict_mentions.append(item)
-                end = max(item.end, end)
+        matches = [(mention.start, mention.end, 0, mention) for mention in original_results]
+        for cluster in conflict_resolver.clusters(matches):
+            conflict_mentions = [match[3] for match in cluster]
+            # If there are prob_mentions in the conflict_mentions, then keep all prob_mentions, drop all no_prob_mentions.
+            # If there are no prob_mentions in the conflict_mentions, the conflict_mentions definitely contains only one no_prob_mention, keep it.
+            mentions_has_prob = []
+            for conflict_mention in conflict_mentions:
+                if conflict_mention.believe_score is not None:
+                    mentions_has_prob.append(conflict_mention)
+            if len(mentions_has_prob) is not None:
+                result.extend(mentions_has_prob)
             else:
-                # If there are prob_mentions in the conflict_mentions, then keep all prob_mentions, drop all no_prob_mentions.
-                # If there are no prob_mentions in the conflict_mentions, the conflict_mentions definitely contains only one no_prob_mention, keep it.
-                mentions_has_prob = []
-                for conflict_mention in conflict_mentions:
-                    if conflict_mention.believe_score is not None:
-                        mentions_has_prob.append(conflict_mention)
-                if len(mentions_has_prob) is not None:
-                    result.extend(mentions_has_prob)
-                else:
-                    result.extend(conflict_mentions)
-                conflict_mentions = [item]
-                start, end = item.start, item.end
-
-        mentions_has_prob = []
-        for conflict_mention in conflict_mentions:
-            if conflict_mention.believe_score is not None:
-                mentions_has_prob.append(conflict_mention)
-        if len(mentions_has_prob) is not None:
-            result.extend(mentions_has_prob)
-        else:
-            result.extend(conflict_mentions)
+                result.extend(conflict_mentions)
 
-        result = sorted(result, key=key_for_compare)
         return result
 
-    def cal_candidate_context_words_sim(self, entity_id, context_words) -> float:
-        if len(context_words) == 0: return 0
-        context_embed = numpy.zeros(self.word_manager.vec_model.vec_size)
-        for word in context_words:
-            context_embed += numpy.array(self.word_manager.vec_model.vectors.get(word))
-        context_embed /= len(context_words)
-
-        entity_embed = self.entity_manager.get_vec_model().vectors.get(entity_id)
-        return numpy.matmul(entity_embed, context_embed)/(LA.norm(entity_embed, 2) * LA.norm(context_embed, 2))
-
-    def cal_candidate_context_entities_sim(self, entity_id, context_entities: List[Candidate]) -> float:
-        if len(context_entities) == 0: return 1
-        context_embed = numpy.zeros(self.entity_manager.get_vec_model().vec_size)
-        for candidate in context_entities:
-            context_embed += numpy.array(self.entity_manager.get_vec_model().vectors.get(candidate.entity_id))
-        context_embed /= len(context_entities)
-
-        entity_embed = self.entity_manager.get_vec_model().vectors.get(entity_id)
-        return numpy.matmul(entity_embed, context_embed)/(LA.norm(entity_embed, 2) * LA.norm(context_embed, 2))
-
     def cal_candidate_believe_score_v1(self, candidate: Candidate) -> float:
         """ P(e)^a * P(C|e) * P(N|e)
         """
@@ -347,12 +552,69 @@ class XLinkPredictor(Predictor.Predictor):
     def cal_candidate_believe_score_v2(self, mention: Mention, candidate: Candidate) -> float:
         """ P(e|m) * P(C|e) * P(N|e)
         """
-        if self.prob_holder.get_e_given_m(candidate.entity_id, mention.label) is not None:
+        e_given_m = self.get_e_given_m(mention, candidate)
+        if e_given_m is not None:
             return candidate.context_entities_sim * \
                candidate.context_words_sim * \
-               numpy.power(self.prob_holder.get_e_given_m(candidate.entity_id, mention.label), self.entity_popularity_power)
+               numpy.power(e_given_m, self.entity_popularity_power)
         return 0
 
+    def get_link_prob(self, mention: Mention):
+        """ link_prob from the payload of a prob trie, or from prob_holder.
+        """
+        if mention.link_prob is not None:
+            return mention.link_prob
+        return self.prob_holder.get_link_prob(mention.label)
+
+    def prune_candidates(self, mention: Mention) -> List[Candidate]:
+        """ Top max_candidates candidates by p(e|m), cut once their p(e|m) sum up to candidates_cum_prob_th.
+        """
+        candidate_probs = [(candidate, self.get_e_given_m(mention, candidate)) for candidate in mention.candidates]
+        return [candidate for candidate, _ in ProbHolder.prune_candidates(
+            candidate_probs, self.max_candidates, self.candidates_cum_prob_th)]
+
+    def get_e_given_m(self, mention: Mention, candidate: Candidate):
+        """ p(e|m) from the payload of a prob trie, or from prob_holder.
+        """
+        if candidate.e_given_m is not None:
+            return candidate.e_given_m
+        return self.prob_holder.get_e_given_m(candidate.entity_id, mention.label)
+
+    def cal_candidates_context_sims(self, entity_rows, context_words_embeds, context_entities_embeds, has_context_entities):
+        """ Vectorized cal_candidate_context_words_sim and cal_candidate_context_entities_sim.
+
+        :param entity_rows: (n,) rows of the candidates in the entity embedding matrix.
+        :param context_words_embeds: (n, dim) normalized context words centroid of each candidate's mention,
+            zero rows for mentions without context words.
+        :param context_entities_embeds: (n, dim) normalized context entities centroid of each candidate's document.
+        :param has_context_entities: (n,) False where the candidate's document has no context entity.
+        :return: context_words_sims (n,), context_entities_sims (n,)
+        """
+        entity_vec_model = self.entity_manager.get_vec_model()
+        entity_embeds = entity_vec_model.matrix[entity_rows]
+        norms = entity_vec_model.norms[entity_rows]
+        inv_norms = numpy.divide(1, norms, out=numpy.zeros_like(norms), where=norms != 0)
+
+        context_words_sims = numpy.einsum('ij,ij->i', entity_embeds, context_words_embeds) * inv_norms
+        context_entities_sims = numpy.where(
+            has_context_entities,
+            numpy.einsum('ij,ij->i', entity_embeds, context_entities_embeds) * inv_norms,
+            numpy.float32(1))
+        return context_words_sims, context_entities_sims
+
+    def cal_candidates_believe_score_v2(self, mentions: List[Mention], candidates: List[Candidate],
+                                        context_words_sims, context_entities_sims):
+        """ Vectorized cal_candidate_believe_score_v2, candidates[i] is a candidate of mentions[i].
+        """
+        e_given_m = numpy.array([self.get_e_given_m(mention, candidate)
+                                 for mention, candidate in zip(mentions, candidates)], dtype=numpy.float64)
+        has_prob = ~numpy.isnan(e_given_m)
+        believe_scores = numpy.zeros(len(candidates), dtype=numpy.float64)
+        believe_scores[has_prob] = context_entities_sims[has_prob] * \
+                                   context_words_sims[has_prob] * \
+                                   numpy.power(e_given_m[has_prob], self.entity_popularity_power)
+        return believe_scores
+
     def set_hyper_params(self,
                          context_words_window=None,
                          entity_popularity_power=None,
@@ -363,6 +625,8 @@ class XLinkPredictor(Predictor.Predictor):
                          no_prob_seed_candidates_sim_th = None,
                          no_prob_believe_score_th = None,
                          no_prob_words_sim_weight = None,
+                         max_candidates = None,
+                         candidates_cum_prob_th = None,
         ):
         if context_words_window is not None:
             self.context_words_window = context_words_window
@@ -391,6 +655,29 @@ class XLinkPredictor(Predictor.Predictor):
         if no_prob_words_sim_weight is not None:
             self.no_prob_words_sim_weight = no_prob_words_sim_weight
 
+        if max_candidates is not None:
+            self.max_candidates = max_candidates
+
+        if candidates_cum_prob_th is not None:
+            self.candidates_cum_prob_th = candidates_cum_prob_th
+
+
+    def get_hyper_params(self) -> dict:
+        """ Keyword arguments of set_hyper_params giving the current values.
+        """
+        return {
+            "context_words_window": self.context_words_window,
+            "entity_popularity_power": self.entity_popularity_power,
+            "link_prob_th": self.link_prob_th,
+            "mention_believe_score_th": self.mention_believe_score_th,
+            "no_prob_context_words_window": self.no_prob_context_words_window,
+            "no_prob_context_words_sim_th": self.no_prob_context_words_sim_th,
+            "no_prob_seed_candidates_sim_th": self.no_prob_seed_candidates_sim_th,
+            "no_prob_believe_score_th": self.no_prob_believe_score_th,
+            "no_prob_words_sim_weight": self.no_prob_words_sim_weight,
+            "max_candidates": self.max_candidates,
+            "candidates_cum_prob_th": self.candidates_cum_prob_th,
+        }
 
     def print_hyper_params(self):
         print("context_words_window: {}\n"
@@ -401,7 +688,9 @@ class XLinkPredictor(Predictor.Predictor):
               "no_prob_context_words_sim_th: {}\n"
               "no_prob_seed_candidates_sim_th: {}\n"
               "no_prob_believe_score_th: {}\n"
-              "no_prob_words_sim_weight: {}\n".format(
+              "no_prob_words_sim_weight: {}\n"
+              "max_candidates: {}\n"
+              "candidates_cum_prob_th: {}\n".format(
             self.context_words_window,
             self.entity_popularity_power,
             self.link_prob_th,
@@ -410,11 +699,13 @@ class XLinkPredictor(Predictor.Predictor):
             self.no_prob_context_words_sim_th,
             self.no_prob_seed_candidates_sim_th,
             self.no_prob_believe_score_th,
-            self.no_prob_words_sim_weight
+            self.no_prob_words_sim_weight,
+            self.max_candidates,
+            self.candidates_cum_prob_th
         ))
 
 
-class XLinkEntityDisambiguator(Predictor.Disambiguator):
+class XLinkEntityDisambiguator(ContextSimilarity, Predictor.Disambiguator):
     entity_manager = None   # type: EntityManager.EntityManager
     word_manager = None     # type: WordManager.WordManager
     word_parser = None      # type: WordParser.WordParser
@@ -440,7 +731,8 @@ class XLinkEntityDisambiguator(Predictor.Disambiguator):
                 m_given_e_path,
                 e_given_m_path,
                 link_prob_path,
-                force_reload):
+                force_reload,
+                prob_store_path=None):
         if not hasattr(XLinkEntityDisambiguator, 'instance'):
             cls.instance = super(XLinkEntityDisambiguator, cls).__new__(cls)
             cls.instance.init(
@@ -452,7 +744,8 @@ class XLinkEntityDisambiguator(Predictor.Disambiguator):
                 m_given_e_path,
                 e_given_m_path,
                 link_prob_path,
-                force_reload
+                force_reload,
+                prob_store_path
             )
         return cls.instance
 
@@ -464,7 +757,8 @@ class XLinkEntityDisambiguator(Predictor.Disambiguator):
                 m_given_e_path,
                 e_given_m_path,
                 link_prob_path,
-                force_reload):
+                force_reload,
+                prob_store_path=None):
         EManager, PHolder, WManager, WParser = None, None, None, None
 
         if source == 'bd':
@@ -481,23 +775,23 @@ class XLinkEntityDisambiguator(Predictor.Disambiguator):
         self.entity_manager = EManager(entity_dict_path, entity_vec_path, force_reload)
         self.word_manager = WManager(word_vec_path, force_reload)
         self.word_parser = WParser()
-        self.prob_holder = PHolder(entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path)
+        if prob_store_path is not None:
+            self.prob_holder = ProbHolder.CompactProbHolder(prob_store_path)
+        else:
+            self.prob_holder = PHolder(entity_prior_path, m_given_e_path, e_given_m_path, link_prob_path)
 
 
     def predict(self, document, mentions_for_ed: List[Mention]):
+        document_context = DocumentContext(document, self.word_parser, self.word_manager)
+
         # 1. Find all unambiguous mentions
         unambiguous_mentions = []  # type: List[Mention]
         prob_link_result = []  # type: List[Mention]
 
+        entity_dictionary = self.entity_manager.get_entity_dictionary()
         for mention in mentions_for_ed:
-            prev_start = mention.start - self.context_words_window
-            if prev_start < 0: prev_start = 0
-            after_end = mention.end + self.context_words_window
-            if after_end > len(document): after_end = len(document)
-            prev_context_words = [word for word in self.word_parser.parse_text(document[prev_start: mention.start]) if
-                                  word in self.word_manager.vec_model.vectors]
-            after_context_words = [word for word in self.word_parser.parse_text(document[mention.end: after_end]) if
-                                   word in self.word_manager.vec_model.vectors]
+            prev_context_words, after_context_words = document_context.get_context_words(
+                mention.start, mention.end, self.context_words_window)
 
             mention.set_prev_context(prev_context_words)
             mention.set_after_context(after_context_words)
@@ -506,32 +800,31 @@ class XLinkEntityDisambiguator(Predictor.Disambiguator):
                 entity_id = mention.candidates[0].entity_id
                 candidate = mention.candidates[0]
                 if self.entity_manager.is_entity_has_embed(entity_id):
-                    candidate.set_entity(self.entity_manager.get_entity_dictionary().get_entity_from_id(entity_id))
+                    candidate.set_entity_dictionary(entity_dictionary)
                     mention.set_result_cand(candidate)
                     unambiguous_mentions.append(mention)
 
             else:
                 for candidate in mention.candidates:
                     if self.entity_manager.is_entity_has_embed(candidate.entity_id):
-                        candidate.set_entity(
-                            self.entity_manager.get_entity_dictionary().get_entity_from_id(candidate.entity_id))
+                        candidate.set_entity_dictionary(entity_dictionary)
             prob_link_result.append(mention)
 
         # 2. Calculate candidates' believe score.
+        context_entities_embed = self.cal_context_entities_embed(*self.entity_manager.get_vec_model().get_sum(
+            [m.result_cand.entity_id for m in unambiguous_mentions]))
         result = []
         for i, mention in enumerate(prob_link_result):
-            context_words = copy.deepcopy(mention.prev_context)
-            context_words.extend(mention.after_context)
+            context_words_embed = document_context.get_context_embed(
+                mention.start, mention.end, self.context_words_window)
             mention.context_entities = [m.result_cand.entity for m in unambiguous_mentions]
             tmp_cands = []
             for candidate in mention.candidates:
                 if self.entity_manager.is_entity_has_embed(candidate.entity_id):
                     candidate.set_context_words_sim(
-                        self.cal_candidate_context_words_sim(candidate.entity_id, context_words))
-                    candidate.set_context_entities_sim(self.cal_candidate_context_entities_sim(candidate.entity_id,
-                                                                                               [mention.result_cand for
-                                                                                                mention in
-                                                                                                unambiguous_mentions]))
+                        self.cal_candidate_context_words_sim_by_embed(candidate.entity_id, context_words_embed))
+                    candidate.set_context_entities_sim(
+                        self.cal_candidate_context_entities_sim_by_embed(candidate.entity_id, context_entities_embed))
                     if mention.parse_from in ['ma']:
                         candidate.set_believe_score(self.cal_candidate_believe_score_v2(mention, candidate))    # P(e|m)^a * P(e|C) * P(e|N)
                         # candidate.set_believe_score(self.cal_candidate_believe_score_v1(candidate))           # P(e) * P(C|e) * P(N|e)
@@ -543,26 +836,6 @@ class XLinkEntityDisambiguator(Predictor.Disambiguator):
             result.append(mention)
         return result
 
-    def cal_candidate_context_words_sim(self, entity_id, context_words) -> float:
-        if len(context_words) == 0: return 0
-        context_embed = numpy.zeros(self.word_manager.vec_model.vec_size)
-        for word in context_words:
-            context_embed += numpy.array(self.word_manager.vec_model.vectors.get(word))
-        context_embed /= len(context_words)
-
-        entity_embed = self.entity_manager.get_vec_model().vectors.get(entity_id)
-        return numpy.matmul(entity_embed, context_embed)/(LA.norm(entity_embed, 2) * LA.norm(context_embed, 2))
-
-    def cal_candidate_context_entities_sim(self, entity_id, context_entities: List[Candidate]) -> float:
-        if len(context_entities) == 0: return 1
-        context_embed = numpy.zeros(self.entity_manager.get_vec_model().vec_size)
-        for candidate in context_entities:
-            context_embed += numpy.array(self.entity_manager.get_vec_model().vectors.get(candidate.entity_id))
-        context_embed /= len(context_entities)
-
-        entity_embed = self.entity_manager.get_vec_model().vectors.get(entity_id)
-        return numpy.matmul(entity_embed, context_embed)/(LA.norm(entity_embed, 2) * LA.norm(context_embed, 2))
-
     def cal_candidate_believe_score_v1(self, candidate: Candidate) -> float:
         """ P(e)^a * P(C|e) * P(N|e)
         """
@@ -0,0 +1,32 @@
+from modules.ConflictResolver import ConflictResolver, HIGHEST_WEIGHT, LONGEST_MATCH
+
+
+def spans(matches):
+    return [(m[0], m[1]) for m in matches]
+
+
+def test_highest_weight_keeps_matches_bridged_by_a_low_weight_match():
+    # B overlaps both A and C, which do not overlap each other
+    a, b, c = (0, 3, 100, "A"), (2, 10, 0, "B"), (5, 7, 100, "C")
+    assert spans(ConflictResolver(HIGHEST_WEIGHT).resolve([a, b, c])) == [(0, 3), (5, 7)]
+
+
+def test_highest_weight_prefers_weight_then_length():
+    matches = [(0, 2, 0, "short"), (0, 6, 0, "long"), (4, 8, 100, "heavy")]
+    assert spans(ConflictResolver(HIGHEST_WEIGHT).resolve(matches)) == [(0, 2), (4, 8)]
+
+
+def test_highest_weight_keeps_a_heavier_bridge():
+    a, b, c = (0, 3, 0, "A"), (2, 10, 100, "B"), (5, 7, 0, "C")
+    assert spans(ConflictResolver(HIGHEST_WEIGHT).resolve([a, b, c])) == [(2, 10)]
+
+
+def test_longest_match_keeps_one_match_per_cluster():
+    matches = [(0, 3, 0, "A"), (2, 10, 0, "B"), (12, 14, 0, "C")]
+    assert spans(ConflictResolver(LONGEST_MATCH).resolve(matches, ordered_by_end=True)) == [(2, 10), (12, 14)]
+
+
+def test_highest_weight_keeps_disjoint_matches_picked_right_to_left():
+    matches = [(2 * i, 2 * i + 1, i, i) for i in range(100)]
+    overlapping = [(2 * i, 2 * i + 2, -1, "x") for i in range(100)]
+    assert ConflictResolver(HIGHEST_WEIGHT).resolve(overlapping + matches) == matches
@@ -0,0 +1,98 @@
+import json
+import os
+
+from datatool.pipeline import generate_prob_files, incremental
+from datatool.pipeline.extract_mention_anchors import extract_mention_and_out_links_from_corpus
+
+CORPUS = "abstract"
+
+
+def write_corpus(data_path, lines):
+    with open(os.path.join(data_path, "standard_{}.txt".format(CORPUS)), "w", encoding="utf-8") as wf:
+        wf.write("".join(lines))
+
+
+def write_mention_list(data_path, mentions):
+    with open(os.path.join(data_path, "mention_anchors.txt"), "w", encoding="utf-8") as wf:
+        for mention in mentions:
+            wf.write("{}::=e\n".format(mention))
+
+
+def full_rebuild(data_path):
+    """ Statistics of main.py step 2.1 and step 4.1 over the whole corpus.
+    """
+    corpus_path = os.path.join(data_path, "standard_{}.txt".format(CORPUS))
+    mention_anchors, out_links, self_links = extract_mention_and_out_links_from_corpus(corpus_path)
+    generate_prob_files.Parser._instance = None
+    freq_m = generate_prob_files.cal_freq_m(corpus_path, os.path.join(data_path, "mention_anchors.txt"))
+    return {"mention_anchors": mention_anchors, "out_links": out_links, "self_links": self_links, "freq_m": freq_m}
+
+
+def save_statistics(data_path, statistics):
+    for name, value in statistics.items():
+        json.dump(value, open(os.path.join(data_path, "{}_{}.json".format(name, CORPUS)), "w", encoding="utf-8"))
+
+
+def load_statistics(data_path):
+    return {name: json.load(open(os.path.join(data_path, "{}_{}.json".format(name, CORPUS)), "r", encoding="utf-8"))
+            for name in ["mention_anchors", "out_links", "self_links", "freq_m"]}
+
+
+def update(data_path, mentions):
+    deltas = incremental.update_mention_anchors_and_out_links(data_path, [CORPUS])
+    write_mention_list(data_path, mentions)
+    incremental.update_freq_m(data_path, [CORPUS], deltas)
+    incremental.save_state(data_path, [CORPUS], deltas)
+    return deltas[CORPUS]
+
+
+def test_update_equals_full_rebuild(tmp_path):
+    data_path = str(tmp_path)
+    write_corpus(data_path, ["d1\t\t[[e2|Foo]] bar [[d1|Self]] baz\n",
+                             "d2\t\t[[e3|Baz]] foo\n",
+                             "d3\t\tplain foo baz\n",
+                             "d4\t\t[[e2|Foo]] and [[e3|baz]]\n"])
+    write_mention_list(data_path, ["foo", "baz"])
+    save_statistics(data_path, full_rebuild(data_path))
+    incremental.save_state(data_path, [CORPUS])
+
+    # d1 changed, d2 deleted, d5 added, and the mention list lost "baz" and gained "self" and "bar"
+    write_corpus(data_path, ["d1\t\t[[e2|Foo]] bar\n",
+                             "d3\t\tplain foo baz\n",
+                             "d4\t\t[[e2|Foo]] and [[e3|baz]]\n",
+                             "d5\t\t[[d1|Self]] bar [[e3|Baz]]\n"])
+    delta = update(data_path, ["foo", "self", "bar"])
+    assert (delta.added, delta.changed, delta.deleted) == ({"d5"}, {"d1"}, {"d2"})
+    assert load_statistics(data_path) == full_rebuild(data_path)
+
+    # a second update reads the previous text of d5 from the documents appended by the first one
+    write_corpus(data_path, ["d1\t\t[[e2|Foo]] bar\n",
+                             "d3\t\tplain foo baz\n",
+                             "d4\t\t[[e2|Foo]] and [[e3|baz]]\n",
+                             "d5\t\t[[e2|Self]] foo\n",
+                             "d6\t\tself\n"])
+    delta = update(data_path, ["foo", "self", "bar"])
+    assert (delta.added, delta.changed, delta.deleted) == ({"d6"}, {"d5"}, set())
+    assert load_statistics(data_path) == full_rebuild(data_path)
+
+
+def test_save_state_appends_only_the_inserted_documents(tmp_path):
+    data_path = str(tmp_path)
+    lines = ["d{}\t\t[[e{}|m{}]] text\n".format(i, i, i) for i in range(10)]
+    write_corpus(data_path, lines)
+    write_mention_list(data_path, ["m1"])
+    save_statistics(data_path, full_rebuild(data_path))
+    incremental.save_state(data_path, [CORPUS])
+    state_path = incremental.get_state_path(data_path)
+    documents_path = incremental.get_documents_path(state_path, CORPUS)
+    old_size = os.path.getsize(documents_path)
+    old_index = incremental.load_document_index(incremental.get_document_index_path(state_path, CORPUS))
+
+    lines[3] = "d3\t\t[[e1|m1]] changed\n"
+    write_corpus(data_path, lines)
+    update(data_path, ["m1"])
+
+    index = incremental.load_document_index(incremental.get_document_index_path(state_path, CORPUS))
+    assert os.path.getsize(documents_path) == old_size + len(lines[3].encode("utf-8"))
+    assert {i: r for i, r in index.items() if i != "d3"} == {i: r for i, r in old_index.items() if i != "d3"}
+    assert list(incremental.iter_stored_document_lines(documents_path, index, {"d3"})) == [lines[3]]
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from link_service import HttpError, LinkingService
+
+
+class StubPredictor:
+    """ Links every document to one mention covering it, and records the batches it was given.
+    """
+
+    def __init__(self, delay=0.0, release=None):
+        self.delay = delay
+        self.release = release      # type: threading.Event
+        self.started = threading.Event()
+        self.batches = []
+
+    def predict_batch(self, documents):
+        self.started.set()
+        self.batches.append(list(documents))
+        if self.release is not None:
+            self.release.wait(5)
+        time.sleep(self.delay)
+        return [[SimpleNamespace(start=0, end=len(document), label=document, believe_score=1.0,
+                                 result_cand=SimpleNamespace(entity_id="e_" + document))] for document in documents]
+
+
+def run(service, main):
+    async def wrapper():
+        await service.start()
+        try:
+            return await main()
+        finally:
+            await service.stop()
+    return asyncio.run(wrapper())
+
+
+def test_concurrent_requests_are_coalesced_into_batches():
+    stub = StubPredictor()
+    service = LinkingService(stub, max_batch_size=4, max_wait_ms=50, workers=4)
+    documents = ["d{}".format(i) for i in range(10)]
+
+    results = run(service, lambda: asyncio.gather(*[service.link(document) for document in documents]))
+
+    assert [result[0]["entity_id"] for result in results] == ["e_" + document for document in documents]
+    assert sorted(len(batch) for batch in stub.batches) == [2, 4, 4]
+
+
+def test_requests_queued_while_the_workers_are_busy_form_one_batch():
+    release = threading.Event()
+    stub = StubPredictor(release=release)
+    service = LinkingService(stub, max_batch_size=8, max_wait_ms=1, workers=1)
+
+    async def main():
+        first = asyncio.ensure_future(service.link("first"))
+        await asyncio.get_event_loop().run_in_executor(None, stub.started.wait, 5)
+        rest = [asyncio.ensure_future(service.link("d{}".format(i))) for i in range(5)]
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(first, *rest)
+
+    run(service, main)
+    assert [len(batch) for batch in stub.batches] == [1, 5]
+
+
+def test_full_queue_gets_503():
+    release = threading.Event()
+    stub = StubPredictor(release=release)
+    service = LinkingService(stub, max_batch_size=1, max_queue_size=1, workers=1)
+
+    async def main():
+        first = asyncio.ensure_future(service.link("first"))
+        await asyncio.get_event_loop().run_in_executor(None, stub.started.wait, 5)
+        queued = asyncio.ensure_future(service.link("queued"))
+        await asyncio.sleep(0)
+        with pytest.raises(HttpError) as error:
+            await service.link("rejected")
+        release.set()
+        await asyncio.gather(first, queued)
+        return error.value.status
+
+    assert run(service, main) == 503
+    assert stub.batches == [["first"], ["queued"]]
+
+
+def test_slow_linking_gets_504():
+    stub = StubPredictor(delay=0.3)
+    service = LinkingService(stub, request_timeout=0.05, workers=1)
+
+    async def main():
+        with pytest.raises(HttpError) as error:
+            await service.link("slow")
+        return error.value.status
+
+    assert run(service, main) == 504